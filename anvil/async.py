@@ -3,19 +3,117 @@
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import collections
+import sys
+import threading
+
+
+class DeferredCancelledError(Exception):
+  """Passed to errbacks when a deferred is cancelled.
+  """
+  pass
+
+
+# Callbacks are dispatched through a per-thread queue instead of being called
+# recursively, so that long chains of deferreds (each completing the next from
+# its callback) run in constant stack depth
+_dispatch_state = threading.local()
+
+
+def _dispatch(fns, args, kwargs):
+  """Calls a list of functions with the given arguments.
+  If a dispatch is already in progress on this thread the calls are queued and
+  made once the current function returns, otherwise they are made immediately.
+  If any function raises, the remaining queued calls are still made and the
+  first exception is reraised.
+
+  Args:
+    fns: A list of functions to call.
+    args: Positional arguments.
+    kwargs: Keyword arguments.
+  """
+  queue = getattr(_dispatch_state, 'queue', None)
+  if queue is None:
+    queue = _dispatch_state.queue = collections.deque()
+  queue.append((fns, args, kwargs))
+  if getattr(_dispatch_state, 'draining', False):
+    return
+  _drain()
+
+
+def call_when_idle(fn):
+  """Calls a function once all queued callbacks on this thread have been made.
+  If no dispatch is in progress the function is called immediately. Functions
+  are called in the order they were added, and any callbacks they cause are
+  made before the next one is called.
+
+  Args:
+    fn: A function taking no arguments.
+  """
+  if not getattr(_dispatch_state, 'draining', False):
+    fn()
+    return
+  idle_fns = getattr(_dispatch_state, 'idle_fns', None)
+  if idle_fns is None:
+    idle_fns = _dispatch_state.idle_fns = collections.deque()
+  idle_fns.append(fn)
+
+
+def _drain():
+  """Makes all queued calls on this thread, followed by any idle functions
+  queued by call_when_idle.
+  """
+  queue = _dispatch_state.queue
+  _dispatch_state.draining = True
+  exc_info = None
+  try:
+    while True:
+      while queue:
+        (fns, args, kwargs) = queue.popleft()
+        for fn in fns:
+          try:
+            fn(*args, **kwargs)
+          except Exception:
+            if not exc_info:
+              exc_info = sys.exc_info()
+      idle_fns = getattr(_dispatch_state, 'idle_fns', None)
+      if not idle_fns:
+        break
+      try:
+        idle_fns.popleft()()
+      except Exception:
+        if not exc_info:
+          exc_info = sys.exc_info()
+  finally:
+    _dispatch_state.draining = False
+  if exc_info:
+    raise exc_info[0], exc_info[1], exc_info[2]
+
+
 class Deferred(object):
   """A simple deferred object, designed for single-threaded tracking of futures.
   """
 
-  def __init__(self):
-    """Initializes a deferred."""
-    self._callbacks = []
-    self._errbacks = []
+  __slots__ = ['_callbacks', '_errbacks', '_is_done', '_failed', '_exception',
+               '_args', '_kwargs', '_canceller', '_cancelled']
+
+  def __init__(self, canceller=None):
+    """Initializes a deferred.
+
+    Args:
+      canceller: A function called with the deferred when it is cancelled, used
+          to abort the work it represents. The canceller may complete the
+          deferred itself, otherwise it is errbacked after the call.
+    """
+    self._callbacks = None
+    self._errbacks = None
     self._is_done = False
     self._failed = False
     self._exception = None
     self._args = None
     self._kwargs = None
+    self._canceller = canceller
+    self._cancelled = False
 
   def is_done(self):
     """Whether the deferred has completed (either succeeded or failed).
@@ -25,6 +123,14 @@ class Deferred(object):
     """
     return self._is_done
 
+  def is_cancelled(self):
+    """Whether the deferred was cancelled before it completed.
+
+    Returns:
+      True if the deferred has been cancelled.
+    """
+    return self._cancelled
+
   def add_callback_fn(self, fn):
     """Adds a function that will be called when the deferred completes
     successfully.
@@ -41,9 +147,12 @@ class Deferred(object):
     """
     if self._is_done:
       if not self._failed:
-        fn(*self._args, **self._kwargs)
+        _dispatch((fn,), self._args, self._kwargs)
       return
-    self._callbacks.append(fn)
+    if self._callbacks is None:
+      self._callbacks = [fn]
+    else:
+      self._callbacks.append(fn)
 
   def add_errback_fn(self, fn):
     """Adds a function that will be called when the deferred completes with
@@ -61,9 +170,12 @@ class Deferred(object):
     """
     if self._is_done:
       if self._failed:
-        fn(*self._args, **self._kwargs)
+        _dispatch((fn,), self._args, self._kwargs)
       return
-    self._errbacks.append(fn)
+    if self._errbacks is None:
+      self._errbacks = [fn]
+    else:
+      self._errbacks.append(fn)
 
   def callback(self, *args, **kwargs):
     """Completes a deferred successfully and calls any registered callbacks."""
@@ -72,10 +184,11 @@ class Deferred(object):
     self._args = args
     self._kwargs = kwargs
     callbacks = self._callbacks
-    self._callbacks = []
-    self._errbacks = []
-    for fn in callbacks:
-      fn(*args, **kwargs)
+    self._callbacks = None
+    self._errbacks = None
+    self._canceller = None
+    if callbacks:
+      _dispatch(callbacks, args, kwargs)
 
   def errback(self, *args, **kwargs):
     """Completes a deferred with an error and calls any registered errbacks."""
@@ -87,10 +200,35 @@ class Deferred(object):
     self._args = args
     self._kwargs = kwargs
     errbacks = self._errbacks
-    self._callbacks = []
-    self._errbacks = []
-    for fn in errbacks:
-      fn(*args, **kwargs)
+    self._callbacks = None
+    self._errbacks = None
+    self._canceller = None
+    if errbacks:
+      _dispatch(errbacks, args, kwargs)
+
+  def cancel(self):
+    """Cancels a deferred that has not yet completed.
+    The canceller, if any, is called to abort the pending work. If it does not
+    complete the deferred then the deferred is errbacked with a
+    DeferredCancelledError exception.
+
+    Returns:
+      True if the deferred was cancelled, False if it had already completed.
+    """
+    if self._is_done:
+      return False
+    self._cancelled = True
+    canceller = self._canceller
+    self._canceller = None
+    if canceller:
+      canceller(self)
+    if not self._is_done:
+      self.errback(exception=DeferredCancelledError())
+    return True
+
+
+def _get_result_tuple(deferred):
+  return (not deferred._failed, deferred._args, deferred._kwargs)
 
 
 def gather_deferreds(deferreds, errback_if_any_fail=False):
@@ -100,6 +238,7 @@ def gather_deferreds(deferreds, errback_if_any_fail=False):
   tuple for each deferred.
 
   The deferred returned by this will only ever issue callbacks, never errbacks.
+  Cancelling it cancels all input deferreds that have not yet completed.
 
   Args:
     deferreds: A list of deferreds to wait on.
@@ -114,41 +253,58 @@ def gather_deferreds(deferreds, errback_if_any_fail=False):
   """
   if isinstance(deferreds, Deferred):
     deferreds = [deferreds]
-  gather_deferred = Deferred()
   deferred_len = len(deferreds)
   if not deferred_len:
+    gather_deferred = Deferred()
     gather_deferred.callback([])
     return gather_deferred
 
+  def _cancel(gather_deferred):
+    for deferred in deferreds:
+      deferred.cancel()
+  gather_deferred = Deferred(canceller=_cancel)
+
+  def _finish(result_tuples, any_failed):
+    if any_failed and errback_if_any_fail:
+      gather_deferred.errback(result_tuples)
+    else:
+      gather_deferred.callback(result_tuples)
+
+  # Fast path for the common case of waiting on a single deferred
+  if deferred_len == 1:
+    deferred = deferreds[0]
+    if deferred._is_done:
+      _finish([_get_result_tuple(deferred)], deferred._failed)
+    else:
+      deferred.add_callback_fn(
+          lambda *args, **kwargs: _finish([(True, args, kwargs)], False))
+      deferred.add_errback_fn(
+          lambda *args, **kwargs: _finish([(False, args, kwargs)], True))
+    return gather_deferred
+
+  # Results are read from the deferreds once they have all completed, so only
+  # a counter is needed while waiting
   pending = [deferred_len]
-  result_tuples = deferred_len * [None]
-  def _complete():
+  def _complete(*args, **kwargs):
     pending[0] -= 1
     if not pending[0]:
-      if not errback_if_any_fail:
-        gather_deferred.callback(result_tuples)
-      else:
-        any_failed = False
-        for result in result_tuples:
-          if not result[0]:
-            any_failed = True
-            break
-        if any_failed:
-          gather_deferred.errback(result_tuples)
-        else:
-          gather_deferred.callback(result_tuples)
-
-  def _makecapture(n, deferred):
-    def _callback(*args, **kwargs):
-      result_tuples[n] = (True, args, kwargs)
-      _complete()
-    def _errback(*args, **kwargs):
-      result_tuples[n] = (False, args, kwargs)
-      _complete()
-    deferred.add_callback_fn(_callback)
-    deferred.add_errback_fn(_errback)
-
-  for n in xrange(deferred_len):
-    _makecapture(n, deferreds[n])
+      result_tuples = [_get_result_tuple(deferred) for deferred in deferreds]
+      any_failed = False
+      for result in result_tuples:
+        if not result[0]:
+          any_failed = True
+          break
+      _finish(result_tuples, any_failed)
+
+  for deferred in deferreds:
+    if deferred._is_done:
+      pending[0] -= 1
+    else:
+      deferred.add_callback_fn(_complete)
+      deferred.add_errback_fn(_complete)
+  if not pending[0]:
+    # Everything had already completed - bump the count back to finish
+    pending[0] = 1
+    _complete()
 
   return gather_deferred
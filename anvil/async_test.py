@@ -8,13 +8,15 @@
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import sys
 import unittest2
 
-from anvil.async import Deferred, gather_deferreds
+from anvil.async import Deferred, DeferredCancelledError, gather_deferreds
+from anvil.async import call_when_idle
 from anvil.test import AsyncTestCase
 
 
-class DeferredTest(unittest2.TestCase):
+class DeferredTest(AsyncTestCase):
   """Behavioral tests of the Deferred type."""
 
   def testMultiCall(self):
@@ -204,14 +206,125 @@ class DeferredTest(unittest2.TestCase):
     self.assertEqual(cbs[1]['args'][0], 'a')
     cbs[:] = []
 
+  def testCallbackException(self):
+    calls = []
+    def _raise(*args, **kwargs):
+      raise ValueError()
+    d = Deferred()
+    d.add_callback_fn(_raise)
+    d.add_callback_fn(lambda: calls.append('a'))
+    with self.assertRaises(ValueError):
+      d.callback()
+    self.assertEqual(calls, ['a'])
+    d = Deferred()
+    d.add_callback_fn(lambda: calls.append('b'))
+    d.callback()
+    self.assertEqual(calls, ['a', 'b'])
+
+  def testCancel(self):
+    d = Deferred()
+    self.assertFalse(d.is_cancelled())
+    self.assertTrue(d.cancel())
+    self.assertTrue(d.is_done())
+    self.assertTrue(d.is_cancelled())
+    self.assertErrbackWithError(d, DeferredCancelledError)
+    self.assertFalse(d.cancel())
+
+    d = Deferred()
+    d.callback('a')
+    self.assertFalse(d.cancel())
+    self.assertFalse(d.is_cancelled())
+    self.assertCallbackEqual(d, 'a')
+
+    cancelled = []
+    d = Deferred(canceller=lambda d: cancelled.append(d))
+    d.cancel()
+    self.assertEqual(cancelled, [d])
+    self.assertErrbackWithError(d, DeferredCancelledError)
+
+    d = Deferred(canceller=lambda d: d.callback('c'))
+    d.cancel()
+    self.assertTrue(d.is_cancelled())
+    self.assertCallbackEqual(d, 'c')
+
+    da = Deferred()
+    db = Deferred()
+    db.callback('b')
+    d = gather_deferreds([da, db], errback_if_any_fail=True)
+    d.cancel()
+    self.assertTrue(da.is_cancelled())
+    self.assertFalse(db.is_cancelled())
+    self.assertErrback(d)
+
+  def testCallWhenIdle(self):
+    calls = []
+    call_when_idle(lambda: calls.append('idle'))
+    self.assertEqual(calls, ['idle'])
+    calls[:] = []
+
+    # Functions added from a callback wait until all queued callbacks are made
+    da = Deferred()
+    db = Deferred()
+    def _a():
+      calls.append('a')
+      call_when_idle(lambda: calls.append('idle'))
+      db.callback()
+    da.add_callback_fn(_a)
+    db.add_callback_fn(lambda: calls.append('b'))
+    da.add_callback_fn(lambda: calls.append('c'))
+    da.callback()
+    self.assertEqual(calls, ['a', 'c', 'b', 'idle'])
+    calls[:] = []
+
+    # Callbacks caused by idle functions are made before the next one
+    dc = Deferred()
+    dc.add_callback_fn(lambda: calls.append('c'))
+    dd = Deferred()
+    dd.add_callback_fn(lambda: (call_when_idle(dc.callback),
+                                call_when_idle(lambda: calls.append('idle'))))
+    dd.callback()
+    self.assertEqual(calls, ['c', 'idle'])
+
 
 class GatherTest(AsyncTestCase):
   """Behavioral tests for the async gather function."""
 
+  def testDeepChain(self):
+    # Each deferred completes the next from its callback - this must not
+    # recurse once per deferred
+    ds = [Deferred() for n in xrange(sys.getrecursionlimit() * 2)]
+    for n in xrange(len(ds) - 1):
+      gather_deferreds([ds[n]]).add_callback_fn(
+          lambda results, next_d=ds[n + 1]: next_d.callback(len(results)))
+    ds[0].callback()
+    self.assertCallbackEqual(ds[-1], 1)
+
   def testGather(self):
     d = gather_deferreds([])
     self.assertCallbackEqual(d, [])
 
+    da = Deferred()
+    d = gather_deferreds(da)
+    da.callback('a')
+    self.assertCallbackEqual(d, [(True, ('a',), {})])
+    d = gather_deferreds([da])
+    self.assertCallbackEqual(d, [(True, ('a',), {})])
+    df = Deferred()
+    d = gather_deferreds([df], errback_if_any_fail=True)
+    df.errback('f')
+    self.assertErrbackEqual(d, [(False, ('f',), {})])
+    d = gather_deferreds([df])
+    self.assertCallbackEqual(d, [(False, ('f',), {})])
+
+    da = Deferred()
+    db = Deferred()
+    da.callback('a')
+    db.callback('b')
+    d = gather_deferreds([da, db])
+    self.assertCallbackEqual(d, [
+        (True, ('a',), {}),
+        (True, ('b',), {})])
+
     da = Deferred()
     db = Deferred()
     dc = Deferred()
@@ -0,0 +1,116 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Build server client.
+
+When a build server ('anvil buildd') is running in the current path, the anvil
+command line forwards commands to it over a Unix socket and prints the output it
+streams back, instead of loading the project itself.
+
+This module is imported on every invocation and so must stay lightweight.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import marshal
+import os
+import socket
+import struct
+import sys
+
+
+# Server socket, relative to the project root
+SOCKET_FILE = os.path.join('.build-cache', 'buildd.sock')
+
+
+class BuildServerError(Exception):
+  """An error communicating with a build server.
+  """
+  pass
+
+
+def send_message(sock, message):
+  """Sends a message over a socket.
+
+  Args:
+    sock: Connected socket.
+    message: A marshallable tuple, with the message type as the first item.
+  """
+  data = marshal.dumps(message)
+  sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _recv_exactly(sock, length):
+  chunks = []
+  while length:
+    chunk = sock.recv(min(length, 1024 * 1024))
+    if not chunk:
+      raise BuildServerError('Connection closed')
+    chunks.append(chunk)
+    length -= len(chunk)
+  return ''.join(chunks)
+
+
+def recv_message(sock):
+  """Receives a message sent with send_message.
+
+  Args:
+    sock: Connected socket.
+
+  Returns:
+    The message tuple.
+
+  Raises:
+    BuildServerError: The connection was closed or the message was invalid.
+  """
+  (length,) = struct.unpack('!I', _recv_exactly(sock, 4))
+  try:
+    message = marshal.loads(_recv_exactly(sock, length))
+  except (EOFError, ValueError, TypeError) as e:
+    raise BuildServerError('Invalid message: %s' % (e))
+  if not isinstance(message, tuple) or not len(message):
+    raise BuildServerError('Invalid message')
+  return message
+
+
+def run_in_server(args, cwd, output=None):
+  """Runs a command in the build server for the given path, if there is one.
+
+  Args:
+    args: Command line arguments, starting with the command name.
+    cwd: Current working directory.
+    output: File object to write command output to, or None for stdout.
+
+  Returns:
+    The return code of the command, or None if there is no build server or it
+    does not support the command and it must be run locally.
+  """
+  if not hasattr(socket, 'AF_UNIX'):
+    return None
+  socket_path = os.path.join(cwd, SOCKET_FILE)
+  if not os.path.exists(socket_path):
+    return None
+  output = output or sys.stdout
+
+  sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    try:
+      sock.connect(socket_path)
+    except socket.error:
+      # Stale socket from a server that did not exit cleanly
+      return None
+    send_message(sock, ('run', list(args), cwd))
+    while True:
+      message = recv_message(sock)
+      if message[0] == 'out':
+        output.write(message[1])
+        output.flush()
+      elif message[0] == 'exit':
+        return message[1]
+      elif message[0] == 'unsupported':
+        return None
+  except (BuildServerError, socket.error) as e:
+    output.write('Lost connection to build server: %s\n' % (e))
+    return 1
+  finally:
+    sock.close()
@@ -0,0 +1,327 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Persistent build server.
+
+A build server ('anvil buildd') keeps the state of a project warm between
+builds: the rule namespace, loaded modules, rule graph, rule and glob caches and
+the task executor with its worker processes. The anvil command line forwards
+supported commands to the server (see build_client) instead of paying for all of
+that on every invocation.
+
+Modules are reloaded when their files change. Only builds run from the project
+root the server was started in are forwarded.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import socket
+import SocketServer
+import sys
+import threading
+import traceback
+
+from anvil import build_client
+from anvil import cache
+from anvil import graph
+from anvil import journal
+from anvil.build_client import BuildServerError
+from anvil.module import ModuleLoader
+from anvil.project import FileModuleResolver, Project
+
+
+class _SessionModuleResolver(FileModuleResolver):
+  """A module resolver that tracks the mtimes of loaded module files and of the
+  directories their globs looked in.
+  """
+
+  def __init__(self, root_path, *args, **kwargs):
+    super(_SessionModuleResolver, self).__init__(root_path, *args, **kwargs)
+    # mtimes of module files when they were loaded, by path
+    self.module_mtimes = {}
+    # mtimes of the directories globbed by modules when they were loaded, as
+    # dictionaries by directory path, by module path
+    self.module_glob_dir_mtimes = {}
+
+  def load_module(self, full_path, rule_namespace):
+    # Record the mtime first so that changes made while loading are noticed
+    self.module_mtimes[full_path] = cache._get_mtime(full_path)
+    glob_dir_mtimes = {}
+    self.module_glob_dir_mtimes[full_path] = glob_dir_mtimes
+    try:
+      module_loader = ModuleLoader(
+          full_path, rule_namespace=rule_namespace,
+          glob_cache=_RecordingGlobCache(self.glob_cache, glob_dir_mtimes))
+      module_loader.load()
+      return module_loader.execute()
+    except:
+      del self.module_mtimes[full_path]
+      del self.module_glob_dir_mtimes[full_path]
+      raise
+
+  def get_changed_modules(self):
+    """
+    Returns:
+      A list of the paths of loaded modules whose files, or the results of
+      whose globs, may have changed since they were loaded.
+    """
+    changed_paths = []
+    for (module_path, mtime) in self.module_mtimes.items():
+      if cache._get_mtime(module_path) != mtime:
+        changed_paths.append(module_path)
+        continue
+      # Adding or removing files changes the mtime of their directory
+      glob_dir_mtimes = self.module_glob_dir_mtimes.get(module_path, {})
+      for (dir_path, dir_mtime) in glob_dir_mtimes.iteritems():
+        if cache._get_mtime(dir_path or os.curdir) != dir_mtime:
+          changed_paths.append(module_path)
+          break
+    return changed_paths
+
+  def forget_module(self, module_path):
+    """Drops the recorded mtimes of a module.
+
+    Args:
+      module_path: Full module path.
+    """
+    self.module_mtimes.pop(module_path, None)
+    self.module_glob_dir_mtimes.pop(module_path, None)
+
+
+class _RecordingGlobCache(object):
+  """Passes globs to a GlobCache, recording the mtimes of the directories
+  their results depend on.
+  """
+
+  def __init__(self, glob_cache, dir_mtimes):
+    """Initializes a recording glob cache.
+
+    Args:
+      glob_cache: GlobCache to glob with, or None to not cache results.
+      dir_mtimes: Dictionary to add directory mtimes to, by path.
+    """
+    self.glob_cache = glob_cache or cache.GlobCache()
+    self.dir_mtimes = dir_mtimes
+
+  def glob(self, glob_path):
+    return self.glob_cache.glob(glob_path, dir_mtimes_out=self.dir_mtimes)
+
+
+class BuildSession(object):
+  """Build state kept between builds of a project.
+  commandutil.run_build uses a session, when one is given, instead of creating
+  a new project, caches and task executor for each build.
+  """
+
+  def __init__(self, root_path):
+    """Initializes a build session.
+
+    Args:
+      root_path: Project root path.
+    """
+    self.root_path = os.path.normpath(root_path)
+    self.glob_cache = cache.GlobCache(self.root_path)
+    # Loaded from the project's cache and saved after each build (see
+    # commandutil.run_build), so builds run without the server reuse its results
+    self.rule_cache = cache.FileRuleCache(self.root_path)
+    self._module_resolver = _SessionModuleResolver(
+        self.root_path, glob_cache=self.glob_cache)
+    self.project = Project(module_resolver=self._module_resolver)
+    self.rule_graph = None
+    self._task_executor = None
+    self._task_executor_key = None
+
+  def refresh(self):
+    """Prepares the session for a build.
+    Modules whose files have changed since they were loaded, or that globbed
+    directories that have changed since, are unloaded so that they are loaded
+    again when next referenced, and the cached state of their rules is
+    dropped.
+
+    Returns:
+      True if any modules were unloaded.
+    """
+    changed_paths = self._module_resolver.get_changed_modules()
+    self.unload_modules(changed_paths)
+    if not self.rule_graph:
+      self.rule_graph = graph.RuleGraph(self.project)
+    return len(changed_paths) > 0
+
+  def unload_modules(self, module_paths):
+    """Unloads modules so that they are loaded again when next referenced.
+    The cached state of their rules is dropped.
+
+    Args:
+      module_paths: A list of full module paths.
+    """
+    for module_path in module_paths:
+      self._module_resolver.forget_module(module_path)
+      module = self.project.modules.pop(module_path, None)
+      if module:
+        for rule in module.rule_list():
+          self.rule_cache.invalidate_rule(rule.path)
+        # The graph may reference rules from unloaded modules
+        self.rule_graph = None
+
+  def get_task_executor(self, key, create_fn):
+    """Gets a task executor, reusing the one from the previous build if it was
+    created with the same settings.
+
+    Args:
+      key: A value identifying the executor settings.
+      create_fn: A function that creates a new executor with the settings.
+
+    Returns:
+      A TaskExecutor. It is owned by the session and must not be closed.
+    """
+    if self._task_executor and self._task_executor_key == key:
+      return self._task_executor
+    self._close_task_executor()
+    self._task_executor = create_fn()
+    self._task_executor_key = key
+    return self._task_executor
+
+  def _close_task_executor(self):
+    if self._task_executor:
+      self._task_executor.close()
+      self._task_executor = None
+      self._task_executor_key = None
+
+  def close(self):
+    """Releases all resources held by the session.
+    """
+    self._close_task_executor()
+    self.glob_cache.save()
+
+
+class _OutputWriter(object):
+  """A file-like object that sends everything written to it to a client.
+  Output is dropped if the client disconnects. Writes may come from any thread,
+  such as the result thread of a task executor.
+  """
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.closed = False
+    self._lock = threading.Lock()
+
+  def write(self, data):
+    if self.closed or not data:
+      return
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+    with self._lock:
+      try:
+        build_client.send_message(self.sock, ('out', data))
+      except socket.error:
+        self.closed = True
+
+  def writelines(self, lines):
+    for line in lines:
+      self.write(line)
+
+  def flush(self):
+    pass
+
+  def isatty(self):
+    return False
+
+
+class _BuildRequestHandler(SocketServer.BaseRequestHandler):
+  def handle(self):
+    try:
+      message = build_client.recv_message(self.request)
+    except (BuildServerError, socket.error):
+      return
+    if message[0] != 'run' or len(message) != 3:
+      return
+    (_, args, cwd) = message
+    server = self.server
+    command = server.commands.get(args[0], None) if args else None
+    if (not command or not command.supports_build_server or
+        os.path.normpath(cwd) != server.session.root_path):
+      build_client.send_message(self.request, ('unsupported',))
+      return
+
+    writer = _OutputWriter(self.request)
+    (old_stdout, old_stderr) = (sys.stdout, sys.stderr)
+    sys.stdout = sys.stderr = writer
+    try:
+      parser = command.create_argument_parser()
+      parsed_args = parser.parse_args(args[1:])
+      parsed_args.build_session = server.session
+      return_code = command.execute(parsed_args, cwd)
+    except SystemExit as e:
+      # argparse exits on bad arguments or --help
+      return_code = e.code if isinstance(e.code, int) else 1
+    except Exception:
+      traceback.print_exc()
+      return_code = 1
+    finally:
+      (sys.stdout, sys.stderr) = (old_stdout, old_stderr)
+    if not writer.closed:
+      try:
+        build_client.send_message(self.request, ('exit', return_code or 0))
+      except socket.error:
+        pass
+
+
+class BuildServer(SocketServer.UnixStreamServer):
+  """Build server for a project.
+  Requests are handled one at a time, so concurrent clients wait for the
+  builds before them to finish.
+  """
+
+  def __init__(self, root_path, commands, watch=True):
+    """Initializes a build server.
+
+    Args:
+      root_path: Project root path.
+      commands: A dictionary of ManageCommands by name, as returned from
+          discover_commands.
+      watch: True to journal file system changes, if no watchd is already
+          running for the project, so that builds only check changed files.
+
+    Raises:
+      BuildServerError: A server is already running for the project.
+    """
+    self.session = BuildSession(root_path)
+    self.commands = commands
+    self.socket_path = os.path.join(self.session.root_path,
+                                    build_client.SOCKET_FILE)
+    if os.path.exists(self.socket_path):
+      sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      try:
+        sock.connect(self.socket_path)
+        raise BuildServerError('A build server is already running')
+      except socket.error:
+        # Left behind by a server that did not exit cleanly
+        os.remove(self.socket_path)
+      finally:
+        sock.close()
+    try:
+      os.makedirs(os.path.dirname(self.socket_path))
+    except OSError:
+      pass
+    SocketServer.UnixStreamServer.__init__(self, self.socket_path,
+                                           _BuildRequestHandler)
+
+    self.watch_server = None
+    if watch and not journal.query_journal(self.session.root_path):
+      self.watch_server = journal.WatchServer(self.session.root_path)
+      thread = threading.Thread(target=self.watch_server.serve_forever)
+      thread.daemon = True
+      thread.start()
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    try:
+      os.remove(self.socket_path)
+    except OSError:
+      pass
+    if self.watch_server:
+      self.watch_server.shutdown()
+      self.watch_server.server_close()
+      self.watch_server = None
+    self.session.close()
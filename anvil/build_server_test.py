@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the build_server module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import cStringIO
+import os
+import threading
+import time
+import unittest2
+
+from anvil.build_client import BuildServerError, run_in_server
+from anvil.build_server import BuildServer, BuildSession
+from anvil.commands.build_command import BuildCommand
+from anvil.manage import ManageCommand
+from anvil.test import FixtureTestCase
+
+
+class BuildSessionTest(FixtureTestCase):
+  """Behavioral tests of the BuildSession type."""
+  fixture = 'simple'
+
+  def testRefresh(self):
+    session = BuildSession(self.root_path)
+    self.assertFalse(session.refresh())
+    rule_graph = session.rule_graph
+    self.assertIsNotNone(rule_graph)
+
+    rule = session.project.resolve_rule(':a')
+    self.assertIsNotNone(rule)
+    self.assertEqual(len(session.project.modules), 1)
+    self.assertFalse(session.refresh())
+    self.assertIs(session.rule_graph, rule_graph)
+
+    # Rules of changed modules are dropped from the cache
+    a_path = os.path.join(self.root_path, 'a.txt')
+    session.rule_cache.compute_delta(rule.path, 'src', [a_path])
+    self.assertEqual(len(session.rule_cache.data), 1)
+    build_path = os.path.join(self.root_path, 'BUILD')
+    new_time = time.time() + 10
+    os.utime(build_path, (new_time, new_time))
+    self.assertTrue(session.refresh())
+    self.assertEqual(len(session.project.modules), 0)
+    self.assertEqual(len(session.rule_cache.data), 0)
+    self.assertIsNot(session.rule_graph, rule_graph)
+    self.assertIsNot(session.project.resolve_rule(':a'), rule)
+
+    # Modules are reloaded when files are added to directories they globbed
+    rule = session.project.resolve_rule(':local_txt')
+    new_path = os.path.join(self.root_path, 'new.txt')
+    self.assertNotIn(new_path, rule.srcs)
+    self.assertFalse(session.refresh())
+    with open(new_path, 'w') as f:
+      f.write('new')
+    new_time = time.time() + 20
+    os.utime(self.root_path, (new_time, new_time))
+    self.assertTrue(session.refresh())
+    rule = session.project.resolve_rule(':local_txt')
+    self.assertIn(new_path, rule.srcs)
+    session.close()
+
+  def testTaskExecutor(self):
+    session = BuildSession(self.root_path)
+    executors = []
+    def _create():
+      executors.append(_Executor())
+      return executors[-1]
+    executor = session.get_task_executor(1, _create)
+    self.assertIs(session.get_task_executor(1, _create), executor)
+    self.assertEqual(len(executors), 1)
+    session.get_task_executor(2, _create)
+    self.assertEqual(len(executors), 2)
+    self.assertTrue(executors[0].closed)
+    session.close()
+    self.assertTrue(executors[1].closed)
+
+
+class _Executor(object):
+  def __init__(self):
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+class BuildServerTest(FixtureTestCase):
+  """Behavioral tests of the BuildServer type."""
+  fixture = 'simple'
+
+  def _start_server(self):
+    commands = {
+        'build': BuildCommand(),
+        'other': ManageCommand('other'),
+        }
+    server = BuildServer(self.root_path, commands, watch=False)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    def _stop_server():
+      server.shutdown()
+      server.server_close()
+    self.addCleanup(_stop_server)
+    return server
+
+  def testBuild(self):
+    self.assertIsNone(run_in_server(['build', ':a'], self.root_path))
+    server = self._start_server()
+
+    for n in xrange(2):
+      output = cStringIO.StringIO()
+      return_code = run_in_server(['build', '-j', '1', ':a'], self.root_path,
+                                  output=output)
+      self.assertEqual(return_code, 0)
+      self.assertIn('result True, 1 outputs', output.getvalue())
+      self.assertEqual(len(server.session.project.modules), 1)
+
+    output = cStringIO.StringIO()
+    return_code = run_in_server(['build', '-j', '1', ':x'], self.root_path,
+                                output=output)
+    self.assertNotEqual(return_code, 0)
+
+    # Bad arguments are reported by argparse
+    output = cStringIO.StringIO()
+    return_code = run_in_server(['build', '--bad', ':a'], self.root_path,
+                                output=output)
+    self.assertEqual(return_code, 2)
+    self.assertIn('--bad', output.getvalue())
+
+  def testUnsupported(self):
+    self._start_server()
+    self.assertIsNone(run_in_server(['other'], self.root_path))
+    self.assertIsNone(run_in_server(['missing'], self.root_path))
+    self.assertIsNone(run_in_server(['build', ':a'],
+                                    os.path.join(self.root_path, 'dir')))
+    with self.assertRaises(BuildServerError):
+      BuildServer(self.root_path, {}, watch=False)
+
+
+if __name__ == '__main__':
+  unittest2.main()
@@ -8,7 +8,24 @@ __author__ = 'benvanik@google.com (Ben Vanik)'
 
 import base64
 import cPickle
+import glob2
+import hashlib
+import io
 import os
+import stat
+import tempfile
+import time
+
+from anvil import journal
+
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError: # pragma: no cover
+    # Entry types will be queried with stat
+    scandir = None
 
 
 class RuleCache(object):
@@ -18,7 +35,9 @@ class RuleCache(object):
   def __init__(self, *args, **kwargs):
     """Initializes the rule cache.
     """
-    pass
+    # StatCache used to query files, set by the BuildContext using the cache
+    # If None the file system is queried directly
+    self.stat_cache = None
 
   def save(self):
     """Saves the cache off to disk.
@@ -42,6 +61,42 @@ class RuleCache(object):
     file_delta.changed_files.extend(src_paths)
     return file_delta
 
+  def get_fingerprint(self, rule_path, name):
+    """Gets a fingerprint stored with set_fingerprint.
+    Rules can use fingerprints to skip steps whose inputs are only a subset of
+    their sources, or are not files at all.
+
+    Args:
+      rule_path: Full path to the rule.
+      name: Name of the fingerprint, unique within the rule.
+
+    Returns:
+      The fingerprint, or None if none is stored.
+    """
+    return None
+
+  def set_fingerprint(self, rule_path, name, fingerprint):
+    """Stores a fingerprint of the inputs of a step of a rule.
+    Fingerprints are dropped with the rest of the rule's information by
+    invalidate_rule.
+
+    Args:
+      rule_path: Full path to the rule.
+      name: Name of the fingerprint, unique within the rule.
+      fingerprint: A string identifying the inputs of the step.
+    """
+    pass
+
+  def invalidate_rule(self, rule_path):
+    """Drops all cached information about a rule.
+    Used when a rule fails or its definition changes, so that it is not
+    considered cached the next time it is built.
+
+    Args:
+      rule_path: Full path to the rule.
+    """
+    pass
+
 
 class FileRuleCache(RuleCache):
   """File-based rule cache.
@@ -57,6 +112,8 @@ class FileRuleCache(RuleCache):
     self.cache_path = os.path.join(cache_path, '.anvil-cache')
     self.data = dict()
     self._dirty = False
+    # Paths changed since the previous build as last recorded, if known
+    self.journal_changes = None
 
     if os.path.exists(self.cache_path):
       with open(self.cache_path, 'rb') as file_obj:
@@ -73,23 +130,148 @@ class FileRuleCache(RuleCache):
     with open(self.cache_path, 'wb') as file_obj:
       cPickle.dump(self.data, file_obj, 2)
 
+  def update_from_journal(self, root_path):
+    """Queries the watchd journal of a project for changes since the last call.
+    This should be called at the start of each build. If the journal is
+    available then compute_delta will only stat files the journal reports as
+    changed, otherwise all files are checked.
+
+    Args:
+      root_path: Project root path.
+
+    Returns:
+      True if the changes since the last build are known.
+    """
+    try:
+      result = journal.query_journal(root_path,
+                                     since_clock=self._get_journal_clock())
+    except journal.JournalError as e:
+      print 'Unable to query watchd: %s' % (e)
+      result = None
+    if not result:
+      self.data.pop(_JOURNAL_KEY, None)
+      self.record_changes(None)
+      return False
+    (journal_id, clock, paths) = result
+    old_state = self.data.get(_JOURNAL_KEY, None)
+    if paths is not None and old_state and old_state[0] == journal_id:
+      self.record_changes(paths)
+    else:
+      self.record_changes(None)
+    self.data[_JOURNAL_KEY] = (journal_id, clock)
+    return self.journal_changes is not None
+
+  def record_changes(self, changed_paths):
+    """Records the paths changed since the previous build.
+    This should be called at the start of each build. Changes are kept until
+    every rule has been checked against them, so rules not run in some builds
+    still see the changes made before them.
+
+    Args:
+      changed_paths: A list of absolute paths changed since the previous build,
+          or None if not known. If not known every file is checked by
+          compute_delta.
+    """
+    (serial, change_log) = self.data.get(_CHANGES_KEY, (0, []))
+    serial += 1
+    if changed_paths is None:
+      # Nothing before this build can be trusted
+      change_log = []
+      self.journal_changes = None
+    else:
+      self.journal_changes = set(changed_paths)
+      change_log = change_log[-(_MAX_CHANGE_LOG_LENGTH - 1):] + [
+          (serial, self.journal_changes)]
+    self.data[_CHANGES_KEY] = (serial, change_log)
+    self._dirty = True
+
+  def _get_changes_since(self, since_serial):
+    """Gets the paths changed after the build with the given serial.
+
+    Args:
+      since_serial: Serial of the build, from the _SERIALS_KEY data.
+
+    Returns:
+      A set of changed paths, or None if not known.
+    """
+    if self.journal_changes is None:
+      # Changes since the previous build are not known
+      return None
+    (serial, change_log) = self.data.get(_CHANGES_KEY, (0, []))
+    if since_serial is None or since_serial > serial:
+      return None
+    changes = [paths for (change_serial, paths) in change_log
+               if change_serial > since_serial]
+    if len(changes) != serial - since_serial:
+      # Older changes have been dropped, or were never known
+      return None
+    return set().union(*changes)
+
+  def invalidate_rule(self, rule_path):
+    prefix = '%s->' % (rule_path)
+    key_serials = self.data.get(_SERIALS_KEY, {})
+    for key in self.data.keys():
+      if key.startswith('.'):
+        continue
+      if base64.b64decode(key).startswith(prefix):
+        del self.data[key]
+        key_serials.pop(key, None)
+        self._dirty = True
+
+  def get_fingerprint(self, rule_path, name):
+    key = base64.b64encode('%s->fingerprint:%s' % (rule_path, name))
+    return self.data.get(key, None)
+
+  def set_fingerprint(self, rule_path, name, fingerprint):
+    key = base64.b64encode('%s->fingerprint:%s' % (rule_path, name))
+    if self.data.get(key, None) != fingerprint:
+      self.data[key] = fingerprint
+      self._dirty = True
+
+  def _get_journal_clock(self):
+    state = self.data.get(_JOURNAL_KEY, None)
+    return state[1] if state else 0
+
   def compute_delta(self, rule_path, mode, src_paths):
     file_delta = FileDelta()
     file_delta.all_files.extend(src_paths)
 
+    key = base64.b64encode('%s->%s' % (rule_path, mode))
+    old_data = self.data.get(key, None)
+
+    # Each key is checked against the changes since it was last scanned, which
+    # may span several builds if its rule was not run in all of them
+    changed_paths = None
+    if _CHANGES_KEY in self.data:
+      key_serials = self.data.setdefault(_SERIALS_KEY, {})
+      changed_paths = self._get_changes_since(key_serials.get(key, None))
+      (serial, _) = self.data[_CHANGES_KEY]
+      if key_serials.get(key, None) != serial:
+        key_serials[key] = serial
+        self._dirty = True
+
+    # If the journal says none of the files changed since they were last
+    # scanned (and the set of files is the same) there is no need to stat them
+    if (changed_paths is not None and old_data is not None and
+        len(old_data) == len(src_paths)):
+      for src_path in src_paths:
+        if (not src_path in old_data or
+            _is_path_changed(src_path, changed_paths)):
+          break
+      else:
+        return file_delta
+
     # Scan all files - we need this to compare regardless of whether we have
     # data from the cache
     # TODO(benvanik): make this parallel
+    stat_cache = self.stat_cache or StatCache()
     new_data = dict()
     for src_path in src_paths:
-      if os.path.exists(src_path):
-        file_time = os.path.getmtime(src_path)
-        file_size = os.path.getsize(src_path)
-        new_data[src_path] = '%s-%s' % (file_time, file_size)
+      st = stat_cache.stat(src_path)
+      if st:
+        new_data[src_path] = '%s-%s' % (st.st_mtime, st.st_size)
 
     # Always swap for new data
-    key = base64.b64encode('%s->%s' % (rule_path, mode))
-    old_data = self.data.get(key, None)
     self.data[key] = new_data
 
     # No previous data
@@ -122,6 +304,41 @@ class FileRuleCache(RuleCache):
     return file_delta
 
 
+# Key of the (journal_id, clock) watchd state in the cache data
+# Rule keys are base64 encoded and cannot collide with keys starting with '.'
+_JOURNAL_KEY = '.journal'
+# Key of the (serial, change log) of recorded changes, where the change log is
+# a list of (serial, changed paths) for the most recent builds
+_CHANGES_KEY = '.changes'
+# Key of the serial of the build each rule key was last scanned in, by rule key
+_SERIALS_KEY = '.serials'
+# Number of builds to keep changes for - rules not run for longer check all of
+# their files
+_MAX_CHANGE_LOG_LENGTH = 64
+
+
+def _is_path_changed(path, changed_paths):
+  """Checks whether a path or any of its parent directories has changed.
+  Directories are checked as a moved or deleted directory is reported without
+  its contents.
+
+  Args:
+    path: Absolute path.
+    changed_paths: A set of changed absolute paths.
+
+  Returns:
+    True if the path may have changed.
+  """
+  path = os.path.normpath(path)
+  while True:
+    if path in changed_paths:
+      return True
+    parent_path = os.path.dirname(path)
+    if parent_path == path:
+      return False
+    path = parent_path
+
+
 class FileDelta(object):
   """File delta information.
   """
@@ -141,3 +358,487 @@ class FileDelta(object):
       True if any changes occurred.
     """
     return len(self.changed_files)
+
+
+class StatCache(object):
+  """File system metadata cache.
+  Memoizes stat and listdir results (including missing paths) for the lifetime
+  of a build, so that paths used by many rules are only queried once. Anything
+  that modifies the file system during the build must invalidate the affected
+  paths.
+
+  This is not safe to use across builds, as the file system may change between
+  them.
+  """
+
+  def __init__(self):
+    """Initializes a stat cache.
+    """
+    # os.stat results by path, None if the path does not exist
+    self._stats = {}
+    # os.listdir results by path
+    self._listings = {}
+    # (name, is_dir) lists by path
+    self._entries = {}
+
+  def stat(self, path):
+    """Stats a path.
+
+    Args:
+      path: Path to stat.
+
+    Returns:
+      The os.stat result, or None if the path does not exist.
+    """
+    try:
+      return self._stats[path]
+    except KeyError:
+      pass
+    try:
+      st = os.stat(path)
+    except OSError:
+      st = None
+    self._stats[path] = st
+    return st
+
+  def exists(self, path):
+    """
+    Returns:
+      True if the path exists.
+    """
+    return self.stat(path) is not None
+
+  def isdir(self, path):
+    """
+    Returns:
+      True if the path exists and is a directory.
+    """
+    st = self.stat(path)
+    return st is not None and stat.S_ISDIR(st.st_mode)
+
+  def isfile(self, path):
+    """
+    Returns:
+      True if the path exists and is a regular file.
+    """
+    st = self.stat(path)
+    return st is not None and stat.S_ISREG(st.st_mode)
+
+  def listdir(self, path):
+    """Lists the contents of a directory.
+
+    Args:
+      path: Directory path.
+
+    Returns:
+      A new list of the names of the entries in the directory.
+
+    Raises:
+      OSError: The path is not a directory or could not be read.
+    """
+    names = self._listings.get(path, None)
+    if names is None:
+      names = os.listdir(path)
+      self._listings[path] = names
+    return names[:]
+
+  def list_entries(self, path):
+    """Lists the contents of a directory along with their types.
+    When scandir is available the types come from the directory listing itself,
+    instead of requiring a stat of each entry.
+
+    Args:
+      path: Directory path.
+
+    Returns:
+      A list of (name, is_dir) tuples. The list is shared and must not be
+      modified.
+
+    Raises:
+      OSError: The path is not a directory or could not be read.
+    """
+    entries = self._entries.get(path, None)
+    if entries is None:
+      if scandir:
+        entries = [(entry.name, entry.is_dir()) for entry in scandir(path)]
+      else:
+        entries = [(name, self.isdir(os.path.join(path, name)))
+                   for name in self.listdir(path)]
+      self._entries[path] = entries
+    return entries
+
+  def walk_files(self, path):
+    """Recursively iterates over all files under a directory.
+    Files in a directory are returned before those in its subdirectories.
+
+    Args:
+      path: Directory path.
+
+    Returns:
+      An iterator of file paths.
+
+    Raises:
+      OSError: A directory could not be read.
+    """
+    pending_paths = [path]
+    while pending_paths:
+      dir_path = pending_paths.pop()
+      child_dir_paths = []
+      for (name, is_dir) in self.list_entries(dir_path):
+        child_path = os.path.join(dir_path, name)
+        if is_dir:
+          child_dir_paths.append(child_path)
+        else:
+          yield child_path
+      pending_paths.extend(reversed(child_dir_paths))
+
+  def makedirs(self, path):
+    """Creates a directory and any missing parents, if it does not exist.
+
+    Args:
+      path: Directory path.
+    """
+    if self.isdir(path):
+      return
+    os.makedirs(path)
+    self.invalidate(path)
+
+  def invalidate(self, path):
+    """Invalidates any cached information about a path.
+    This must be called after a path is created, modified or removed. As any of
+    its parent directories may have been created or removed along with it, their
+    listings and any results saying they do not exist are invalidated as well.
+
+    Args:
+      path: Path that changed.
+    """
+    self._stats.pop(path, None)
+    self._listings.pop(path, None)
+    self._entries.pop(path, None)
+    parent_path = os.path.dirname(path)
+    while parent_path != path:
+      if parent_path in self._stats and self._stats[parent_path] is None:
+        del self._stats[parent_path]
+      self._listings.pop(parent_path, None)
+      self._entries.pop(parent_path, None)
+      path = parent_path
+      parent_path = os.path.dirname(path)
+
+  def invalidate_all(self, paths):
+    """Invalidates any cached information about a list of paths.
+
+    Args:
+      paths: Paths that changed.
+    """
+    for path in paths:
+      self.invalidate(path)
+
+
+class _PersistentCache(object):
+  """Base type of caches stored as pickled dictionaries under .build-cache.
+  Caches are saved atomically but not merged, so when several processes save
+  the same cache concurrently only the last one's results are kept.
+  """
+
+  def __init__(self, cache_path=None, name='cache', *args, **kwargs):
+    """Initializes the cache.
+
+    Args:
+      cache_path: Path to store the cache file in. If omitted results are only
+          cached in memory.
+      name: Name of the cache file. Each kind of result must use its own name,
+          which should be changed whenever the format of its values does.
+    """
+    self.cache_path = None
+    if cache_path:
+      self.cache_path = os.path.join(cache_path, '.build-cache', name)
+    self.data = dict()
+    self._dirty = False
+
+    if self.cache_path and os.path.exists(self.cache_path):
+      try:
+        with open(self.cache_path, 'rb') as file_obj:
+          self.data.update(cPickle.load(file_obj))
+      except Exception:
+        # Corrupt or from another version - everything will be recomputed
+        self.data.clear()
+
+  def save(self):
+    """Saves the cache off to disk, if it has a cache path.
+    """
+    if not self._dirty or not self.cache_path:
+      return
+    self._dirty = False
+    cache_dir = os.path.dirname(self.cache_path)
+    try:
+      os.makedirs(cache_dir)
+    except:
+      pass
+    (fd, temp_path) = tempfile.mkstemp(dir=cache_dir)
+    try:
+      with os.fdopen(fd, 'wb') as file_obj:
+        cPickle.dump(self.data, file_obj, 2)
+      os.rename(temp_path, self.cache_path)
+    except:
+      os.remove(temp_path)
+      raise
+
+
+class GlobCache(_PersistentCache):
+  """Glob result cache.
+  Recursive globs over large trees are expensive, so results are stored along
+  with the modification times of every directory visited while producing them.
+  As adding, removing or renaming an entry changes the mtime of its directory
+  a result can be reused for as long as none of those directories change.
+  """
+
+  # Directories modified within this many seconds of a glob may change again
+  # without their mtime changing, so results depending on them are not cached
+  MTIME_RESOLUTION = 2
+
+  def __init__(self, cache_path=None, *args, **kwargs):
+    """Initializes the glob cache.
+
+    Args:
+      cache_path: Path to store the cache file in. If omitted results are only
+          cached in memory.
+    """
+    # Data holds (directory mtimes, result paths) by glob path
+    super(GlobCache, self).__init__(cache_path, 'globs', *args, **kwargs)
+
+  def glob(self, glob_path, dir_mtimes_out=None):
+    """Globs the given expression.
+    This uses the glob2 module and supports recursive globs ('**/*').
+
+    Args:
+      glob_path: Full glob expression.
+      dir_mtimes_out: A dictionary to add the mtimes of the directories the
+          result depends on to, by path, if any. The result may change if any
+          of them are modified.
+
+    Returns:
+      A new list of all paths that match the glob expression.
+    """
+    entry = self.data.get(glob_path, None)
+    if entry:
+      (dir_mtimes, result_paths) = entry
+      if not self._any_changed(dir_mtimes):
+        if dir_mtimes_out is not None:
+          dir_mtimes_out.update(dir_mtimes)
+        return result_paths[:]
+
+    scan_time = time.time()
+    globber = _RecordingGlobber()
+    result_paths = list(globber.iglob(glob_path))
+    dir_mtimes = globber.dir_mtimes
+    if dir_mtimes_out is not None:
+      dir_mtimes_out.update(dir_mtimes)
+    if self._any_recent(dir_mtimes, scan_time):
+      if self.data.pop(glob_path, None):
+        self._dirty = True
+    else:
+      self.data[glob_path] = (dir_mtimes, result_paths[:])
+      self._dirty = True
+    return result_paths
+
+  def _any_changed(self, dir_mtimes):
+    """
+    Returns:
+      True if any of the directories changed since their mtime was recorded.
+    """
+    for (dir_path, mtime) in dir_mtimes.iteritems():
+      if _get_mtime(dir_path) != mtime:
+        return True
+    return False
+
+  def _any_recent(self, dir_mtimes, scan_time):
+    """
+    Returns:
+      True if any of the directories was modified too close to the scan time
+      for its mtime to be trusted.
+    """
+    for mtime in dir_mtimes.itervalues():
+      if mtime is not None and mtime >= scan_time - self.MTIME_RESOLUTION:
+        return True
+    return False
+
+
+def _get_mtime(path):
+  """
+  Returns:
+    The mtime of the given path, or None if it does not exist.
+  """
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+
+class _RecordingGlobber(glob2.Globber):
+  """A globber that records the mtime of every directory it looks in.
+  """
+
+  def __init__(self):
+    # mtimes by directory path, None if the directory did not exist
+    self.dir_mtimes = {}
+
+  def _record(self, dir_path):
+    if not dir_path in self.dir_mtimes:
+      self.dir_mtimes[dir_path] = _get_mtime(dir_path or os.curdir)
+
+  def listdir(self, path):
+    self._record(path)
+    return os.listdir(path)
+
+  def isdir(self, path):
+    self._record(os.path.dirname(path))
+    return os.path.isdir(path)
+
+  def islink(self, path):
+    self._record(os.path.dirname(path))
+    return os.path.islink(path)
+
+  def exists(self, path):
+    self._record(os.path.dirname(path))
+    return os.path.lexists(path)
+
+
+class FileScanCache(_PersistentCache):
+  """Cache of values computed from the contents of files.
+  Scanning large numbers of source files (for dependencies, imports, etc) on
+  every build is expensive, so the value computed for each file is stored with
+  its stat and digest. A file is only read again if its stat changed, and only
+  rescanned if its contents did.
+  """
+
+  # Files modified within this many seconds of a scan may change again without
+  # their stat changing, so their digest is always checked
+  MTIME_RESOLUTION = 2
+
+  def __init__(self, cache_path=None, name='scans', *args, **kwargs):
+    """Initializes the file scan cache.
+
+    Args:
+      cache_path: Path to store the cache file in. If omitted results are only
+          cached in memory.
+      name: Name of the cache file. Each kind of scan must use its own name,
+          which should be changed whenever the format of its values does.
+    """
+    # Data holds (mtime, size, digest, value) by file path
+    super(FileScanCache, self).__init__(cache_path, name, *args, **kwargs)
+
+  def get_entries(self, paths):
+    """Gets the cached entries of the given files.
+    Used to hand part of a cache to a task running in another process.
+
+    Args:
+      paths: A list of file paths.
+
+    Returns:
+      A dictionary of opaque entries by file path, for the files that have one.
+    """
+    data = self.data
+    return dict((path, data[path]) for path in paths if path in data)
+
+  def merge(self, entries):
+    """Merges entries returned from get_entries into the cache.
+
+    Args:
+      entries: A dictionary of entries by file path.
+    """
+    for (path, entry) in entries.iteritems():
+      if self.data.get(path, None) != entry:
+        self.data[path] = entry
+        self._dirty = True
+
+  def scan(self, path, scan_fn):
+    """Gets the value computed from the contents of a file.
+
+    Args:
+      path: File path.
+      scan_fn: A function that takes the file contents as a str and returns a
+          picklable value. It must always return the same value for the same
+          contents.
+
+    Returns:
+      The value returned by scan_fn for the current contents of the file.
+
+    Raises:
+      IOError: The file could not be read.
+      OSError: The file could not be read.
+    """
+    st = os.stat(path)
+    entry = self.data.get(path, None)
+    if (entry and entry[0] == st.st_mtime and entry[1] == st.st_size and
+        st.st_mtime < time.time() - self.MTIME_RESOLUTION):
+      return entry[3]
+
+    with io.open(path, 'rb') as f:
+      contents = f.read()
+    digest = hashlib.md5(contents).digest()
+    if entry and entry[2] == digest:
+      value = entry[3]
+    else:
+      value = scan_fn(contents)
+    new_entry = (st.st_mtime, st.st_size, digest, value)
+    if new_entry != entry:
+      self.data[path] = new_entry
+      self._dirty = True
+    return value
+
+
+class ResultCache(_PersistentCache):
+  """Cache of the results of work done on files, such as linting.
+  Each file has a single result, stored with the key it was computed for. Keys
+  should cover everything the result depends on (such as a digest of the file
+  contents and the tool settings), as results are only returned for the same
+  key.
+  """
+
+  def __init__(self, cache_path=None, name='results', *args, **kwargs):
+    """Initializes the result cache.
+
+    Args:
+      cache_path: Path to store the cache file in. If omitted results are only
+          cached in memory.
+      name: Name of the cache file. Each kind of result must use its own name.
+    """
+    # Data holds (key, result) by file path
+    super(ResultCache, self).__init__(cache_path, name, *args, **kwargs)
+
+  def get(self, path, key):
+    """Gets the result of a file.
+
+    Args:
+      path: File path.
+      key: Key the result must have been computed for.
+
+    Returns:
+      The result, or None if there is none for the key.
+    """
+    entry = self.data.get(path, None)
+    if entry and entry[0] == key:
+      return entry[1]
+    return None
+
+  def set(self, path, key, result):
+    """Sets the result of a file, replacing any previous result.
+
+    Args:
+      path: File path.
+      key: Key the result was computed for.
+      result: A picklable result.
+    """
+    entry = (key, result)
+    if self.data.get(path, None) != entry:
+      self.data[path] = entry
+      self._dirty = True
+
+  def discard(self, path):
+    """Removes the result of a file, if any.
+
+    Args:
+      path: File path.
+    """
+    if self.data.pop(path, None):
+      self._dirty = True
@@ -9,6 +9,7 @@ __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
 import os
+import time
 import unittest2
 
 import anvil.cache
@@ -24,5 +25,372 @@ class CacheTest(FixtureTestCase):
     rule_cache.save()
 
 
+class FileRuleCacheTest(FixtureTestCase):
+  """Behavioral tests for the FileRuleCache type."""
+  fixture = 'simple'
+
+  def testJournal(self):
+    rule_cache = anvil.cache.FileRuleCache(self.root_path)
+    # No watchd running
+    self.assertFalse(rule_cache.update_from_journal(self.root_path))
+    self.assertIsNone(rule_cache.journal_changes)
+
+    a_path = os.path.join(self.root_path, 'a.txt')
+    b_path = os.path.join(self.root_path, 'b.txt')
+    rule_cache.compute_delta(':a', 'src', [a_path, b_path])
+    with open(a_path, 'a') as f:
+      f.write('more')
+
+    # Files not reported by the journal are assumed unchanged
+    rule_cache.record_changes([os.path.join(self.root_path, 'c.txt')])
+    delta = rule_cache.compute_delta(':a', 'src', [a_path, b_path])
+    self.assertEqual(delta.all_files, [a_path, b_path])
+    self.assertFalse(delta.any_changes())
+    rule_cache.record_changes([a_path])
+    delta = rule_cache.compute_delta(':a', 'src', [a_path, b_path])
+    self.assertEqual(delta.modified_files, [a_path])
+
+    # Changes to parent directories apply to everything under them
+    with open(b_path, 'a') as f:
+      f.write('more')
+    rule_cache.record_changes([self.root_path])
+    delta = rule_cache.compute_delta(':a', 'src', [a_path, b_path])
+    self.assertEqual(delta.modified_files, [b_path])
+
+    # Different file sets are always checked
+    rule_cache.record_changes([])
+    delta = rule_cache.compute_delta(':a', 'src', [a_path])
+    self.assertEqual(delta.removed_files, [b_path])
+
+    # Unknown changes check everything
+    with open(a_path, 'a') as f:
+      f.write('more')
+    rule_cache.record_changes(None)
+    delta = rule_cache.compute_delta(':a', 'src', [a_path])
+    self.assertEqual(delta.modified_files, [a_path])
+
+  def testJournalPartialBuilds(self):
+    rule_cache = anvil.cache.FileRuleCache(self.root_path)
+    a_path = os.path.join(self.root_path, 'a.txt')
+    b_path = os.path.join(self.root_path, 'b.txt')
+    def _build(rule_paths, changed_paths):
+      rule_cache.record_changes(changed_paths)
+      src_paths = {':a': [a_path], ':b': [b_path]}
+      return dict((rule_path, rule_cache.compute_delta(
+                       rule_path, 'src', src_paths[rule_path]).changed_files)
+                  for rule_path in rule_paths)
+    self.assertEqual(_build([':a', ':b'], None),
+                     {':a': [a_path], ':b': [b_path]})
+
+    # Changes made before builds that did not run a rule are still seen by it
+    with open(a_path, 'a') as f:
+      f.write('more')
+    self.assertEqual(_build([':b'], [a_path]), {':b': []})
+    self.assertEqual(_build([':b'], []), {':b': []})
+    self.assertEqual(_build([':a'], []), {':a': [a_path]})
+    self.assertEqual(_build([':a', ':b'], []), {':a': [], ':b': []})
+
+    # ...and persist across cache instances
+    with open(a_path, 'a') as f:
+      f.write('more')
+    _build([':b'], [a_path])
+    rule_cache.save()
+    rule_cache = anvil.cache.FileRuleCache(self.root_path)
+    self.assertEqual(_build([':a'], []), {':a': [a_path]})
+
+    # Rules not run for longer than the change log check all of their files
+    with open(b_path, 'a') as f:
+      f.write('more')
+    for n in xrange(anvil.cache._MAX_CHANGE_LOG_LENGTH + 1):
+      _build([':a'], [b_path] if n == 0 else [])
+    self.assertEqual(_build([':b'], []), {':b': [b_path]})
+
+  def testInvalidateRule(self):
+    rule_cache = anvil.cache.FileRuleCache(self.root_path)
+    a_path = os.path.join(self.root_path, 'a.txt')
+    rule_cache.compute_delta(':a', 'src', [a_path])
+    rule_cache.compute_delta(':a', 'out', [a_path])
+    rule_cache.compute_delta(':ab', 'src', [a_path])
+    rule_cache.invalidate_rule(':a')
+    self.assertTrue(rule_cache.compute_delta(':a', 'src', [a_path]).any_changes())
+    self.assertFalse(
+        rule_cache.compute_delta(':ab', 'src', [a_path]).any_changes())
+
+  def testFingerprints(self):
+    rule_cache = anvil.cache.FileRuleCache(self.root_path)
+    self.assertIsNone(rule_cache.get_fingerprint(':a', 'x'))
+    rule_cache.set_fingerprint(':a', 'x', 'abc')
+    rule_cache.set_fingerprint(':ab', 'x', 'def')
+    self.assertEqual(rule_cache.get_fingerprint(':a', 'x'), 'abc')
+    self.assertIsNone(rule_cache.get_fingerprint(':a', 'y'))
+    rule_cache.invalidate_rule(':a')
+    self.assertIsNone(rule_cache.get_fingerprint(':a', 'x'))
+    self.assertEqual(rule_cache.get_fingerprint(':ab', 'x'), 'def')
+
+
+class StatCacheTest(FixtureTestCase):
+  """Behavioral tests for the StatCache type."""
+  fixture = 'simple'
+
+  def testStat(self):
+    stat_cache = anvil.cache.StatCache()
+    a_path = os.path.join(self.root_path, 'a.txt')
+    dir_path = os.path.join(self.root_path, 'dir')
+    missing_path = os.path.join(self.root_path, 'x.txt')
+    self.assertEqual(stat_cache.stat(a_path).st_size, os.path.getsize(a_path))
+    self.assertTrue(stat_cache.exists(a_path))
+    self.assertTrue(stat_cache.isfile(a_path))
+    self.assertFalse(stat_cache.isdir(a_path))
+    self.assertTrue(stat_cache.isdir(dir_path))
+    self.assertFalse(stat_cache.isfile(dir_path))
+    self.assertIsNone(stat_cache.stat(missing_path))
+    self.assertFalse(stat_cache.exists(missing_path))
+
+    # Results are cached until invalidated
+    with open(missing_path, 'w') as f:
+      f.write('x')
+    self.assertFalse(stat_cache.exists(missing_path))
+    stat_cache.invalidate(missing_path)
+    self.assertTrue(stat_cache.exists(missing_path))
+
+  def testListdir(self):
+    stat_cache = anvil.cache.StatCache()
+    names = stat_cache.listdir(self.root_path)
+    self.assertEqual(sorted(names), sorted(os.listdir(self.root_path)))
+    # Callers may modify the result
+    names.append('y.txt')
+    self.assertNotIn('y.txt', stat_cache.listdir(self.root_path))
+    with self.assertRaises(OSError):
+      stat_cache.listdir(os.path.join(self.root_path, 'a.txt'))
+
+    new_path = os.path.join(self.root_path, 'x.txt')
+    with open(new_path, 'w') as f:
+      f.write('x')
+    self.assertNotIn('x.txt', stat_cache.listdir(self.root_path))
+    stat_cache.invalidate_all([new_path])
+    self.assertIn('x.txt', stat_cache.listdir(self.root_path))
+
+  def testListEntries(self):
+    stat_cache = anvil.cache.StatCache()
+    entries = stat_cache.list_entries(os.path.join(self.root_path, 'dir'))
+    self.assertEqual(entries, [('dir_2', True)])
+    dir_2_path = os.path.join(self.root_path, 'dir', 'dir_2')
+    self.assertEqual(
+        sorted(stat_cache.list_entries(dir_2_path)),
+        [('BUILD', False), ('d.txt', False), ('e.txt', False),
+         ('f.not-txt', False)])
+
+    os.mkdir(os.path.join(dir_2_path, 'x'))
+    self.assertNotIn(('x', True), stat_cache.list_entries(dir_2_path))
+    stat_cache.invalidate(os.path.join(dir_2_path, 'x'))
+    self.assertIn(('x', True), stat_cache.list_entries(dir_2_path))
+
+  def testWalkFiles(self):
+    stat_cache = anvil.cache.StatCache()
+    dir_path = os.path.join(self.root_path, 'dir')
+    dir_2_path = os.path.join(dir_path, 'dir_2')
+    self.assertEqual(
+        sorted(stat_cache.walk_files(dir_path)),
+        [os.path.join(dir_2_path, name)
+         for name in ['BUILD', 'd.txt', 'e.txt', 'f.not-txt']])
+    # Files in a directory come before those in its subdirectories
+    file_paths = list(stat_cache.walk_files(self.root_path))
+    self.assertEqual(len(file_paths), 12)
+    self.assertEqual(
+        [os.path.dirname(file_path) for file_path in file_paths[-4:]],
+        [dir_2_path] * 4)
+
+  def testMakedirs(self):
+    stat_cache = anvil.cache.StatCache()
+    self.assertNotIn('x', stat_cache.listdir(self.root_path))
+    base_path = os.path.join(self.root_path, 'x')
+    path = os.path.join(base_path, 'y', 'z')
+    self.assertFalse(stat_cache.isdir(base_path))
+    self.assertFalse(stat_cache.isdir(path))
+    stat_cache.makedirs(path)
+    self.assertTrue(os.path.isdir(path))
+    self.assertTrue(stat_cache.isdir(path))
+    self.assertTrue(stat_cache.isdir(base_path))
+    self.assertIn('x', stat_cache.listdir(self.root_path))
+    stat_cache.makedirs(path)
+
+  def testInvalidateAncestors(self):
+    stat_cache = anvil.cache.StatCache()
+    a_path = os.path.join(self.root_path, 'a')
+    b_path = os.path.join(a_path, 'b')
+    c_path = os.path.join(b_path, 'c.js')
+    os.mkdir(a_path)
+    self.assertEqual(stat_cache.listdir(a_path), [])
+    self.assertEqual(stat_cache.list_entries(a_path), [])
+    self.assertFalse(stat_cache.exists(b_path))
+    self.assertFalse(stat_cache.exists(c_path))
+
+    # Creating a file invalidates every directory above it
+    os.mkdir(b_path)
+    with open(c_path, 'w') as f:
+      f.write('c')
+    stat_cache.invalidate(c_path)
+    self.assertTrue(stat_cache.isfile(c_path))
+    self.assertTrue(stat_cache.isdir(b_path))
+    self.assertEqual(stat_cache.listdir(a_path), ['b'])
+    self.assertEqual(stat_cache.list_entries(a_path), [('b', True)])
+    self.assertEqual(stat_cache.listdir(b_path), ['c.js'])
+
+  def testComputeDelta(self):
+    rule_cache = anvil.cache.FileRuleCache(self.root_path)
+    rule_cache.stat_cache = anvil.cache.StatCache()
+    a_path = os.path.join(self.root_path, 'a.txt')
+    b_path = os.path.join(self.root_path, 'b.txt')
+    delta = rule_cache.compute_delta(':a', 'src', [a_path, b_path])
+    self.assertEqual(delta.changed_files, [a_path, b_path])
+    delta = rule_cache.compute_delta(':a', 'src', [a_path, b_path])
+    self.assertFalse(delta.any_changes())
+
+    with open(a_path, 'a') as f:
+      f.write('more')
+    rule_cache.stat_cache.invalidate(a_path)
+    delta = rule_cache.compute_delta(':a', 'src', [a_path])
+    self.assertEqual(delta.modified_files, [a_path])
+    self.assertEqual(delta.removed_files, [b_path])
+
+
+class GlobCacheTest(FixtureTestCase):
+  """Behavioral tests for the GlobCache type."""
+  fixture = 'simple'
+
+  def _age_dirs(self):
+    # Freshly copied fixtures are too recent to be cached
+    old_time = time.time() - 60
+    for (dir_path, dir_names, file_names) in os.walk(self.root_path):
+      os.utime(dir_path, (old_time, old_time))
+
+  def testGlob(self):
+    self._age_dirs()
+    glob_cache = anvil.cache.GlobCache(self.root_path)
+    glob_path = os.path.join(self.root_path, '**', '*.txt')
+    result = glob_cache.glob(glob_path)
+    self.assertEqual(len(result), 5)
+    self.assertIn(glob_path, glob_cache.data)
+    # Results are copies
+    result.append('x')
+    self.assertEqual(len(glob_cache.glob(glob_path)), 5)
+
+    glob_cache.save()
+    # Saved by renaming a temporary file into place
+    self.assertEqual(os.listdir(os.path.join(self.root_path, '.build-cache')),
+                     ['globs'])
+    glob_cache = anvil.cache.GlobCache(self.root_path)
+    self.assertEqual(sorted(glob_cache.glob(glob_path)), sorted(result[:-1]))
+
+    # Adding a file to a visited directory invalidates the result
+    with open(os.path.join(self.root_path, 'dir', 'x.txt'), 'w') as f:
+      f.write('x')
+    self.assertEqual(len(glob_cache.glob(glob_path)), 6)
+    # ...and is too recent to cache
+    self.assertNotIn(glob_path, glob_cache.data)
+
+  def testCachedResult(self):
+    self._age_dirs()
+    glob_cache = anvil.cache.GlobCache()
+    glob_path = os.path.join(self.root_path, '*.txt')
+    self.assertEqual(len(glob_cache.glob(glob_path)), 3)
+    # Pretend the scan found something else to show the result is reused
+    (dir_mtimes, result_paths) = glob_cache.data[glob_path]
+    glob_cache.data[glob_path] = (dir_mtimes, ['x'])
+    self.assertEqual(glob_cache.glob(glob_path), ['x'])
+
+    glob_path = os.path.join(self.root_path, 'x', '*.txt')
+    self.assertEqual(glob_cache.glob(glob_path), [])
+    os.mkdir(os.path.join(self.root_path, 'x'))
+    with open(os.path.join(self.root_path, 'x', 'a.txt'), 'w') as f:
+      f.write('x')
+    self.assertEqual(len(glob_cache.glob(glob_path)), 1)
+
+
+class FileScanCacheTest(FixtureTestCase):
+  """Behavioral tests for the FileScanCache type."""
+  fixture = 'simple'
+
+  def testScan(self):
+    scans = []
+    def _scan(contents):
+      scans.append(contents)
+      return contents.upper()
+
+    a_path = os.path.join(self.root_path, 'a.txt')
+    with open(a_path, 'w') as f:
+      f.write('a')
+    old_time = time.time() - 60
+    os.utime(a_path, (old_time, old_time))
+    scan_cache = anvil.cache.FileScanCache(self.root_path, 'test')
+    self.assertEqual(scan_cache.scan(a_path, _scan), 'A')
+    self.assertEqual(scan_cache.scan(a_path, _scan), 'A')
+    self.assertEqual(scans, ['a'])
+    scan_cache.save()
+    self.assertTrue(os.path.isfile(
+        os.path.join(self.root_path, '.build-cache', 'test')))
+
+    scan_cache = anvil.cache.FileScanCache(self.root_path, 'test')
+    self.assertEqual(scan_cache.scan(a_path, _scan), 'A')
+    self.assertEqual(scans, ['a'])
+
+    # Touched files are read but not rescanned
+    os.utime(a_path, (old_time + 1, old_time + 1))
+    self.assertEqual(scan_cache.scan(a_path, _scan), 'A')
+    self.assertEqual(scans, ['a'])
+
+    # Recently modified files are always checked, even if the stat matches
+    with open(a_path, 'w') as f:
+      f.write('b')
+    self.assertEqual(scan_cache.scan(a_path, _scan), 'B')
+    with open(a_path, 'w') as f:
+      f.write('c')
+    os.utime(a_path, (scan_cache.data[a_path][0],) * 2)
+    self.assertEqual(scan_cache.scan(a_path, _scan), 'C')
+    self.assertEqual(scans, ['a', 'b', 'c'])
+
+    self.assertRaises(OSError, scan_cache.scan,
+                      os.path.join(self.root_path, 'x.txt'), _scan)
+
+    # Entries can be handed to and merged back from other caches
+    other_cache = anvil.cache.FileScanCache()
+    entries = scan_cache.get_entries([a_path, 'x'])
+    self.assertEqual(entries.keys(), [a_path])
+    other_cache.merge(entries)
+    self.assertEqual(other_cache.scan(a_path, _scan), 'C')
+    self.assertEqual(len(scans), 3)
+
+    # Caches are separated by name
+    scan_cache = anvil.cache.FileScanCache(self.root_path, 'other')
+    self.assertEqual(scan_cache.scan(a_path, _scan), 'C')
+    self.assertEqual(len(scans), 4)
+
+
+class ResultCacheTest(FixtureTestCase):
+  """Behavioral tests for the ResultCache type."""
+  fixture = 'simple'
+
+  def testResults(self):
+    a_path = os.path.join(self.root_path, 'a.txt')
+    result_cache = anvil.cache.ResultCache(self.root_path, 'test')
+    self.assertIsNone(result_cache.get(a_path, 'k1'))
+    result_cache.set(a_path, 'k1', 'r1')
+    self.assertEqual(result_cache.get(a_path, 'k1'), 'r1')
+    self.assertIsNone(result_cache.get(a_path, 'k2'))
+    result_cache.save()
+
+    result_cache = anvil.cache.ResultCache(self.root_path, 'test')
+    self.assertEqual(result_cache.get(a_path, 'k1'), 'r1')
+    result_cache.set(a_path, 'k2', 'r2')
+    self.assertIsNone(result_cache.get(a_path, 'k1'))
+    self.assertEqual(result_cache.get(a_path, 'k2'), 'r2')
+    result_cache.discard(a_path)
+    self.assertIsNone(result_cache.get(a_path, 'k2'))
+    result_cache.save()
+
+    result_cache = anvil.cache.ResultCache(self.root_path, 'test')
+    self.assertEqual(result_cache.data, {})
+
+
 if __name__ == '__main__':
   unittest2.main()
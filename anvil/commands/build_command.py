@@ -26,6 +26,7 @@ class BuildCommand(ManageCommand):
     self.completion_hints.extend([
         '--rebuild',
         ])
+    self.supports_build_server = True
 
   def create_argument_parser(self):
     parser = super(BuildCommand, self).create_argument_parser()
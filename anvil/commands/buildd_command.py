@@ -0,0 +1,63 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Runs a build server for the current path.
+While it is running 'anvil build' commands run from the same path are forwarded
+to it, skipping startup, BUILD file loading and cache loading. BUILD files are
+reloaded only when they change. Set ANVIL_NO_BUILD_SERVER=1 to build without the
+server.
+
+Unless a watchd is already running for the path the server also journals file
+system changes, so that builds only check files that have changed.
+
+Examples:
+# Start the server
+anvil buildd
+# Builds now run in the server
+anvil build :some_rule
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+
+from anvil.build_server import BuildServer
+from anvil.manage import ManageCommand, discover_commands
+import anvil.util
+
+
+class BuilddCommand(ManageCommand):
+  def __init__(self):
+    super(BuilddCommand, self).__init__(
+        name='buildd',
+        help_short='Runs a persistent build server.',
+        help_long=__doc__)
+    self.completion_hints.extend([
+        '--no_watch',
+        ])
+
+  def create_argument_parser(self):
+    parser = super(BuilddCommand, self).create_argument_parser()
+
+    # 'buildd' specific
+    parser.add_argument('--no_watch',
+                        dest='watch',
+                        action='store_false',
+                        default=True,
+                        help=('Do not journal file system changes. Builds '
+                              'check all files for changes.'))
+
+    return parser
+
+  def execute(self, args, cwd):
+    commands = discover_commands(
+        [os.path.join(anvil.util.get_anvil_path(), 'commands')])
+    server = BuildServer(cwd, commands, watch=args.watch)
+    print 'Build server running for %s...' % (cwd)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+    return 0
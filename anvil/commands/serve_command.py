@@ -4,9 +4,12 @@
 This serves the current working directory over HTTP, similar to Python's
 SimpleHTTPServer.
 
-If a daemon port and any rules are defined then changes to the
-specified paths will automatically trigger builds. A WebSocket port is specified
-that clients can connect to and get lists of file change sets.
+If any rules are given they are built and then continuously rebuilt as the
+files they use change. Only the rules using the changed files, and the rules
+depending on them, are rebuilt. A WebSocket port is specified that clients can
+connect to and get lists of file change sets: after each build a JSON message
+of the form {"result": true, "paths": ["some/file.js", ...]} is sent with the
+output paths that changed, relative to the HTTP server root.
 
 Daemon rules should be of the form:
 file_set('some_daemon',
@@ -28,10 +31,17 @@ __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
 import copy
+import json
 import os
 import sys
+import threading
 
+from anvil import journal
+from anvil import serving
+from anvil.build_server import BuildSession
 import anvil.commands.util as commandutil
+from anvil.context import BuildEnvironment
+from anvil.daemon import ContinuousBuilder
 from anvil.manage import ManageCommand
 
 
@@ -42,6 +52,12 @@ class ServeCommand(ManageCommand):
         help_short='Continuously builds and serves targets.',
         help_long=__doc__)
     self._add_common_build_hints()
+    self.completion_hints.extend([
+        '-p', '--http_port',
+        '--daemon_port',
+        '--build_once',
+        '--debounce',
+        ])
 
   def create_argument_parser(self):
     parser = super(ServeCommand, self).create_argument_parser()
@@ -56,26 +72,70 @@ class ServeCommand(ManageCommand):
                         type=int,
                         default=8080,
                         help=('TCP port the HTTP server will listen on.'))
+    parser.add_argument('--daemon_port',
+                        dest='daemon_port',
+                        type=int,
+                        default=8081,
+                        help=('TCP port the WebSocket change server will '
+                              'listen on.'))
+    parser.add_argument('--build_once',
+                        dest='build_once',
+                        action='store_true',
+                        default=False,
+                        help=('Build the targets once instead of rebuilding '
+                              'them as files change.'))
+    parser.add_argument('--debounce',
+                        dest='debounce',
+                        type=int,
+                        default=100,
+                        help=('Milliseconds without file changes to wait for '
+                              'before rebuilding.'))
 
     return parser
 
   def execute(self, args, cwd):
-    # Initial build
+    if args.build_once:
+      # Initial build
+      if len(args.targets):
+        (result, all_target_outputs) = commandutil.run_build(cwd, args)
+        print all_target_outputs
+      self._launch_http_server(args.http_port, cwd)
+      return 0
+
+    builder = None
     if len(args.targets):
-      (result, all_target_outputs) = commandutil.run_build(cwd, args)
-      print all_target_outputs
+      # Builds run on a background thread, reusing the project and the
+      # results of unaffected rules between them
+      session = BuildSession(cwd)
+      task_executor = commandutil.create_task_executor(args, None)
+      builder = ContinuousBuilder(BuildEnvironment(root_path=cwd), session,
+                                  task_executor, args.targets,
+                                  stop_on_error=args.stop_on_error,
+                                  debounce=args.debounce / 1000.0)
 
-    self._launch_http_server(args.http_port, cwd)
+    try:
+      self._launch_http_server(args.http_port, cwd,
+                               builder=builder, daemon_port=args.daemon_port)
+    finally:
+      if builder:
+        task_executor.close()
+        session.close()
 
     return 0
 
-  def _launch_http_server(self, port, root_path):
+  def _launch_http_server(self, port, root_path, builder=None,
+                          daemon_port=None):
     """Launches a simple static twisted HTTP server.
     The server will automatically merge build-* paths in to a unified namespace.
+    Files are resolved through a PathIndex kept up to date by a file system
+    watcher, and support ETags and precompressed .gz siblings.
 
     Args:
       port: TCP port to listen on.
       root_path: Root path of the HTTP server.
+      builder: A ContinuousBuilder to run until the server exits, if any.
+      daemon_port: TCP port the WebSocket change server listens on, if a
+          builder is given.
     """
     # Twisted has a bug where it doesn't properly initialize mimetypes
     # This must be done before importing it
@@ -83,17 +143,77 @@ class ServeCommand(ManageCommand):
     mimetypes.init()
 
     from twisted.internet import reactor
+    from twisted.web import http
     from twisted.web.resource import Resource, NoResource
-    from twisted.web.server import Site
-    from twisted.web.static import File
+    from twisted.web.server import NOT_DONE_YET, Site
+    from twisted.web.static import (File, NoRangeStaticProducer,
+                                    getTypeAndEncoding)
+
+    change_journal = journal.ChangeJournal()
+    watcher = journal.create_watcher(root_path, change_journal)
+    watcher_thread = threading.Thread(target=watcher.run)
+    watcher_thread.daemon = True
+    watcher_thread.start()
+    path_index = serving.PathIndex(root_path, change_journal)
+    content_cache = serving.ContentCache()
+
+    # Serves a single file resolved by the path index
+    class ServedFileResource(Resource):
+      isLeaf = True
+
+      def __init__(self, served_file):
+        Resource.__init__(self)
+        self.served_file = served_file
+
+      def render_GET(self, request):
+        served_file = self.served_file
+        (path, etag) = (served_file.path, served_file.etag)
+        if served_file.gzip_path:
+          request.setHeader('vary', 'Accept-Encoding')
+          if 'gzip' in (request.getHeader('accept-encoding') or ''):
+            (path, etag) = (served_file.gzip_path, served_file.gzip_etag)
+            request.setHeader('content-encoding', 'gzip')
+        (content_type, _) = getTypeAndEncoding(
+            served_file.path, root.contentTypes, root.contentEncodings,
+            root.defaultType)
+        request.setHeader('content-type', content_type)
+        # Always revalidate, as files change between builds
+        request.setHeader('cache-control', 'no-cache')
+        # Only ETags are checked, as modification times are too coarse
+        if request.setETag(etag) == http.CACHED:
+          return ''
+
+        data = content_cache.get(path, etag, (
+            served_file.gzip_size if path == served_file.gzip_path else
+            served_file.size))
+        if data is not None:
+          request.setHeader('content-length', str(len(data)))
+          return data if request.method != 'HEAD' else ''
+        try:
+          f = open(path, 'rb')
+        except IOError:
+          return NoResource().render(request)
+        request.setHeader('content-length', str(os.fstat(f.fileno()).st_size))
+        if request.method == 'HEAD':
+          f.close()
+          return ''
+        NoRangeStaticProducer(request, f).start()
+        return NOT_DONE_YET
+
+      render_HEAD = render_GET
 
     # Special site handler that merges various output and input paths into a
     # single unifed file system
     class MergedSite(Site):
       def getResourceFor(self, request):
-        # Scan well-known search paths first
-        search_paths = ['build-out', 'build-gen',]
-        for search_path in search_paths:
+        served_file = path_index.lookup('/'.join(request.postpath))
+        if served_file:
+          request.prepath.extend(request.postpath)
+          request.postpath = []
+          return ServedFileResource(served_file)
+
+        # Directories and missing files go through the resource tree
+        for search_path in serving.DEFAULT_SEARCH_PATHS:
           resource = self.resource
           prepath = copy.copy(request.prepath)
           postpath = copy.copy(request.postpath)
@@ -112,4 +232,83 @@ class ServeCommand(ManageCommand):
     root = File(root_path)
     factory = MergedSite(root)
     reactor.listenTCP(port, factory)
+
+    reactor.addSystemEventTrigger('after', 'shutdown', watcher.close)
+    reactor.addSystemEventTrigger('before', 'shutdown', watcher.stop)
+
+    if builder:
+      change_factory = self._create_change_factory(daemon_port, root_path)
+      print 'Launching WebSocket change server on port %s...' % (daemon_port)
+      reactor.listenTCP(daemon_port, change_factory)
+      builder.change_callback = (
+          lambda result, paths: reactor.callFromThread(
+              change_factory.send_changes, result, paths))
+      # Builds run on a reactor thread; the reactor waits for the build in
+      # progress to complete when shutting down
+      reactor.addSystemEventTrigger('before', 'shutdown', builder.stop)
+      reactor.callInThread(builder.run, watcher=watcher)
+
     reactor.run()
+
+  def _create_change_factory(self, port, root_path):
+    """Creates a WebSocket server factory that sends the outputs changed by
+    each build to all connected clients.
+
+    Args:
+      port: TCP port the server will listen on.
+      root_path: Root path of the HTTP server.
+
+    Returns:
+      A WebSocketServerFactory with a send_changes(result, paths) method.
+    """
+    try:
+      from autobahn.twisted.websocket import (WebSocketServerFactory,
+                                              WebSocketServerProtocol)
+    except ImportError:
+      # autobahn < 0.8
+      from autobahn.websocket import (WebSocketServerFactory,
+                                      WebSocketServerProtocol)
+
+    class ChangeProtocol(WebSocketServerProtocol):
+      def onOpen(self):
+        self.factory.clients.add(self)
+
+      def onClose(self, wasClean, code, reason):
+        self.factory.clients.discard(self)
+
+    class ChangeFactory(WebSocketServerFactory):
+      protocol = ChangeProtocol
+
+      def __init__(self, url):
+        WebSocketServerFactory.__init__(self, url)
+        self.clients = set()
+
+      def send_changes(self, result, paths):
+        # Change sets are sent in a single message per build
+        message = json.dumps({
+            'result': bool(result),
+            'paths': [get_served_path(root_path, path) for path in paths],
+            })
+        for client in list(self.clients):
+          client.sendMessage(message)
+
+    return ChangeFactory('ws://localhost:%s' % (port))
+
+
+def get_served_path(root_path, path):
+  """Gets the path a file is served at by the serve HTTP server.
+  Outputs are served as if they were in the root path.
+
+  Args:
+    root_path: Root path of the HTTP server.
+    path: Absolute file path.
+
+  Returns:
+    A '/'-separated path relative to the server root.
+  """
+  rel_path = os.path.relpath(path, root_path)
+  for search_path in serving.DEFAULT_SEARCH_PATHS:
+    if rel_path.startswith(search_path + os.sep):
+      rel_path = rel_path[len(search_path) + 1:]
+      break
+  return rel_path.replace(os.sep, '/')
@@ -6,13 +6,16 @@
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import multiprocessing
 import os
 import shutil
 import sys
 
-from anvil.cache import RuleCache, FileRuleCache
+from anvil.cache import GlobCache, RuleCache, FileRuleCache
 from anvil.context import BuildEnvironment, BuildContext
+from anvil.jobserver import Jobserver
 from anvil.project import FileModuleResolver, Project
+from anvil.remote import RemoteTaskExecutor
 from anvil.task import InProcessTaskExecutor, MultiProcessTaskExecutor
 
 
@@ -43,11 +46,41 @@ def clean_output(cwd):
   return not any_failed
 
 
+def create_task_executor(parsed_args, jobserver):
+  """Creates the local task executor requested by the build arguments.
+
+  Args:
+    parsed_args: Argument namespace from an ArgumentParser.
+    jobserver: Jobserver to coordinate parallelism with, if any.
+
+  Returns:
+    A TaskExecutor.
+  """
+  if parsed_args.jobs == 1:
+    return InProcessTaskExecutor()
+  resource_budget = {}
+  if parsed_args.memory_budget:
+    resource_budget['memory'] = parsed_args.memory_budget
+  max_worker_rss = None
+  if parsed_args.max_worker_memory:
+    max_worker_rss = parsed_args.max_worker_memory * 1024 * 1024
+  return MultiProcessTaskExecutor(
+      worker_count=parsed_args.jobs,
+      max_tasks_per_worker=parsed_args.max_tasks_per_worker,
+      max_worker_rss=max_worker_rss,
+      resource_budget=resource_budget,
+      jobserver=jobserver)
+
+
 def run_build(cwd, parsed_args):
   """Runs a build with the given arguments.
   Assumes that add_common_args and add_common_build_args was called on the
   ArgumentParser.
 
+  If the build is being run by a build server parsed_args.build_session is set
+  to its BuildSession, and the project, caches and task executor are reused
+  from previous builds.
+
   Args:
     cwd: Current working directory.
     parsed_args: Argument namespace from an ArgumentParser.
@@ -60,8 +93,21 @@ def run_build(cwd, parsed_args):
 
   build_env = BuildEnvironment(root_path=cwd)
 
-  module_resolver = FileModuleResolver(cwd)
-  project = Project(module_resolver=module_resolver)
+  session = getattr(parsed_args, 'build_session', None)
+  rule_graph = None
+  if session:
+    session.refresh()
+    glob_cache = session.glob_cache
+    project = session.project
+    rule_graph = session.rule_graph
+  else:
+    # Glob results are reused across builds unless forcing a full rebuild
+    if not parsed_args.force:
+      glob_cache = GlobCache(cwd)
+    else:
+      glob_cache = GlobCache()
+    module_resolver = FileModuleResolver(cwd, glob_cache=glob_cache)
+    project = Project(module_resolver=module_resolver)
 
   # -j/--jobs switch to change execution mode
   #task_executor = None
@@ -71,34 +117,82 @@ def run_build(cwd, parsed_args):
     if (sys.platform == 'cygwin' or
         sys.platform == 'win32'):
       parsed_args.jobs = 1
-  if parsed_args.jobs == 1:
-    task_executor = InProcessTaskExecutor()
-  else:
-    task_executor = MultiProcessTaskExecutor(worker_count=parsed_args.jobs)
-
-  # TODO(benvanik): good logging/info - resolve rules in project and print
-  #     info?
-  print 'building %s' % (parsed_args.targets)
 
-  # Setup cache
-  if not parsed_args.force:
-    cache_path = os.getcwd()
-    rule_cache = FileRuleCache(cache_path)
-  else:
-    rule_cache = RuleCache()
-
-  # TODO(benvanik): take additional args from command line
-  all_target_outputs = set([])
-  with BuildContext(build_env, project,
-                    rule_cache=rule_cache,
-                    task_executor=task_executor,
-                    force=parsed_args.force,
-                    stop_on_error=parsed_args.stop_on_error,
-                    raise_on_error=False) as build_ctx:
-    result = build_ctx.execute_sync(parsed_args.targets)
-    if result:
-      for target in parsed_args.targets:
-        (state, target_outputs) = build_ctx.get_rule_results(target)
-        all_target_outputs.update(target_outputs)
+  # Share parallelism with make - either with a jobserver inherited from a
+  # parent make or by serving one to any make run by our tasks
+  # This must be setup before the worker processes are started so that they
+  # inherit the jobserver pipe and MAKEFLAGS
+  jobserver = Jobserver.from_environment()
+  original_makeflags = None
+  if not jobserver and parsed_args.jobserver:
+    jobserver = Jobserver.create(
+        parsed_args.jobs or multiprocessing.cpu_count())
+    original_makeflags = os.environ.get('MAKEFLAGS', '')
+    os.environ['MAKEFLAGS'] = original_makeflags + jobserver.get_makeflags()
+
+  # Everything from here on must be undone even if the build fails
+  task_executor = None
+  close_task_executor = True
+  completed = False
+  try:
+    if session and not jobserver and not parsed_args.remote_workers:
+      # Keep the worker processes warm for the next build
+      executor_key = (parsed_args.jobs, parsed_args.max_tasks_per_worker,
+                      parsed_args.max_worker_memory, parsed_args.memory_budget)
+      task_executor = session.get_task_executor(
+          executor_key, lambda: create_task_executor(parsed_args, None))
+      close_task_executor = False
+    else:
+      task_executor = create_task_executor(parsed_args, jobserver)
+      if parsed_args.remote_workers:
+        # Local execution is only used as a fallback
+        task_executor = RemoteTaskExecutor(
+            worker_addresses=parsed_args.remote_workers.split(','),
+            fallback_executor=task_executor)
+
+    # TODO(benvanik): good logging/info - resolve rules in project and print
+    #     info?
+    print 'building %s' % (parsed_args.targets)
+
+    # Setup cache
+    if parsed_args.force:
+      rule_cache = RuleCache()
+    elif session:
+      rule_cache = session.rule_cache
+    else:
+      cache_path = os.getcwd()
+      rule_cache = FileRuleCache(cache_path)
+    if not parsed_args.force:
+      # Use the watchd journal, if running, to avoid checking unchanged files
+      rule_cache.update_from_journal(cwd)
+
+    # TODO(benvanik): take additional args from command line
+    all_target_outputs = set([])
+    with BuildContext(build_env, project,
+                      rule_cache=rule_cache,
+                      task_executor=task_executor,
+                      force=parsed_args.force,
+                      stop_on_error=parsed_args.stop_on_error,
+                      raise_on_error=False,
+                      rule_graph=rule_graph) as build_ctx:
+      result = build_ctx.execute_sync(parsed_args.targets)
+      if result:
+        for target in parsed_args.targets:
+          (state, target_outputs) = build_ctx.get_rule_results(target)
+          all_target_outputs.update(target_outputs)
+
+    # Persist the file deltas and the journal clock for the next build
+    rule_cache.save()
+    glob_cache.save()
+    completed = True
+  finally:
+    # Close the executor so that any jobserver tokens are returned - running
+    # tasks are abandoned if the build was interrupted
+    if task_executor and close_task_executor:
+      task_executor.close(graceful=completed)
+    if jobserver:
+      jobserver.close()
+      if original_makeflags is not None:
+        os.environ['MAKEFLAGS'] = original_makeflags
 
   return (result == True, all_target_outputs)
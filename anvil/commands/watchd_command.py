@@ -0,0 +1,75 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Runs a daemon that journals file system changes under the current path.
+While it is running builds ask it which files changed since the previous build
+instead of checking every source file, making no-op builds of large trees much
+faster. inotify is used where available, otherwise the tree is scanned every
+--poll_interval seconds.
+
+Examples:
+# Watch the current project
+anvil watchd
+# Watch by scanning every 5 seconds
+anvil watchd --poll --poll_interval=5
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+from anvil.journal import PollingWatcher, WatchServer
+from anvil.manage import ManageCommand
+
+
+class WatchdCommand(ManageCommand):
+  def __init__(self):
+    super(WatchdCommand, self).__init__(
+        name='watchd',
+        help_short='Runs a file system change journal daemon.',
+        help_long=__doc__)
+    self.completion_hints.extend([
+        '-p', '--port',
+        '--poll',
+        '--poll_interval',
+        ])
+
+  def create_argument_parser(self):
+    parser = super(WatchdCommand, self).create_argument_parser()
+
+    # 'watchd' specific
+    parser.add_argument('-p', '--port',
+                        dest='port',
+                        type=int,
+                        default=0,
+                        help=('TCP port to listen on (localhost only). If '
+                              'omitted any free port is used.'))
+    parser.add_argument('--poll',
+                        dest='poll',
+                        action='store_true',
+                        default=False,
+                        help=('Scan for changes even if inotify is '
+                              'available.'))
+    parser.add_argument('--poll_interval',
+                        dest='poll_interval',
+                        type=float,
+                        default=1,
+                        help=('Seconds between scans when polling.'))
+
+    return parser
+
+  def execute(self, args, cwd):
+    server = WatchServer(cwd, port=args.port,
+                         poll_interval=args.poll_interval,
+                         force_polling=args.poll)
+    if isinstance(server.watcher, PollingWatcher):
+      mode = 'polling every %ss' % (args.poll_interval)
+    else:
+      mode = 'inotify'
+    print 'Watching %s (%s) on port %s...' % (
+        cwd, mode, server.server_address[1])
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+    return 0
@@ -0,0 +1,79 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Runs a worker daemon that executes tasks for remote builds.
+Builds run with --remote_workers send their tasks to workers, which must have
+the same tools installed as the building machine.
+
+The worker protocol is not authenticated and uses pickle, so workers must only
+be reachable from trusted machines.
+
+Examples:
+# Listen on localhost only
+anvil worker
+# Listen on all interfaces with 8 concurrent tasks
+anvil worker --host=0.0.0.0 --port=8090 -j 8
+# Build using two workers
+anvil build --remote_workers=host1:8090,host2:8090 :some_rule
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+from anvil.manage import ManageCommand
+from anvil.remote import DEFAULT_PORT, WorkerServer
+
+
+class WorkerCommand(ManageCommand):
+  def __init__(self):
+    super(WorkerCommand, self).__init__(
+        name='worker',
+        help_short='Runs a remote build worker daemon.',
+        help_long=__doc__)
+    self.completion_hints.extend([
+        '--host',
+        '-p', '--port',
+        '-j', '--jobs',
+        '--work_path',
+        ])
+
+  def create_argument_parser(self):
+    parser = super(WorkerCommand, self).create_argument_parser()
+
+    # 'worker' specific
+    parser.add_argument('--host',
+                        dest='host',
+                        default='127.0.0.1',
+                        help=('Interface the worker will listen on.'))
+    parser.add_argument('-p', '--port',
+                        dest='port',
+                        type=int,
+                        default=DEFAULT_PORT,
+                        help=('TCP port the worker will listen on.'))
+    parser.add_argument('-j', '--jobs',
+                        dest='jobs',
+                        type=int,
+                        default=None,
+                        help=('Specifies the number of tasks to run '
+                              'simultaneously. If omitted then all processors '
+                              'will be used.'))
+    parser.add_argument('--work_path',
+                        dest='work_path',
+                        default=None,
+                        help=('Path used to store files received from clients. '
+                              'If omitted a temporary path is used.'))
+
+    return parser
+
+  def execute(self, args, cwd):
+    server = WorkerServer((args.host, args.port),
+                          work_path=args.work_path,
+                          worker_count=args.jobs)
+    print 'Worker listening on %s:%s with %s slots...' % (
+        args.host, server.server_address[1], server.worker_count)
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+    return 0
@@ -10,10 +10,10 @@ __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
 from collections import deque
-import fnmatch
 import multiprocessing
 import os
 import stat
+import threading
 
 from anvil import async
 from anvil.async import Deferred
@@ -79,7 +79,8 @@ class BuildContext(object):
 
   def __init__(self, build_env, project,
                rule_cache=None, task_executor=None, force=False,
-               stop_on_error=False, raise_on_error=False):
+               stop_on_error=False, raise_on_error=False, rule_graph=None,
+               reuse_rule_contexts=None):
     """Initializes a build context.
 
     Args:
@@ -90,7 +91,13 @@ class BuildContext(object):
           passed.
       force: True to force execution of tasks even if they have not changed.
       stop_on_error: True to stop executing tasks as soon as an error occurs.
+          Any tasks still queued or running are cancelled.
       raise_on_error: True to rethrow exceptions to ease debugging.
+      rule_graph: RuleGraph of the project to reuse from a previous build. If
+          omitted a new one is created.
+      reuse_rule_contexts: A dictionary of succeeded RuleContexts by rule path
+          from a previous build of the project. These rules are not executed
+          again, and their previous outputs are used instead.
     """
     self.build_env = build_env
     self.project = project
@@ -112,20 +119,116 @@ class BuildContext(object):
     self.error_encountered = False
 
     # Build the rule graph
-    self.rule_graph = graph.RuleGraph(self.project)
+    self.rule_graph = rule_graph or graph.RuleGraph(self.project)
 
     # Dictionary that should be used to map rule paths to RuleContexts
     self.rule_contexts = {}
+    self.reuse_rule_contexts = reuse_rule_contexts or {}
+
+    # File system metadata shared by all rules in the build
+    self.stat_cache = cache.StatCache()
+
+    # Values shared by all rules in the build, keyed by names chosen by the
+    # rule types using them
+    self.shared_state = {}
+
+    # Functions to call once all rules that are ready to begin have begun
+    self._batch_callbacks = []
+    # Depth of the rule issuing/completion calls currently in progress
+    self._batch_depth = 0
+    self._batch_flush_pending = False
+    # Guards the batch state - rules are issued on the calling thread but may
+    # complete on the task executor's result thread
+    self._batch_lock = threading.Lock()
+    # Functions to call when the context is exited
+    self._exit_callbacks = []
 
     # Cache used to generate file deltas
     self.cache = rule_cache or cache.RuleCache()
+    self.cache.stat_cache = self.stat_cache
 
   def __enter__(self):
     return self
 
   def __exit__(self, type, value, traceback):
-    if self._close_task_executor:
-      self.task_executor.close()
+    try:
+      for callback in self._exit_callbacks:
+        callback()
+    finally:
+      if self._close_task_executor:
+        self.task_executor.close()
+      else:
+        # The executor may be kept for other builds
+        self.task_executor.release_shared_state()
+
+  def add_exit_callback(self, callback):
+    """Calls a function when the context is exited, after all builds in it have
+    completed.
+    Rules can use this to save state shared by all rules in the build once,
+    instead of each saving its own copy.
+
+    Args:
+      callback: A function taking no arguments.
+    """
+    self._exit_callbacks.append(callback)
+
+  def add_batch_callback(self, callback):
+    """Calls a function once all rules that are ready to begin have begun.
+    Rules can use this to combine work from several rules, such as compiling
+    them with a single process, by queuing it when they begin and issuing it
+    from the callback.
+
+    Args:
+      callback: A function taking no arguments.
+    """
+    with self._batch_lock:
+      self._batch_callbacks.append(callback)
+      if self._batch_depth:
+        return
+    self._schedule_batch_callbacks()
+
+  def _begin_batch(self):
+    """Begins a batch of rules that may begin together.
+    Must be balanced by a call to _end_batch.
+    """
+    with self._batch_lock:
+      self._batch_depth += 1
+
+  def _end_batch(self):
+    """Ends a batch of rules, calling any batch callbacks if it is the
+    outermost one.
+    """
+    with self._batch_lock:
+      self._batch_depth -= 1
+      if self._batch_depth:
+        return
+    self._schedule_batch_callbacks()
+
+  def _schedule_batch_callbacks(self):
+    """Calls any batch callbacks once all pending deferred callbacks have been
+    made.
+    Task completion callbacks are dispatched from a queue, so rules waiting on
+    the one completing only begin after it has returned - the batch callbacks
+    must wait for them as well.
+    """
+    with self._batch_lock:
+      if not self._batch_callbacks or self._batch_flush_pending:
+        return
+      self._batch_flush_pending = True
+    async.call_when_idle(self._flush_batch_callbacks)
+
+  def _flush_batch_callbacks(self):
+    # Callbacks are made without the lock held, as they may add more
+    with self._batch_lock:
+      self._batch_flush_pending = False
+    while True:
+      with self._batch_lock:
+        callbacks = self._batch_callbacks
+        self._batch_callbacks = []
+      if not callbacks:
+        break
+      for callback in callbacks:
+        callback()
 
   def execute_sync(self, target_rule_names):
     """Synchronously executes the given target rules in the context.
@@ -198,8 +301,10 @@ class BuildContext(object):
 
       def _rule_errback(exception=None, *args, **kwargs):
         remaining_rules.remove(rule)
-        if self.stop_on_error:
+        if self.stop_on_error and not self.error_encountered:
           self.error_encountered = True
+          # Abort all other running work - the rules waiting on it will fail
+          self.task_executor.cancel_all()
         # TODO(benvanik): log result/exception/etc?
         if exception: # pragma: no cover
           print exception
@@ -244,6 +349,14 @@ class BuildContext(object):
       issued_rules = []
       all_deferreds = []
       for rule in target_rules:
+        reused_ctx = self.reuse_rule_contexts.get(rule.path, None)
+        if reused_ctx:
+          # Results from a previous build are still valid
+          self.rule_contexts[rule.path] = reused_ctx
+          remaining_rules.remove(rule)
+          all_deferreds.append(reused_ctx.deferred)
+          continue
+
         # Create the RuleContexts here so that failures can cascade and the
         # deferred is accessible by any rules that depend on this one.
         rule_ctx = rule.create_context(self)
@@ -262,9 +375,14 @@ class BuildContext(object):
           all_deferreds.append(_issue_rule(rule, dependent_deferred))
         else:
           all_deferreds.append(_issue_rule(rule))
+        issued_rules.append(rule)
       return async.gather_deferreds(all_deferreds, errback_if_any_fail=True)
 
-    return _chain_rule_execution(rule_sequence)
+    self._begin_batch()
+    try:
+      return _chain_rule_execution(rule_sequence)
+    finally:
+      self._end_batch()
 
   def wait(self, deferreds):
     """Blocks waiting on a list of deferreds until they all complete.
@@ -405,15 +523,27 @@ class RuleContext(object):
       OSError: A source path was not found or could not be accessed.
       RuntimeError: Internal runtime error (rule executed out of order/etc)
     """
-    include_filter_list = []
-    if apply_src_filter and self.rule.src_filter:
-      include_filter_list = self.rule.src_filter.split('|')
-    exclude_filter_list = []
-    if apply_src_filter and self.rule.src_exclude_filter:
-      exclude_filter_list = self.rule.src_exclude_filter.split('|')
+    return list(self._iter_input_files(paths, apply_src_filter))
+
+  def _iter_input_files(self, paths, apply_src_filter):
+    """Lazily resolves the given paths into real file system paths.
+    See _resolve_input_files for more information.
+
+    Args:
+      paths: Paths to resolve.
+      apply_src_filter: True to apply the src_filter of the rule.
+
+    Returns:
+      An iterator of file paths.
+    """
+    include_regex = None
+    exclude_regex = None
+    if apply_src_filter:
+      include_regex = self.rule.src_filter_regex
+      exclude_regex = self.rule.src_exclude_filter_regex
 
+    stat_cache = self.build_context.stat_cache
     base_path = os.path.dirname(self.rule.parent_module.path)
-    input_paths = []
     for src in paths:
       # Grab all items from the source
       src_items = None
@@ -430,26 +560,29 @@ class RuleContext(object):
       else:
         # File or folder path
         src_path = os.path.join(base_path, src)
-        if not os.path.exists(src_path):
+        if not stat_cache.exists(src_path):
           raise OSError('Source path "%s" not found' % (src_path))
-        elif os.path.isdir(src_path):
-          src_items = [os.path.join(src_path, child)
-                       for child in os.listdir(src_path)]
+        elif stat_cache.isdir(src_path):
+          if src.endswith('/') or src.endswith(os.sep):
+            # Trailing slash - all files in the tree
+            src_items = stat_cache.walk_files(src_path.rstrip('/' + os.sep))
+          else:
+            src_items = [os.path.join(src_path, child)
+                         for child in stat_cache.listdir(src_path)]
         else:
           src_items = [src_path]
 
       # Apply the src_filter, if any
-      if len(include_filter_list) or len(exclude_filter_list):
+      if include_regex or exclude_regex:
         for file_path in src_items:
-          file_name = os.path.basename(file_path)
-          if any(fnmatch.fnmatch(file_name, f) for f in exclude_filter_list):
+          file_name = os.path.normcase(os.path.basename(file_path))
+          if exclude_regex and exclude_regex.match(file_name):
             continue
-          if (not len(include_filter_list) or
-              any(fnmatch.fnmatch(file_name, f) for f in include_filter_list)):
-            input_paths.append(file_path)
+          if not include_regex or include_regex.match(file_name):
+            yield file_path
       else:
-        input_paths.extend(src_items)
-    return input_paths
+        for file_path in src_items:
+          yield file_path
 
   def __get_target_path(self, base_path, name=None, suffix=None):
     """Handling of _get_*_path() methods.
@@ -575,8 +708,7 @@ class RuleContext(object):
     Arg:
       path: An absolute path to a folder that should exist.
     """
-    if not os.path.isdir(path):
-      os.makedirs(path)
+    self.build_context.stat_cache.makedirs(path)
 
   def _append_output_paths(self, paths):
     """Appends the given paths to the output list.
@@ -591,6 +723,7 @@ class RuleContext(object):
   def _run_task_async(self, task):
     """Runs a task asynchronously.
     This is a utility method that makes it easier to execute tasks.
+    Any resource weights defined on the rule are applied to the task.
 
     Args:
       task: Task to execute.
@@ -598,6 +731,9 @@ class RuleContext(object):
     Returns:
       A deferred that signals when the task completes.
     """
+    if self.rule.resource_weights:
+      task.resource_weights = dict(task.resource_weights)
+      task.resource_weights.update(self.rule.resource_weights)
     return self.build_context.task_executor.run_task_async(task)
 
   def check_predecessor_failures(self):
@@ -695,7 +831,14 @@ class RuleContext(object):
     """
     self.status = Status.SUCCEEDED
     self.end_time = util.timer()
-    self.deferred.callback()
+    # Outputs were likely written by tasks since they were last queried
+    self.build_context.stat_cache.invalidate_all(self.all_output_files)
+    # Rules waiting on this one begin together
+    self.build_context._begin_batch()
+    try:
+      self.deferred.callback()
+    finally:
+      self.build_context._end_batch()
 
   def _fail(self, exception=None, *args, **kwargs):
     """Signals that rule execution has completed in failure.
@@ -709,12 +852,19 @@ class RuleContext(object):
     self.status = Status.FAILED
     self.end_time = util.timer()
     self.exception = exception
+    self.build_context.stat_cache.invalidate_all(self.all_output_files)
+    # Ensure the rule runs again next time, even if its inputs do not change
+    self.build_context.cache.invalidate_rule(self.rule.path)
     # TODO(benvanik): real logging of rule failure
     print '!! failed %s' % (self.rule)
-    if exception:
-      self.deferred.errback(exception=exception)
-    else:
-      self.deferred.errback()
+    self.build_context._begin_batch()
+    try:
+      if exception:
+        self.deferred.errback(exception=exception)
+      else:
+        self.deferred.errback()
+    finally:
+      self.build_context._end_batch()
 
   def _chain(self, deferreds):
     """Chains the completion of the rule on the given deferred.
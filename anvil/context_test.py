@@ -161,10 +161,18 @@ class BuildContextTest(FixtureTestCase):
         SucceedRule('d', deps=[':c']),
         SucceedRule('e', deps=[':c']),
         SucceedRule('f', deps=[':d', ':e'])])])
-    with BuildContext(self.build_env, project, stop_on_error=True) as ctx:
+    class CancelCountingExecutor(InProcessTaskExecutor):
+      cancel_count = 0
+      def cancel_all(self):
+        self.cancel_count += 1
+    task_executor = CancelCountingExecutor()
+    with BuildContext(self.build_env, project, task_executor=task_executor,
+                      stop_on_error=True) as ctx:
       d = ctx.execute_async(['m:b', 'm:f'])
       ctx.wait(d)
       self.assertErrback(d)
+      # Outstanding work is cancelled once, on the first failure
+      self.assertEqual(task_executor.cancel_count, 1)
       results = ctx.get_rule_results('m:a')
       self.assertEqual(results[0], Status.FAILED)
       results = ctx.get_rule_results('m:b')
@@ -244,6 +252,81 @@ class BuildContextTest(FixtureTestCase):
       d = ctx.execute_sync(['m:a'])
       self.assertFalse(rule_was_cached[0])
 
+  def testDependencyOrder(self):
+    begun = []
+    running = []
+    class WaitingRule(Rule):
+      class _Context(RuleContext):
+        def begin(self):
+          super(WaitingRule._Context, self).begin()
+          begun.append(self.rule.name)
+          running.append(self)
+
+    project = Project(modules=[Module('m', rules=[
+        WaitingRule('a'),
+        WaitingRule('b', srcs=[':a']),
+        WaitingRule('c', srcs=[':b']),
+        WaitingRule('d', srcs=[':a']),
+        ])])
+    with BuildContext(self.build_env, project) as ctx:
+      d = ctx.execute_async(['m:c', 'm:d'])
+      # Rules only begin once all rules they depend on have completed
+      self.assertEqual(begun, ['a'])
+      running.pop(0)._succeed()
+      self.assertEqual(sorted(begun), ['a', 'b', 'd'])
+      self.assertEqual(sorted(rule_ctx.rule.name for rule_ctx in running),
+                       ['b', 'd'])
+      for rule_ctx in running[:]:
+        running.remove(rule_ctx)
+        rule_ctx._succeed()
+      self.assertEqual(begun[-1], 'c')
+      running.pop(0)._succeed()
+      self.assertCallback(d)
+
+  def testBatchCallbacks(self):
+    batches = []
+    pending = []
+    class BatchedRule(Rule):
+      class _Context(RuleContext):
+        def begin(self):
+          super(BatchedRule._Context, self).begin()
+          if not pending:
+            self.build_context.add_batch_callback(_issue_pending)
+          pending.append(self)
+    def _issue_pending():
+      rule_ctxs = pending[:]
+      del pending[:]
+      batches.append(sorted(rule_ctx.rule.name for rule_ctx in rule_ctxs))
+      for rule_ctx in rule_ctxs:
+        rule_ctx._succeed()
+
+    project = Project(modules=[Module('m', rules=[
+        BatchedRule('a'),
+        BatchedRule('b'),
+        BatchedRule('c', srcs=[':a', ':b']),
+        BatchedRule('d', srcs=[':c']),
+        BatchedRule('e', srcs=[':c']),
+        ])])
+    with BuildContext(self.build_env, project) as ctx:
+      self.assertTrue(ctx.execute_sync(['m:d', 'm:e']))
+    self.assertEqual(batches, [['a', 'b'], ['c'], ['d', 'e']])
+
+    # Callbacks added outside of rule execution are called immediately
+    called = []
+    with BuildContext(self.build_env, project) as ctx:
+      ctx.add_batch_callback(lambda: called.append(True))
+    self.assertEqual(called, [True])
+
+  def testExitCallbacks(self):
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    called = []
+    with BuildContext(self.build_env, project) as ctx:
+      ctx.add_exit_callback(lambda: called.append('a'))
+      ctx.add_exit_callback(lambda: called.append('b'))
+      self.assertTrue(ctx.execute_sync([':a']))
+      self.assertEqual(called, [])
+    self.assertEqual(called, ['a', 'b'])
+
   def testBuild(self):
     project = Project(module_resolver=FileModuleResolver(self.root_path))
 
@@ -410,6 +493,24 @@ class RuleContextTest(FixtureTestCase):
         set([os.path.basename(f) for f in rule_outputs]),
         set(['a.txt', 'b.txt', 'c.txt', 'd.txt', 'e.txt']))
 
+    rule = ':recursive_dir'
+    resolved = project.resolve_rule(rule)
+    success = build_ctx.execute_sync([rule])
+    self.assertTrue(success)
+    rule_outputs = build_ctx.get_rule_outputs(resolved)
+    self.assertEqual(
+        set([os.path.basename(f) for f in rule_outputs]),
+        set(['BUILD', 'd.txt', 'e.txt', 'f.not-txt']))
+
+    rule = ':recursive_dir_filter'
+    resolved = project.resolve_rule(rule)
+    success = build_ctx.execute_sync([rule])
+    self.assertTrue(success)
+    rule_outputs = build_ctx.get_rule_outputs(resolved)
+    self.assertEqual(
+        set([os.path.basename(f) for f in rule_outputs]),
+        set(['d.txt', 'e.txt']))
+
     rule = ':exclude_txt_filter'
     resolved = project.resolve_rule(rule)
     success = build_ctx.execute_sync([rule])
@@ -0,0 +1,272 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Continuous build daemon.
+
+Rebuilds a set of target rules whenever the files they use change. File system
+changes are debounced and mapped to the rules consuming the changed files with a
+reverse index built from the previous build. Only those rules and the rules that
+depend on them are executed again - the results of all others are reused.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import threading
+import traceback
+
+from anvil import journal
+from anvil.context import BuildContext
+from anvil.enums import Status
+
+
+class RuleIndex(object):
+  """Reverse index of input files to the rules that use them.
+  """
+
+  def __init__(self):
+    """Initializes an empty rule index.
+    """
+    # Rule paths by input file path
+    self._rules_by_path = {}
+    # Rule paths by the directories containing their input files
+    self._rules_by_dir = {}
+
+  def add_rule_context(self, rule_ctx):
+    """Adds the inputs of an executed rule to the index.
+
+    Args:
+      rule_ctx: A RuleContext that has been executed.
+    """
+    rule_path = rule_ctx.rule.path
+    for src_path in rule_ctx.src_paths:
+      src_path = os.path.normpath(src_path)
+      self._rules_by_path.setdefault(src_path, set()).add(rule_path)
+      self._rules_by_dir.setdefault(
+          os.path.dirname(src_path), set()).add(rule_path)
+
+  def get_affected_rules(self, changed_paths):
+    """Gets the rules affected by changes to the given paths.
+    Paths not used by any rule are assumed to have been added, which affects
+    the rules using files in the same directory (or the nearest parent
+    directory) as their sources may be globs.
+
+    Args:
+      changed_paths: A list of absolute paths that changed.
+
+    Returns:
+      A tuple of (rule_paths, added_rule_paths) with sets of the paths of all
+      affected rules and of the rules affected by added or removed files.
+    """
+    rule_paths = set()
+    added_rule_paths = set()
+    for path in changed_paths:
+      path = os.path.normpath(path)
+      path_rules = self._rules_by_path.get(path, None)
+      if path_rules:
+        rule_paths.update(path_rules)
+        if not os.path.exists(path):
+          added_rule_paths.update(path_rules)
+        continue
+      while True:
+        parent_path = os.path.dirname(path)
+        if parent_path == path:
+          break
+        path = parent_path
+        dir_rules = self._rules_by_dir.get(path, None)
+        if dir_rules:
+          rule_paths.update(dir_rules)
+          added_rule_paths.update(dir_rules)
+          break
+    return (rule_paths, added_rule_paths)
+
+
+class ContinuousBuilder(object):
+  """Builds target rules and rebuilds them when the files they use change.
+  """
+
+  def __init__(self, build_env, session, task_executor, target_rule_names,
+               stop_on_error=False, debounce=0.1, poll_interval=1,
+               change_callback=None):
+    """Initializes a continuous builder.
+
+    Args:
+      build_env: Current build environment.
+      session: BuildSession holding the project and caches.
+      task_executor: Task executor to use for all builds.
+      target_rule_names: A list of rule names to build.
+      stop_on_error: True to stop each build as soon as an error occurs.
+      debounce: Seconds without file changes to wait for before rebuilding.
+      poll_interval: Seconds between scans if changes have to be polled for.
+      change_callback: A function called from the build thread after each
+          build with the result and a list of output paths that changed.
+    """
+    self.build_env = build_env
+    self.session = session
+    self.task_executor = task_executor
+    self.target_rule_names = list(target_rule_names)
+    self.stop_on_error = stop_on_error
+    self.debounce = debounce
+    self.poll_interval = poll_interval
+    self.change_callback = change_callback
+
+    root_path = os.path.normpath(build_env.root_path)
+    # Changes under these paths never trigger builds, as they are made by them
+    self.ignored_paths = [os.path.join(root_path, name) + os.sep
+                          for name in ['build-out', 'build-gen', 'build-bin']]
+
+    # RuleContexts by rule path from the last build
+    self.rule_contexts = None
+    self.rule_index = RuleIndex()
+    # mtimes of all outputs when they were last reported, by path
+    self._output_mtimes = {}
+    # Output paths that changed in the last build
+    self.changed_output_paths = []
+    self._stopped = threading.Event()
+
+  def build(self, changed_paths=None):
+    """Builds the target rules.
+
+    Args:
+      changed_paths: A list of absolute paths that changed since the last
+          build. If None then all rules are checked.
+
+    Returns:
+      True if the build succeeded, False if it failed, or None if no rules were affected by the
+      changes.
+    """
+    session = self.session
+    reuse_rule_contexts = None
+    if changed_paths is None or self.rule_contexts is None:
+      session.rule_cache.record_changes(None)
+    elif any(path in session.project.modules for path in changed_paths):
+      # A module changed - rules may be different now
+      # The session will reload it
+      session.rule_cache.record_changes(None)
+    else:
+      trigger_paths = [path for path in changed_paths
+                       if not self._is_ignored(path)]
+      (rule_paths, added_rule_paths) = self.rule_index.get_affected_rules(
+          trigger_paths)
+      if not rule_paths:
+        return None
+      dirty_rule_paths = session.rule_graph.get_dependent_rule_paths(
+          rule_paths)
+      reuse_rule_contexts = {}
+      for (rule_path, rule_ctx) in self.rule_contexts.iteritems():
+        if (not rule_path in dirty_rule_paths and
+            rule_ctx.status == Status.SUCCEEDED):
+          reuse_rule_contexts[rule_path] = rule_ctx
+      # Glob results in the modules of these rules may have changed
+      session.unload_modules(set(
+          self.rule_contexts[rule_path].rule.parent_module.path
+          for rule_path in added_rule_paths
+          if rule_path in self.rule_contexts))
+      # Nothing else changed, so only these need to be checked by the cache
+      session.rule_cache.record_changes(changed_paths)
+    session.refresh()
+
+    try:
+      with BuildContext(self.build_env, session.project,
+                        rule_cache=session.rule_cache,
+                        task_executor=self.task_executor,
+                        stop_on_error=self.stop_on_error,
+                        raise_on_error=False,
+                        rule_graph=session.rule_graph,
+                        reuse_rule_contexts=reuse_rule_contexts) as build_ctx:
+        result = build_ctx.execute_sync(self.target_rule_names)
+    except Exception:
+      # Bad modules or missing sources - keep watching so they can be fixed
+      traceback.print_exc()
+      self.rule_contexts = None
+      self.rule_index = RuleIndex()
+      self.changed_output_paths = []
+      return False
+    self.rule_contexts = build_ctx.rule_contexts
+    self.rule_index = RuleIndex()
+    for rule_ctx in self.rule_contexts.itervalues():
+      self.rule_index.add_rule_context(rule_ctx)
+    self.changed_output_paths = self._get_changed_output_paths(
+        reuse_rule_contexts or {})
+    return result
+
+  def _get_changed_output_paths(self, reuse_rule_contexts):
+    """Gets the outputs of the rules executed in the last build that changed
+    since they were last reported.
+
+    Args:
+      reuse_rule_contexts: RuleContexts reused from the build before, by rule
+          path.
+
+    Returns:
+      A sorted list of absolute output paths.
+    """
+    changed_paths = set()
+    for (rule_path, rule_ctx) in self.rule_contexts.iteritems():
+      if (rule_path in reuse_rule_contexts or
+          rule_ctx.status != Status.SUCCEEDED):
+        continue
+      for output_path in rule_ctx.all_output_files:
+        try:
+          mtime = os.path.getmtime(output_path)
+        except OSError:
+          continue
+        if self._output_mtimes.get(output_path, None) != mtime:
+          self._output_mtimes[output_path] = mtime
+          changed_paths.add(output_path)
+    return sorted(changed_paths)
+
+  def _is_ignored(self, path):
+    for ignored_path in self.ignored_paths:
+      if path.startswith(ignored_path):
+        return True
+    return False
+
+  def run(self, watcher=None):
+    """Builds the target rules and then rebuilds them on changes until stop is
+    called.
+
+    Args:
+      watcher: A running Watcher of the root path to take changes from. If
+          omitted one is created and run for as long as the builder.
+    """
+    owns_watcher = not watcher
+    if owns_watcher:
+      watcher = journal.create_watcher(self.build_env.root_path,
+                                       journal.ChangeJournal(),
+                                       poll_interval=self.poll_interval)
+      watcher_thread = threading.Thread(target=watcher.run)
+      watcher_thread.daemon = True
+      watcher_thread.start()
+    change_journal = watcher.journal
+    try:
+      clock = change_journal.clock
+      self._report_result(self.build())
+      while not self._stopped.is_set():
+        # Wait for changes, and then for them to stop
+        last_clock = clock
+        while not self._stopped.wait(self.debounce):
+          watcher.sync()
+          if change_journal.clock == last_clock and last_clock != clock:
+            break
+          last_clock = change_journal.clock
+        if self._stopped.is_set():
+          break
+        (clock, changed_paths) = change_journal.get_changes_since(clock)
+        self._report_result(self.build(changed_paths))
+    finally:
+      if owns_watcher:
+        watcher.stop()
+        watcher_thread.join()
+        watcher.close()
+
+  def _report_result(self, result):
+    if result is not None:
+      print 'result %s, watching for changes...' % (result)
+      if self.change_callback:
+        self.change_callback(result, self.changed_output_paths)
+
+  def stop(self):
+    """Stops a running builder after any build in progress completes.
+    """
+    self._stopped.set()
@@ -0,0 +1,150 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the daemon module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import time
+import unittest2
+
+from anvil.build_server import BuildSession
+from anvil.context import BuildEnvironment
+from anvil.daemon import ContinuousBuilder, RuleIndex
+from anvil.task import InProcessTaskExecutor
+from anvil.test import FixtureTestCase
+
+
+class _TestRuleContext(object):
+  def __init__(self, rule_path, src_paths):
+    self.rule = _TestRule(rule_path)
+    self.src_paths = src_paths
+
+
+class _TestRule(object):
+  def __init__(self, path):
+    self.path = path
+
+
+class RuleIndexTest(unittest2.TestCase):
+  """Behavioral tests of the RuleIndex type."""
+
+  def testAffectedRules(self):
+    index = RuleIndex()
+    self.assertEqual(index.get_affected_rules(['/x/a.txt']), (set(), set()))
+
+    index.add_rule_context(_TestRuleContext(':a', ['/x/a.txt']))
+    index.add_rule_context(_TestRuleContext(':b', ['/x/./b.txt',
+                                                   '/x/y/c.txt']))
+    # Modified files only affect the rules using them
+    (rule_paths, added_rule_paths) = index.get_affected_rules(
+        [os.path.abspath(__file__), '/x/y/c.txt'])
+    self.assertEqual(rule_paths, set([':b']))
+    self.assertEqual(added_rule_paths, set([':b']))
+
+    # Unknown files affect rules using files in the nearest directory
+    (rule_paths, added_rule_paths) = index.get_affected_rules(['/x/d.txt'])
+    self.assertEqual(rule_paths, set([':a', ':b']))
+    self.assertEqual(added_rule_paths, set([':a', ':b']))
+    (rule_paths, added_rule_paths) = index.get_affected_rules(
+        ['/x/y/z/d.txt'])
+    self.assertEqual(rule_paths, set([':b']))
+    self.assertEqual(index.get_affected_rules(['/w/d.txt']), (set(), set()))
+
+
+class ContinuousBuilderTest(FixtureTestCase):
+  """Behavioral tests of the ContinuousBuilder type."""
+  fixture = 'simple'
+
+  def setUp(self):
+    super(ContinuousBuilderTest, self).setUp()
+    self.session = BuildSession(self.root_path)
+    self.task_executor = InProcessTaskExecutor()
+    self.builder = ContinuousBuilder(BuildEnvironment(root_path=self.root_path),
+                                     self.session, self.task_executor,
+                                     [':c'])
+
+  def tearDown(self):
+    self.task_executor.close()
+    self.session.close()
+    super(ContinuousBuilderTest, self).tearDown()
+
+  def testIncremental(self):
+    self.assertTrue(self.builder.build())
+    contexts = self.builder.rule_contexts
+    self.assertEqual(len(contexts), 3)
+
+    # Only the changed rule and those depending on it run
+    a_path = os.path.join(self.root_path, 'a.txt')
+    with open(a_path, 'a') as f:
+      f.write('more')
+    self.assertTrue(self.builder.build([a_path]))
+    new_contexts = self.builder.rule_contexts
+    a_rule_path = self.session.project.resolve_rule(':a').path
+    b_rule_path = self.session.project.resolve_rule(':b').path
+    c_rule_path = self.session.project.resolve_rule(':c').path
+    self.assertIsNot(new_contexts[a_rule_path], contexts[a_rule_path])
+    self.assertIs(new_contexts[b_rule_path], contexts[b_rule_path])
+    self.assertIsNot(new_contexts[c_rule_path], contexts[c_rule_path])
+    contexts = new_contexts
+
+    # Outputs and unused files do not trigger builds
+    self.assertIsNone(self.builder.build([
+        os.path.join(self.root_path, 'build-out', 'a.txt'),
+        os.path.join(os.path.dirname(self.root_path), 'x.txt')]))
+
+    # Added files reload the modules of the rules in the same path
+    x_path = os.path.join(self.root_path, 'x.txt')
+    with open(x_path, 'w') as f:
+      f.write('x')
+    self.assertTrue(self.builder.build([x_path]))
+    self.assertEqual(len(self.builder.rule_contexts), 3)
+
+    # Module changes rebuild everything
+    contexts = self.builder.rule_contexts
+    build_path = os.path.join(self.root_path, 'BUILD')
+    new_time = time.time() + 10
+    os.utime(build_path, (new_time, new_time))
+    self.assertTrue(self.builder.build([build_path]))
+    for (rule_path, rule_ctx) in self.builder.rule_contexts.iteritems():
+      self.assertIsNot(rule_ctx, contexts[rule_path])
+
+  def testChangedOutputPaths(self):
+    changes = []
+    self.builder.change_callback = lambda result, paths: changes.append(
+        (result, paths))
+    paths = [os.path.join(self.root_path, name)
+             for name in ['a.txt', 'b.txt', 'c.txt']]
+    self.assertTrue(self.builder.build())
+    self.assertEqual(self.builder.changed_output_paths, paths)
+
+    # Only outputs that changed are reported
+    new_time = time.time() + 10
+    os.utime(paths[0], (new_time, new_time))
+    self.assertTrue(self.builder.build([paths[0]]))
+    self.assertEqual(self.builder.changed_output_paths, [paths[0]])
+    self.assertTrue(self.builder.build([paths[0]]))
+    self.assertEqual(self.builder.changed_output_paths, [])
+
+    # The callback is only used when running
+    self.assertEqual(changes, [])
+    self.builder._report_result(True)
+    self.assertEqual(changes, [(True, [])])
+    self.builder._report_result(None)
+    self.assertEqual(len(changes), 1)
+
+  def testFailure(self):
+    a_path = os.path.join(self.root_path, 'a.txt')
+    os.remove(a_path)
+    self.assertFalse(self.builder.build())
+    with open(a_path, 'w') as f:
+      f.write('a')
+    self.assertTrue(self.builder.build([a_path]))
+
+
+if __name__ == '__main__':
+  unittest2.main()
@@ -114,6 +114,27 @@ class RuleGraph(object):
       rule_paths.append(rule.path)
     self._ensure_rules_present(rule_paths, requesting_module=module)
 
+  def get_dependent_rule_paths(self, rule_paths):
+    """Gets the given rules and all rules that depend on them, directly or
+    indirectly.
+
+    Args:
+      rule_paths: A list of full rule paths. Rules not in the graph are ignored.
+
+    Returns:
+      A set of full rule paths.
+    """
+    dependent_paths = set()
+    pending_paths = [rule_path for rule_path in rule_paths
+                     if rule_path in self.rule_nodes]
+    while pending_paths:
+      rule_path = pending_paths.pop()
+      if rule_path in dependent_paths:
+        continue
+      dependent_paths.add(rule_path)
+      pending_paths.extend(self.graph.successors(rule_path))
+    return dependent_paths
+
   def has_rule(self, rule_path):
     """Whether the graph has the given rule loaded.
 
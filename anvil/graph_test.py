@@ -107,6 +107,18 @@ class RuleGraphTest(unittest2.TestCase):
     with self.assertRaises(KeyError):
       graph.has_dependency('m1:x', 'm1:x')
 
+  def testGetDependentRulePaths(self):
+    graph = RuleGraph(self.project)
+    graph.add_rules_from_module(self.module_1)
+    graph.add_rules_from_module(self.module_2)
+    self.assertEqual(graph.get_dependent_rule_paths([]), set())
+    self.assertEqual(graph.get_dependent_rule_paths(['m1:a3']),
+                     set(['m1:a3']))
+    self.assertEqual(graph.get_dependent_rule_paths(['m1:a1']),
+                     set(['m1:a1', 'm1:b', 'm1:c', 'm2:p']))
+    self.assertEqual(graph.get_dependent_rule_paths(['m1:c', 'm1:a3', 'm1:x']),
+                     set(['m1:c', 'm1:a3', 'm2:p']))
+
   def testCalculateRuleSequence(self):
     graph = RuleGraph(self.project)
 
@@ -0,0 +1,214 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""GNU make jobserver support.
+
+A jobserver is a pipe shared between cooperating processes that is pre-filled
+with one byte ('token') for every job that may run in parallel beyond the first.
+Each process owns one implicit token and must read a token from the pipe before
+starting any additional concurrent job, writing it back when the job completes.
+
+When anvil is run from make (with the rule marked as recursive, such as with
+$(MAKE) or a '+' prefix) it acts as a client of the inherited jobserver. It can
+also create its own jobserver so that any make invoked by its tasks shares the
+same limit.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import errno
+import os
+import re
+import select
+
+try:
+  import fcntl
+except ImportError: # pragma: no cover
+  # Not available on Windows - try_acquire will block
+  fcntl = None
+
+
+class Jobserver(object):
+  """A GNU make jobserver client, and optionally its owner.
+  """
+
+  _AUTH_REGEX = re.compile(r'--jobserver-(?:auth|fds)=(\S+)')
+
+  def __init__(self, read_fd, write_fd, owned=False, fifo_path=None):
+    """Initializes a jobserver.
+    Prefer using from_environment or create.
+
+    Args:
+      read_fd: File descriptor tokens are read from.
+      write_fd: File descriptor tokens are written back to.
+      owned: True if this process created the jobserver and should close it.
+      fifo_path: Path of the named pipe, if the jobserver uses one.
+    """
+    self.read_fd = read_fd
+    self.write_fd = write_fd
+    self.owned = owned
+    self.fifo_path = fifo_path
+    # Non-blocking descriptor used by try_acquire, opened on first use
+    self._nonblocking_read_fd = None
+
+  @classmethod
+  def from_environment(cls, environ=None):
+    """Connects to a jobserver inherited from a parent make, if any.
+
+    Args:
+      environ: Environment dictionary. Defaults to os.environ.
+
+    Returns:
+      A Jobserver, or None if no usable jobserver was inherited.
+    """
+    if environ is None:
+      environ = os.environ
+    makeflags = environ.get('MAKEFLAGS', '')
+    matches = cls._AUTH_REGEX.findall(makeflags)
+    if not matches:
+      return None
+    # The last one wins, matching make
+    auth = matches[-1]
+    if auth.startswith('fifo:'):
+      fifo_path = auth[len('fifo:'):]
+      try:
+        fd = os.open(fifo_path, os.O_RDWR)
+      except OSError:
+        print 'Unable to open jobserver fifo %s - ignoring' % (fifo_path)
+        return None
+      return cls(fd, fd, fifo_path=fifo_path)
+    try:
+      (read_fd, write_fd) = [int(fd) for fd in auth.split(',')]
+    except ValueError:
+      return None
+    if read_fd < 0 or write_fd < 0:
+      return None
+    # make closes the pipe for rules not marked as recursive
+    try:
+      os.fstat(read_fd)
+      os.fstat(write_fd)
+    except OSError:
+      print ('Jobserver pipe not inherited - ignoring (prefix the make rule '
+             'with + to share it)')
+      return None
+    return cls(read_fd, write_fd)
+
+  @classmethod
+  def create(cls, job_count):
+    """Creates a new jobserver owned by this process.
+
+    Args:
+      job_count: Total number of jobs that may run at once, including the
+          implicit job of this process.
+
+    Returns:
+      A new Jobserver.
+    """
+    (read_fd, write_fd) = os.pipe()
+    if job_count > 1:
+      os.write(write_fd, '+' * (job_count - 1))
+    return cls(read_fd, write_fd, owned=True)
+
+  def get_makeflags(self):
+    """Gets the MAKEFLAGS value that lets child makes use this jobserver.
+
+    Returns:
+      A string suitable for MAKEFLAGS.
+    """
+    if self.fifo_path:
+      return ' -j --jobserver-auth=fifo:%s' % (self.fifo_path)
+    # --jobserver-fds is understood by make versions before 4.2
+    return ' -j --jobserver-fds=%s,%s --jobserver-auth=%s,%s' % (
+        self.read_fd, self.write_fd, self.read_fd, self.write_fd)
+
+  def wait_for_token(self, timeout=None):
+    """Waits for a token to become readable.
+
+    Args:
+      timeout: Maximum time to wait, in seconds. None to wait forever.
+
+    Returns:
+      True if a token may be available.
+    """
+    try:
+      (readable, _, _) = select.select([self.read_fd], [], [], timeout)
+    except select.error as e:
+      if e.args[0] == errno.EINTR:
+        return False
+      raise
+    return bool(readable)
+
+  def acquire(self):
+    """Reads a token from the jobserver.
+    This blocks until a token is available. Use wait_for_token first to avoid
+    blocking for long.
+
+    Returns:
+      The token read, which must be passed to release.
+    """
+    while True:
+      try:
+        return os.read(self.read_fd, 1)
+      except OSError as e:
+        if e.errno not in (errno.EINTR, errno.EAGAIN):
+          raise
+
+  def try_acquire(self):
+    """Reads a token from the jobserver if one is available.
+    Other processes may take a token between wait_for_token returning and the
+    read, so this never blocks.
+
+    Returns:
+      The token read, which must be passed to release, or None if no token was
+      available.
+    """
+    fd = self._get_nonblocking_read_fd()
+    while True:
+      try:
+        return os.read(fd, 1) or None
+      except OSError as e:
+        if e.errno == errno.EAGAIN:
+          return None
+        if e.errno != errno.EINTR:
+          raise
+
+  def _get_nonblocking_read_fd(self):
+    """Gets a non-blocking descriptor to read tokens from.
+    The pipe is reopened where possible, so that the file description shared
+    with other processes (which may expect blocking reads) is not changed.
+
+    Returns:
+      A file descriptor.
+    """
+    if self._nonblocking_read_fd is not None:
+      return self._nonblocking_read_fd
+    path = self.fifo_path or '/proc/self/fd/%s' % (self.read_fd)
+    try:
+      self._nonblocking_read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+      if fcntl:
+        flags = fcntl.fcntl(self.read_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+      self._nonblocking_read_fd = self.read_fd
+    return self._nonblocking_read_fd
+
+  def release(self, token):
+    """Returns a token to the jobserver.
+
+    Args:
+      token: A token returned from acquire.
+    """
+    os.write(self.write_fd, token)
+
+  def close(self):
+    """Closes the jobserver file descriptors, if owned by this process.
+    """
+    if self._nonblocking_read_fd not in (None, self.read_fd):
+      os.close(self._nonblocking_read_fd)
+    self._nonblocking_read_fd = None
+    if self.owned:
+      os.close(self.read_fd)
+      os.close(self.write_fd)
+    elif self.fifo_path:
+      os.close(self.read_fd)
+    self.read_fd = self.write_fd = -1
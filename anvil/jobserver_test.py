@@ -0,0 +1,166 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the jobserver module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest2
+
+from anvil.context import BuildEnvironment
+from anvil.jobserver import Jobserver
+from anvil.task import MultiProcessTaskExecutor, Task
+
+
+def _count_tokens(jobserver):
+  """Reads all available tokens and writes them back.
+
+  Args:
+    jobserver: Jobserver to check.
+
+  Returns:
+    The number of tokens that were available.
+  """
+  tokens = []
+  while jobserver.wait_for_token(timeout=0):
+    tokens.append(jobserver.acquire())
+  for token in tokens:
+    jobserver.release(token)
+  return len(tokens)
+
+
+class JobserverTest(unittest2.TestCase):
+  """Behavioral tests of the Jobserver type."""
+
+  def testFromEnvironment(self):
+    self.assertIsNone(Jobserver.from_environment({}))
+    self.assertIsNone(Jobserver.from_environment({'MAKEFLAGS': '-k'}))
+    self.assertIsNone(Jobserver.from_environment(
+        {'MAKEFLAGS': '--jobserver-auth=x,y'}))
+    self.assertIsNone(Jobserver.from_environment(
+        {'MAKEFLAGS': '--jobserver-auth=-2,-2'}))
+
+    (read_fd, write_fd) = os.pipe()
+    os.close(read_fd)
+    os.close(write_fd)
+    self.assertIsNone(Jobserver.from_environment(
+        {'MAKEFLAGS': ' -j --jobserver-auth=%s,%s' % (read_fd, write_fd)}))
+
+    owner = Jobserver.create(3)
+    try:
+      for makeflags in [owner.get_makeflags(),
+                        ' -j --jobserver-fds=%s,%s' % (owner.read_fd,
+                                                       owner.write_fd)]:
+        client = Jobserver.from_environment({'MAKEFLAGS': makeflags})
+        self.assertIsNotNone(client)
+        self.assertFalse(client.owned)
+        self.assertEqual(client.read_fd, owner.read_fd)
+        self.assertEqual(client.write_fd, owner.write_fd)
+        client.close()
+        self.assertEqual(_count_tokens(owner), 2)
+    finally:
+      owner.close()
+
+  def testFifo(self):
+    temp_path = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, temp_path)
+    fifo_path = os.path.join(temp_path, 'fifo')
+    os.mkfifo(fifo_path)
+    client = Jobserver.from_environment(
+        {'MAKEFLAGS': '-j --jobserver-auth=fifo:%s' % (fifo_path)})
+    self.assertIsNotNone(client)
+    self.assertEqual(client.get_makeflags(),
+                     ' -j --jobserver-auth=fifo:%s' % (fifo_path))
+    client.release('+')
+    self.assertEqual(_count_tokens(client), 1)
+    client.close()
+
+  def testTokens(self):
+    jobserver = Jobserver.create(1)
+    self.assertTrue(jobserver.owned)
+    self.assertEqual(_count_tokens(jobserver), 0)
+    jobserver.close()
+
+    jobserver = Jobserver.create(4)
+    self.assertEqual(_count_tokens(jobserver), 3)
+    token = jobserver.acquire()
+    self.assertEqual(_count_tokens(jobserver), 2)
+    jobserver.release(token)
+    self.assertEqual(_count_tokens(jobserver), 3)
+    jobserver.close()
+
+    # try_acquire returns None instead of blocking once tokens run out
+    jobserver = Jobserver.create(3)
+    tokens = [jobserver.try_acquire(), jobserver.try_acquire()]
+    self.assertNotIn(None, tokens)
+    self.assertIsNone(jobserver.try_acquire())
+    for token in tokens:
+      jobserver.release(token)
+    self.assertEqual(_count_tokens(jobserver), 2)
+    jobserver.close()
+
+
+class _SleepTask(Task):
+  def execute(self):
+    start_time = time.time()
+    time.sleep(0.1)
+    return (start_time, time.time())
+
+
+class JobserverExecutorTest(unittest2.TestCase):
+  """Behavioral tests of task executors using a jobserver."""
+
+  def testLimit(self):
+    build_env = BuildEnvironment()
+    jobserver = Jobserver.create(2)
+    with MultiProcessTaskExecutor(worker_count=4,
+                                  jobserver=jobserver) as executor:
+      ds = [executor.run_task_async(_SleepTask(build_env))
+            for n in xrange(6)]
+      executor.wait(ds)
+      intervals = []
+      for d in ds:
+        d.add_callback_fn(lambda result: intervals.append(result))
+    self.assertEqual(len(intervals), 6)
+
+    # No more than two tasks may have been running at any time
+    for (start_time, end_time) in intervals:
+      overlapping = [other for other in intervals
+                     if other[0] <= start_time < other[1]]
+      self.assertLessEqual(len(overlapping), 2)
+
+    # All tokens must have been returned
+    self.assertEqual(_count_tokens(jobserver), 1)
+    jobserver.close()
+
+  def testQueuedTasksHoldNoTokens(self):
+    build_env = BuildEnvironment()
+    jobserver = Jobserver.create(16)
+    held_counts = []
+    with MultiProcessTaskExecutor(worker_count=2,
+                                  jobserver=jobserver) as executor:
+      ds = [executor.run_task_async(_SleepTask(build_env))
+            for n in xrange(8)]
+      while not all(d.is_done() for d in ds):
+        with executor._lock:
+          held_counts.append(len(executor._jobserver_tokens) + len(
+              [token for token in executor._task_tokens.values()
+               if token is not None]))
+        time.sleep(0.01)
+      executor.wait(ds)
+
+    # Only one token is needed beyond the implicit one for two workers
+    self.assertLessEqual(max(held_counts), 1)
+    self.assertEqual(_count_tokens(jobserver), 15)
+    jobserver.close()
+
+
+if __name__ == '__main__':
+  unittest2.main()
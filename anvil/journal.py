@@ -0,0 +1,517 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""File system change journal.
+
+A watch daemon (started with 'anvil watchd') records every path that changes
+under a project root, tagging each change with the value of a monotonically
+increasing clock. Builds query the daemon for the paths changed since the clock
+value they saw last, allowing them to skip stat scans of files that are known to
+be unchanged.
+
+Changes are detected with inotify where available, otherwise by periodically
+scanning the tree. Clients find the daemon through a state file in the
+.build-cache path of the project root and talk to it over a localhost socket.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import collections
+import errno
+import marshal
+import os
+import select
+import socket
+import SocketServer
+import struct
+import threading
+import uuid
+
+try:
+  import ctypes
+  import ctypes.util
+  _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                      use_errno=True)
+  _libc.inotify_init1
+  _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                      ctypes.c_uint32]
+  _libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+except (ImportError, OSError, AttributeError): # pragma: no cover
+  # Not Linux - only polling is supported
+  _libc = None
+
+
+# Directories that are never watched
+IGNORED_NAMES = frozenset(['.build-cache', '.git', '.hg', '.svn'])
+
+# State file, relative to the project root
+STATE_FILE = os.path.join('.build-cache', 'watchd')
+
+
+class JournalError(Exception):
+  """An error communicating with the watch daemon.
+  """
+  pass
+
+
+class ChangeJournal(object):
+  """An in-memory journal of changed paths.
+  Each call to record bumps the clock and tags the paths with the new value.
+  Only the most recent change to a path is kept, and the oldest paths are
+  dropped once the journal grows too large - queries for changes older than
+  that return None to indicate that anything may have changed.
+  """
+
+  def __init__(self, max_changes=100000):
+    """Initializes a change journal.
+
+    Args:
+      max_changes: Maximum number of paths to remember.
+    """
+    # Identifies this journal, as clock values are meaningless across journals
+    self.journal_id = uuid.uuid4().hex
+    self.clock = 0
+    self.max_changes = max_changes
+    self._lock = threading.Lock()
+    # Clock values by path, ordered from least to most recently changed
+    self._changes = collections.OrderedDict()
+    # Changes with clock values up to this have been dropped
+    self._min_clock = 0
+
+  def record(self, paths):
+    """Records that the given paths have changed.
+
+    Args:
+      paths: A list of absolute paths.
+    """
+    if not paths:
+      return
+    with self._lock:
+      self.clock += 1
+      for path in paths:
+        self._changes.pop(path, None)
+        self._changes[path] = self.clock
+      while len(self._changes) > self.max_changes:
+        (path, clock) = self._changes.popitem(last=False)
+        self._min_clock = clock
+
+  def reset(self):
+    """Marks everything as changed.
+    Used when changes may have been missed.
+    """
+    with self._lock:
+      self.clock += 1
+      self._changes.clear()
+      self._min_clock = self.clock
+
+  def get_changes_since(self, since_clock):
+    """Gets all paths changed after the given clock value.
+
+    Args:
+      since_clock: A clock value previously returned from this method, or 0.
+
+    Returns:
+      A tuple of (clock, paths) with the current clock value and a list of the
+      changed paths. paths is None if the changes are no longer known.
+    """
+    with self._lock:
+      if since_clock < self._min_clock:
+        return (self.clock, None)
+      paths = []
+      for path in reversed(self._changes):
+        if self._changes[path] <= since_clock:
+          break
+        paths.append(path)
+      return (self.clock, paths)
+
+
+class Watcher(object):
+  """Abstract file system watcher.
+  Watchers record changes to the files and directories under a root path into
+  a journal until stopped.
+  """
+
+  def __init__(self, root_path, journal, *args, **kwargs):
+    """Initializes a watcher.
+    Only changes made after the watcher is initialized are recorded.
+
+    Args:
+      root_path: Root path to watch.
+      journal: ChangeJournal to record changes into.
+    """
+    self.root_path = os.path.normpath(root_path)
+    self.journal = journal
+    self._stopped = threading.Event()
+
+  def run(self):
+    """Records changes until stop is called.
+    """
+    raise NotImplementedError()
+
+  def sync(self):
+    """Records any changes that have been detected but not yet recorded.
+    Called before the journal is queried.
+    """
+    pass
+
+  def stop(self):
+    """Stops a running watcher.
+    """
+    self._stopped.set()
+
+  def close(self):
+    """Releases any resources held by the watcher.
+    """
+    pass
+
+  def _walk(self, path):
+    """Walks the tree under a path, skipping ignored directories.
+
+    Args:
+      path: Root path.
+
+    Returns:
+      An iterator of (dir_path, dir_names, file_names) tuples.
+    """
+    for (dir_path, dir_names, file_names) in os.walk(path):
+      dir_names[:] = [name for name in dir_names
+                      if not name in IGNORED_NAMES]
+      yield (dir_path, dir_names, file_names)
+
+
+class PollingWatcher(Watcher):
+  """A watcher that periodically scans the tree for changes.
+  Changes are detected with a delay of up to the poll interval.
+  """
+
+  def __init__(self, root_path, journal, poll_interval=1, *args, **kwargs):
+    """Initializes a polling watcher.
+
+    Args:
+      root_path: Root path to watch.
+      journal: ChangeJournal to record changes into.
+      poll_interval: Seconds to wait between scans.
+    """
+    super(PollingWatcher, self).__init__(root_path, journal, *args, **kwargs)
+    self.poll_interval = poll_interval
+    # Held while scanning, as both run and sync may poll
+    self._lock = threading.Lock()
+    self._snapshot = self._scan()
+
+  def _scan(self):
+    """
+    Returns:
+      A dictionary of (mtime, size) tuples by path for everything in the tree.
+    """
+    snapshot = {}
+    for (dir_path, dir_names, file_names) in self._walk(self.root_path):
+      for name in dir_names + file_names:
+        path = os.path.join(dir_path, name)
+        try:
+          st = os.lstat(path)
+        except OSError:
+          continue
+        snapshot[path] = (st.st_mtime, st.st_size)
+    return snapshot
+
+  def poll(self):
+    """Scans the tree and records any changes since the last scan.
+    """
+    with self._lock:
+      old_snapshot = self._snapshot
+      new_snapshot = self._scan()
+      self._snapshot = new_snapshot
+      paths = [path for (path, value) in new_snapshot.iteritems()
+               if old_snapshot.get(path, None) != value]
+      paths.extend([path for path in old_snapshot
+                    if not path in new_snapshot])
+      self.journal.record(paths)
+
+  def sync(self):
+    # Changes made since the last scan would otherwise be missed until the next
+    # poll interval
+    self.poll()
+
+  def run(self):
+    while not self._stopped.wait(self.poll_interval):
+      self.poll()
+
+
+# inotify constants, from sys/inotify.h
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+_IN_CLOEXEC = 0x00080000
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF |
+               _IN_MOVE_SELF | _IN_ONLYDIR)
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class InotifyWatcher(Watcher):
+  """A watcher using Linux inotify.
+  Every directory in the tree is watched and changes are recorded as soon as
+  they are read from the kernel.
+  """
+
+  def __init__(self, root_path, journal, *args, **kwargs):
+    """Initializes an inotify watcher.
+
+    Args:
+      root_path: Root path to watch.
+      journal: ChangeJournal to record changes into.
+
+    Raises:
+      OSError: inotify could not be initialized.
+    """
+    super(InotifyWatcher, self).__init__(root_path, journal, *args, **kwargs)
+    self._lock = threading.Lock()
+    # Watched directory paths by watch descriptor
+    self._watches = {}
+    self._fd = _libc.inotify_init1(_IN_CLOEXEC)
+    if self._fd < 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+    self._add_watches(self.root_path)
+
+  @staticmethod
+  def is_supported():
+    """
+    Returns:
+      True if inotify is available on this system.
+    """
+    return _libc is not None
+
+  def _add_watches(self, path):
+    """Watches a directory and all directories under it.
+
+    Args:
+      path: Directory path.
+
+    Returns:
+      A list of all paths found under the directory.
+    """
+    found_paths = []
+    for (dir_path, dir_names, file_names) in self._walk(path):
+      wd = _libc.inotify_add_watch(self._fd, dir_path, _WATCH_MASK)
+      if wd < 0:
+        e = ctypes.get_errno()
+        if e == errno.ENOSPC:
+          raise OSError(e, 'inotify watch limit reached, try polling')
+        # Removed since it was listed - picked up by its parent
+        continue
+      self._watches[wd] = dir_path
+      found_paths.extend([os.path.join(dir_path, name)
+                          for name in dir_names + file_names])
+    return found_paths
+
+  def _read_events(self, timeout):
+    """Reads and records pending events.
+
+    Args:
+      timeout: Seconds to wait for events, or 0 to only read pending ones.
+
+    Returns:
+      True if any events were read.
+    """
+    (readable, _, _) = select.select([self._fd], [], [], timeout)
+    if not readable:
+      return False
+    data = os.read(self._fd, 64 * 1024)
+    paths = []
+    offset = 0
+    while offset < len(data):
+      (wd, mask, cookie, name_length) = _EVENT_HEADER.unpack_from(data, offset)
+      offset += _EVENT_HEADER.size
+      name = data[offset:offset + name_length].rstrip('\0')
+      offset += name_length
+      if mask & _IN_Q_OVERFLOW:
+        # Events were dropped - anything may have changed
+        self.journal.reset()
+        continue
+      dir_path = self._watches.get(wd, None)
+      if dir_path is None:
+        continue
+      if mask & _IN_IGNORED:
+        del self._watches[wd]
+        continue
+      if name in IGNORED_NAMES:
+        continue
+      path = os.path.join(dir_path, name) if name else dir_path
+      paths.append(path)
+      if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+        # Files may have been added before the directory was watched
+        paths.extend(self._add_watches(path))
+    self.journal.record(paths)
+    return True
+
+  def sync(self):
+    with self._lock:
+      while self._read_events(0):
+        pass
+
+  def run(self):
+    while not self._stopped.is_set():
+      with self._lock:
+        self._read_events(0.1)
+
+  def close(self):
+    if self._fd >= 0:
+      os.close(self._fd)
+      self._fd = -1
+
+
+def create_watcher(root_path, journal, poll_interval=1, force_polling=False):
+  """Creates the best watcher available on this system.
+
+  Args:
+    root_path: Root path to watch.
+    journal: ChangeJournal to record changes into.
+    poll_interval: Seconds to wait between scans when polling.
+    force_polling: True to always use a PollingWatcher.
+
+  Returns:
+    A Watcher.
+  """
+  if not force_polling and InotifyWatcher.is_supported():
+    try:
+      return InotifyWatcher(root_path, journal)
+    except OSError as e:
+      print 'Unable to use inotify (%s), polling instead' % (e)
+  return PollingWatcher(root_path, journal, poll_interval=poll_interval)
+
+
+def _send_message(sock, message):
+  data = marshal.dumps(message)
+  sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _recv_message(sock):
+  header = ''
+  while len(header) < 4:
+    chunk = sock.recv(4 - len(header))
+    if not chunk:
+      raise JournalError('Connection closed')
+    header += chunk
+  (length,) = struct.unpack('!I', header)
+  chunks = []
+  while length:
+    chunk = sock.recv(min(length, 1024 * 1024))
+    if not chunk:
+      raise JournalError('Connection closed')
+    chunks.append(chunk)
+    length -= len(chunk)
+  try:
+    return marshal.loads(''.join(chunks))
+  except (EOFError, ValueError, TypeError) as e:
+    raise JournalError('Invalid message: %s' % (e))
+
+
+class _WatchRequestHandler(SocketServer.BaseRequestHandler):
+  def handle(self):
+    try:
+      since_clock = _recv_message(self.request)
+      self.server.watcher.sync()
+      (clock, paths) = self.server.journal.get_changes_since(since_clock)
+      _send_message(self.request, (self.server.journal.journal_id, clock,
+                                   paths))
+    except (JournalError, socket.error, ValueError):
+      pass
+
+
+class WatchServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """Watch daemon that serves the change journal of a project.
+  Only listens on localhost. The port is written to the state file under the
+  root path so that builds can find it.
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, root_path, port=0, poll_interval=1, force_polling=False):
+    """Initializes the server and starts watching.
+
+    Args:
+      root_path: Project root path to watch.
+      port: TCP port to listen on, or 0 to pick any free port.
+      poll_interval: Seconds to wait between scans when polling.
+      force_polling: True to poll even if inotify is available.
+    """
+    SocketServer.TCPServer.__init__(self, ('127.0.0.1', port),
+                                    _WatchRequestHandler)
+    self.root_path = os.path.normpath(root_path)
+    self.journal = ChangeJournal()
+    self.watcher = create_watcher(self.root_path, self.journal,
+                                  poll_interval=poll_interval,
+                                  force_polling=force_polling)
+    self._watcher_thread = threading.Thread(target=self.watcher.run)
+    self._watcher_thread.daemon = True
+    self._watcher_thread.start()
+
+    self.state_path = os.path.join(self.root_path, STATE_FILE)
+    try:
+      os.makedirs(os.path.dirname(self.state_path))
+    except OSError:
+      pass
+    with open(self.state_path, 'w') as f:
+      f.write('%s %s\n' % (self.server_address[1], os.getpid()))
+
+  def server_close(self):
+    SocketServer.TCPServer.server_close(self)
+    self.watcher.stop()
+    self._watcher_thread.join()
+    self.watcher.close()
+    try:
+      os.remove(self.state_path)
+    except OSError:
+      pass
+
+
+def query_journal(root_path, since_clock=0, timeout=2):
+  """Queries the watch daemon of a project for changed paths.
+
+  Args:
+    root_path: Project root path.
+    since_clock: Clock value returned from a previous query, or 0.
+    timeout: Seconds to wait for the daemon to respond.
+
+  Returns:
+    A tuple of (journal_id, clock, paths) with the ID of the journal, its
+    current clock value and a list of absolute paths changed since the given
+    clock value (None if not known), or None if no daemon is running. Clock
+    values must only be compared when the journal IDs match.
+
+  Raises:
+    JournalError: The daemon could not be queried.
+  """
+  state_path = os.path.join(root_path, STATE_FILE)
+  try:
+    with open(state_path, 'r') as f:
+      port = int(f.read().split()[0])
+  except (IOError, ValueError, IndexError):
+    return None
+  try:
+    sock = socket.create_connection(('127.0.0.1', port), timeout)
+  except socket.error:
+    # Stale state file
+    return None
+  try:
+    _send_message(sock, since_clock)
+    result = _recv_message(sock)
+  except socket.error as e:
+    raise JournalError('Unable to query watchd: %s' % (e))
+  finally:
+    sock.close()
+  if not isinstance(result, tuple) or len(result) != 3:
+    raise JournalError('Invalid response from watchd')
+  return result
@@ -0,0 +1,156 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the journal module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import threading
+import time
+import unittest2
+
+from anvil.journal import (ChangeJournal, InotifyWatcher, PollingWatcher,
+                           WatchServer, query_journal)
+from anvil.test import FixtureTestCase
+
+
+class ChangeJournalTest(unittest2.TestCase):
+  """Behavioral tests of the ChangeJournal type."""
+
+  def testChanges(self):
+    journal = ChangeJournal()
+    self.assertEqual(journal.get_changes_since(0), (0, []))
+    journal.record([])
+    self.assertEqual(journal.clock, 0)
+    journal.record(['/a', '/b'])
+    self.assertEqual(journal.clock, 1)
+    (clock, paths) = journal.get_changes_since(0)
+    self.assertEqual(clock, 1)
+    self.assertEqual(set(paths), set(['/a', '/b']))
+    self.assertEqual(journal.get_changes_since(1), (1, []))
+
+    journal.record(['/a'])
+    journal.record(['/c'])
+    (clock, paths) = journal.get_changes_since(1)
+    self.assertEqual(clock, 3)
+    self.assertEqual(set(paths), set(['/a', '/c']))
+    (clock, paths) = journal.get_changes_since(2)
+    self.assertEqual(paths, ['/c'])
+
+  def testLimit(self):
+    journal = ChangeJournal(max_changes=2)
+    journal.record(['/a'])
+    journal.record(['/b'])
+    journal.record(['/c'])
+    self.assertEqual(journal.get_changes_since(0), (3, None))
+    self.assertEqual(set(journal.get_changes_since(1)[1]), set(['/b', '/c']))
+
+  def testReset(self):
+    journal = ChangeJournal()
+    journal.record(['/a'])
+    journal.reset()
+    self.assertEqual(journal.get_changes_since(1), (2, None))
+    self.assertEqual(journal.get_changes_since(2), (2, []))
+    self.assertNotEqual(journal.journal_id, ChangeJournal().journal_id)
+
+
+class WatcherTest(FixtureTestCase):
+  """Behavioral tests of the Watcher types."""
+  fixture = 'simple'
+
+  def _modify_tree(self):
+    with open(os.path.join(self.root_path, 'a.txt'), 'a') as f:
+      f.write('more')
+    with open(os.path.join(self.root_path, 'x.txt'), 'w') as f:
+      f.write('x')
+    os.remove(os.path.join(self.root_path, 'b.txt'))
+    os.mkdir(os.path.join(self.root_path, 'y'))
+    with open(os.path.join(self.root_path, 'y', 'z.txt'), 'w') as f:
+      f.write('z')
+    os.mkdir(os.path.join(self.root_path, '.build-cache'))
+    with open(os.path.join(self.root_path, '.build-cache', 'w.txt'), 'w') as f:
+      f.write('w')
+
+  def _assertChanges(self, journal):
+    (clock, paths) = journal.get_changes_since(0)
+    self.assertIsNotNone(paths)
+    for name in ['a.txt', 'x.txt', 'b.txt', 'y', 'y/z.txt']:
+      self.assertIn(os.path.join(self.root_path, name), paths)
+    self.assertNotIn(os.path.join(self.root_path, 'c.txt'), paths)
+    self.assertNotIn(os.path.join(self.root_path, '.build-cache', 'w.txt'),
+                     paths)
+
+  def testPolling(self):
+    journal = ChangeJournal()
+    # Changes are picked up by sync without waiting for the poll interval
+    watcher = PollingWatcher(self.root_path, journal, poll_interval=60)
+    watcher.sync()
+    self.assertEqual(journal.clock, 0)
+    # Fixture files may have been written within the mtime resolution
+    time.sleep(1.1)
+    self._modify_tree()
+    watcher.sync()
+    self._assertChanges(journal)
+
+  @unittest2.skipUnless(InotifyWatcher.is_supported(), 'inotify')
+  def testInotify(self):
+    journal = ChangeJournal()
+    watcher = InotifyWatcher(self.root_path, journal)
+    try:
+      watcher.sync()
+      self.assertEqual(journal.clock, 0)
+      self._modify_tree()
+      watcher.sync()
+      self._assertChanges(journal)
+
+      # Directories moved away are reported without their contents
+      os.rename(os.path.join(self.root_path, 'dir'),
+                os.path.join(self.root_path, '.build-cache', 'dir'))
+      (clock, paths) = journal.get_changes_since(journal.clock)
+      watcher.sync()
+      self.assertEqual(journal.get_changes_since(clock)[1],
+                       [os.path.join(self.root_path, 'dir')])
+    finally:
+      watcher.close()
+
+
+class WatchServerTest(FixtureTestCase):
+  """Behavioral tests of the WatchServer type."""
+  fixture = 'simple'
+
+  def testQuery(self):
+    self.assertIsNone(query_journal(self.root_path))
+
+    server = WatchServer(self.root_path, poll_interval=0.1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+      (journal_id, clock, paths) = query_journal(self.root_path)
+      self.assertEqual(journal_id, server.journal.journal_id)
+      self.assertEqual(paths, [])
+
+      time.sleep(1.1)
+      a_path = os.path.join(self.root_path, 'a.txt')
+      with open(a_path, 'a') as f:
+        f.write('more')
+      for n in xrange(50):
+        (journal_id, new_clock, paths) = query_journal(self.root_path,
+                                                       since_clock=clock)
+        if paths:
+          break
+        time.sleep(0.1)
+      self.assertIn(a_path, paths)
+      self.assertGreater(new_clock, clock)
+    finally:
+      server.shutdown()
+      server.server_close()
+    self.assertIsNone(query_journal(self.root_path))
+
+
+if __name__ == '__main__':
+  unittest2.main()
@@ -18,6 +18,7 @@ import sys
 
 sys.path.insert(1, os.path.join(os.path.dirname(__file__), '..'))
 
+from anvil import build_client
 from anvil import util
 
 
@@ -45,6 +46,8 @@ class ManageCommand(object):
     self.help_short = help_short
     self.help_long = help_long
     self.completion_hints = []
+    # Whether the command can be forwarded to a build server
+    self.supports_build_server = False
 
   def create_argument_parser(self):
     """Creates and sets up an argument parser.
@@ -63,6 +66,11 @@ class ManageCommand(object):
         '-j', '--jobs',
         '-f', '--force',
         '--stop_on_error',
+        '--max_tasks_per_worker',
+        '--max_worker_memory',
+        '--memory_budget',
+        '--jobserver',
+        '--remote_workers',
         ])
 
   def _add_common_build_arguments(self, parser, targets=False,
@@ -82,6 +90,41 @@ class ManageCommand(object):
                         help=('Specifies the number of tasks to run '
                               'simultaneously. If omitted then all processors '
                               'will be used.'))
+    parser.add_argument('--max_tasks_per_worker',
+                        dest='max_tasks_per_worker',
+                        type=int,
+                        default=None,
+                        help=('Number of tasks a worker process will run before '
+                              'being replaced. If omitted workers are never '
+                              'recycled.'))
+    parser.add_argument('--max_worker_memory',
+                        dest='max_worker_memory',
+                        type=int,
+                        default=None,
+                        help=('Resident memory, in MB, above which a worker '
+                              'process is replaced after its current task.'))
+    parser.add_argument('--memory_budget',
+                        dest='memory_budget',
+                        type=int,
+                        default=None,
+                        help=('Memory, in MB, that concurrently running tasks '
+                              'may declare in total. Heavy tasks (such as '
+                              'compilers) wait until enough is available.'))
+    parser.add_argument('--jobserver',
+                        dest='jobserver',
+                        action='store_true',
+                        default=False,
+                        help=('Serve a GNU make jobserver to child processes so '
+                              'that any make they run shares the -j limit. A '
+                              'jobserver inherited from a parent make is '
+                              'always used.'))
+    parser.add_argument('--remote_workers',
+                        dest='remote_workers',
+                        default=None,
+                        help=('Comma-separated host:port list of worker '
+                              'daemons (started with \'anvil worker\') to '
+                              'run tasks on. Tasks are run locally if no '
+                              'workers are reachable.'))
 
     # Build context control
     parser.add_argument('-f', '--force',
@@ -277,6 +320,15 @@ def main(): # pragma: no cover
   # Always add anvil/.. to the path
   sys.path.insert(1, util.get_anvil_path())
 
+  # Forward the command to a build server for this path, if one is running
+  # This skips all of the work below, so it must come first
+  if (len(sys.argv) >= 2 and
+      not 'ANVIL_AUTO_COMPLETE' in os.environ and
+      not os.environ.get('ANVIL_NO_BUILD_SERVER', None)):
+    return_code = build_client.run_in_server(sys.argv[1:], os.getcwd())
+    if return_code is not None:
+      sys.exit(return_code)
+
   # TODO(benvanik): if a command is specified try loading it first - may be
   #     able to avoid searching all commands
   search_paths = [os.path.join(util.get_anvil_path(), 'commands')]
@@ -109,14 +109,16 @@ class ModuleLoader(object):
   A loader should only be used to load a single module and then be discarded.
   """
 
-  def __init__(self, path, rule_namespace=None, modes=None):
+  def __init__(self, path, rule_namespace=None, modes=None, glob_cache=None):
     """Initializes a loader.
 
     Args:
       path: File-system path to the module.
       rule_namespace: Rule namespace to use for rule definitions.
+      glob_cache: GlobCache used to cache the results of glob(), if any.
     """
     self.path = path
+    self.glob_cache = glob_cache
     self.rule_namespace = rule_namespace
     if not self.rule_namespace:
       self.rule_namespace = RuleNamespace()
@@ -220,6 +222,8 @@ class ModuleLoader(object):
       return []
     base_path = os.path.dirname(self.path)
     glob_path = os.path.join(base_path, expr)
+    if self.glob_cache:
+      return self.glob_cache.glob(glob_path)
     return list(glob2.iglob(glob_path))
 
   def include_rules(self, srcs):
@@ -12,6 +12,7 @@ import glob2
 import os
 import unittest2
 
+from anvil.cache import GlobCache
 from anvil.module import *
 from anvil.rule import *
 from anvil.test import FixtureTestCase
@@ -275,6 +276,13 @@ class ModuleLoaderTest(FixtureTestCase):
     rule = module.get_rule(':a')
     self.assertEqual(len(rule.srcs), 0)
 
+    glob_cache = GlobCache()
+    loader = ModuleLoader(module_path, glob_cache=glob_cache)
+    loader.load(source_string='file_set("a", srcs=glob("**/*.txt"))')
+    module = loader.execute()
+    rule = module.get_rule(':a')
+    self.assertEqual(len(rule.srcs), 5)
+
 
 class ModuleLoaderIncludeTest(FixtureTestCase):
   """Behavioral tests for ModuleLoader include functionality."""
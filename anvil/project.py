@@ -238,11 +238,12 @@ class FileModuleResolver(ModuleResolver):
   treated as the module.
   """
 
-  def __init__(self, root_path, *args, **kwargs):
+  def __init__(self, root_path, glob_cache=None, *args, **kwargs):
     """Initializes a file-system module resolver.
 
     Args:
       root_path: Root filesystem path to treat as the base for all resolutions.
+      glob_cache: GlobCache used by loaded modules to cache glob() results.
 
     Raises:
       IOError: The given root path is not found or is not a directory.
@@ -250,6 +251,7 @@ class FileModuleResolver(ModuleResolver):
     super(FileModuleResolver, self).__init__(*args, **kwargs)
 
     self.can_resolve_local = True
+    self.glob_cache = glob_cache
 
     self.root_path = os.path.normpath(root_path)
     if not os.path.isdir(self.root_path):
@@ -274,6 +276,7 @@ class FileModuleResolver(ModuleResolver):
     return os.path.normpath(full_path)
 
   def load_module(self, full_path, rule_namespace):
-    module_loader = ModuleLoader(full_path, rule_namespace=rule_namespace)
+    module_loader = ModuleLoader(full_path, rule_namespace=rule_namespace,
+                                 glob_cache=self.glob_cache)
     module_loader.load()
     return module_loader.execute()
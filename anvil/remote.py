@@ -0,0 +1,719 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Distributed task execution.
+
+A RemoteTaskExecutor ships tasks to one or more worker daemons (started with
+'anvil worker') over TCP. Tasks are pickled with every path under the build root
+rewritten, so that the worker can run them in a private workspace. Any existing
+files referenced by a task are sent to the worker by content digest, only if the
+worker does not already have them, and any files the task creates or modifies in
+the workspace are sent back and written to the build root.
+
+Workers must have the same tools (and anvil version) installed as the client,
+as only files under the build root are transferred.
+
+The protocol uses pickle and must only be used on trusted networks.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import cPickle
+import cStringIO
+import hashlib
+import multiprocessing
+import os
+import Queue
+import re
+import shutil
+import socket
+import SocketServer
+import stat
+import struct
+import tempfile
+import threading
+import time
+import traceback
+
+from anvil.async import Deferred, DeferredCancelledError
+from anvil.task import (InProcessTaskExecutor, TaskExecutor, TaskResourceUsage,
+                        _execute_measured, _task_initializer)
+
+
+# Bumped whenever the messages below change in incompatible ways
+PROTOCOL_VERSION = 1
+
+DEFAULT_PORT = 8090
+
+
+class RemoteError(Exception):
+  """An error communicating with a worker daemon.
+  """
+  pass
+
+
+def _send_message(sock, message):
+  """Sends a message over a socket.
+
+  Args:
+    sock: Connected socket.
+    message: A picklable tuple, with the message type as the first item.
+  """
+  data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+  sock.sendall(struct.pack('!I', len(data)) + data)
+
+
+def _recv_exactly(sock, length):
+  chunks = []
+  while length:
+    chunk = sock.recv(min(length, 1024 * 1024))
+    if not chunk:
+      raise RemoteError('Connection closed')
+    chunks.append(chunk)
+    length -= len(chunk)
+  return ''.join(chunks)
+
+
+def _recv_message(sock):
+  """Receives a message sent with _send_message.
+
+  Args:
+    sock: Connected socket.
+
+  Returns:
+    The message tuple.
+
+  Raises:
+    RemoteError: The connection was closed.
+  """
+  (length,) = struct.unpack('!I', _recv_exactly(sock, 4))
+  return cPickle.loads(_recv_exactly(sock, length))
+
+
+def _root_regex(root_path):
+  # Only match the root as a whole path component, and not /foo/bar in /foo/bar2
+  return re.compile(re.escape(root_path) + r'(?=$|[\\/\x00\s])')
+
+
+def dumps_rooted(value, root_path):
+  """Pickles a value, making all paths under a root path relative.
+  Any string containing the root path is affected, including lists of paths
+  packed into one string (such as PackedPathList) and command line arguments.
+
+  Args:
+    value: Value to pickle.
+    root_path: Absolute root path.
+
+  Returns:
+    A (data, paths) tuple, where data is the pickled value and paths is a set of
+    all absolute paths under the root that the value referenced.
+  """
+  regex = _root_regex(root_path)
+  paths = set()
+  def _persistent_id(obj):
+    if not isinstance(obj, basestring) or root_path not in obj:
+      return None
+    parts = regex.split(obj)
+    if len(parts) == 1:
+      return None
+    for part in parts[1:]:
+      # Paths end at the end of the string or the next packed item
+      paths.add(root_path + re.split(r'[\x00\s]', part, 1)[0])
+    return ('rooted', type(obj) is unicode, tuple(parts))
+  f = cStringIO.StringIO()
+  pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+  pickler.persistent_id = _persistent_id
+  pickler.dump(value)
+  return (f.getvalue(), paths)
+
+
+def loads_rooted(data, root_path):
+  """Unpickles a value pickled with dumps_rooted, relative to a new root.
+
+  Args:
+    data: Pickled data from dumps_rooted.
+    root_path: Absolute root path to rebase all paths on.
+
+  Returns:
+    The unpickled value.
+  """
+  def _persistent_load(pid):
+    (kind, is_unicode, parts) = pid
+    if kind != 'rooted':
+      raise cPickle.UnpicklingError('Unknown persistent id %s' % (kind))
+    value = root_path.join(parts)
+    return unicode(value) if is_unicode else value
+  unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+  unpickler.persistent_load = _persistent_load
+  return unpickler.load()
+
+
+def _hash_file(path):
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    while True:
+      chunk = f.read(1024 * 1024)
+      if not chunk:
+        break
+      digest.update(chunk)
+  return digest.hexdigest()
+
+
+def _parse_address(address):
+  """Parses a worker address.
+
+  Args:
+    address: A 'host:port' string, 'host' string or (host, port) tuple.
+
+  Returns:
+    A (host, port) tuple.
+  """
+  if not isinstance(address, basestring):
+    return tuple(address)
+  if ':' in address:
+    (host, port) = address.rsplit(':', 1)
+    return (host, int(port))
+  return (address, DEFAULT_PORT)
+
+
+class _RemoteJob(object):
+  """A task queued for remote execution.
+  """
+
+  def __init__(self, deferred, task, task_data, paths):
+    self.deferred = deferred
+    self.task = task
+    self.task_data = task_data
+    self.paths = paths
+    self.attempts = 0
+
+
+class RemoteTaskExecutor(TaskExecutor):
+  """A task executor that runs tasks on remote worker daemons.
+  One connection is made for every slot a worker advertises, and each connection
+  runs one task at a time, so tasks are balanced across workers by how quickly
+  they complete them.
+
+  A task whose worker fails (such as by disconnecting) is retried on another
+  worker. Once it has been tried max_retries times, or if no workers are
+  reachable, it is run on the local fallback executor instead. Failures of the
+  task itself are not retried.
+
+  Resource budgets and jobservers are not applied to remote tasks - each worker
+  daemon limits its own parallelism.
+  """
+
+  def __init__(self, worker_addresses, max_retries=2, fallback_executor=None,
+               connect_timeout=5, *args, **kwargs):
+    """Initializes a task executor.
+    This connects to all workers, and may take a bit to run.
+
+    Args:
+      worker_addresses: A list of worker addresses, as 'host:port' strings or
+          (host, port) tuples.
+      max_retries: Number of times a task is tried on workers before falling
+          back to local execution.
+      fallback_executor: TaskExecutor used to run tasks locally. It is owned by
+          this executor and closed with it. If omitted an InProcessTaskExecutor
+          is used.
+      connect_timeout: Time, in seconds, to wait when connecting to a worker.
+    """
+    super(RemoteTaskExecutor, self).__init__(*args, **kwargs)
+    self.max_retries = max_retries
+    self.connect_timeout = connect_timeout
+    self._fallback_executor = fallback_executor or InProcessTaskExecutor()
+    self._lock = threading.Lock()
+    self._queue = Queue.Queue()
+    # All jobs that have not completed
+    self._jobs = set()
+
+    # Digests of local files, keyed by path and validated by (mtime, size)
+    self._digest_cache = {}
+
+    self._slot_threads = []
+    self._live_slot_count = 0
+    for address in worker_addresses:
+      self._connect_worker(_parse_address(address))
+
+  def _connect(self, address):
+    """Connects to a worker and performs a handshake.
+
+    Args:
+      address: (host, port) tuple.
+
+    Returns:
+      A (socket, slot_count) tuple.
+
+    Raises:
+      RemoteError: The worker could not be used.
+    """
+    try:
+      sock = socket.create_connection(address, self.connect_timeout)
+      sock.settimeout(None)
+      sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+      _send_message(sock, ('hello', PROTOCOL_VERSION))
+      (_, version, slot_count) = _recv_message(sock)
+    except (socket.error, RemoteError) as e:
+      raise RemoteError('Unable to connect to worker %s:%s: %s' % (
+          address[0], address[1], e))
+    if version != PROTOCOL_VERSION:
+      sock.close()
+      raise RemoteError('Worker %s:%s uses protocol %s, expected %s' % (
+          address[0], address[1], version, PROTOCOL_VERSION))
+    return (sock, slot_count)
+
+  def _connect_worker(self, address):
+    """Opens a connection for each slot of a worker.
+    Unreachable workers are ignored.
+
+    Args:
+      address: (host, port) tuple.
+    """
+    try:
+      (sock, slot_count) = self._connect(address)
+      socks = [sock]
+      for n in xrange(slot_count - 1):
+        socks.append(self._connect(address)[0])
+    except RemoteError as e:
+      print e
+      return
+    for sock in socks:
+      thread = threading.Thread(target=self._slot_thread_main,
+                                args=(address, sock),
+                                name='RemoteSlotThread')
+      thread.daemon = True
+      self._slot_threads.append(thread)
+      self._live_slot_count += 1
+      thread.start()
+
+  def run_task_async(self, task):
+    if self.closed:
+      raise RuntimeError('Executor has been closed and cannot run new tasks')
+
+    deferred = Deferred()
+    root_path = task.build_env.root_path
+    (task_data, paths) = dumps_rooted(task, root_path)
+    job = _RemoteJob(deferred, task, task_data, paths)
+    with self._lock:
+      self._running_count += 1
+      self._jobs.add(job)
+      if self._live_slot_count:
+        self._queue.put(job)
+        return deferred
+    self._run_fallback(job)
+    return deferred
+
+  def _complete_job(self, job, succeeded, result, usage):
+    """Signals the deferred of a completed job.
+
+    Args:
+      job: _RemoteJob that completed.
+      succeeded: True if the task succeeded.
+      result: Task result, or the exception it raised.
+      usage: TaskResourceUsage, or None if not known.
+    """
+    with self._lock:
+      if job not in self._jobs:
+        # Cancelled
+        return
+      self._jobs.remove(job)
+      self._running_count -= 1
+    if usage:
+      self.resource_usage.append(usage)
+    if succeeded:
+      job.deferred.callback(result)
+    else:
+      job.deferred.errback(exception=result)
+
+  def _run_fallback(self, job):
+    """Runs a job on the local fallback executor.
+
+    Args:
+      job: _RemoteJob to run.
+    """
+    deferred = self._fallback_executor.run_task_async(job.task)
+    def _callback(*args, **kwargs):
+      self._complete_job(job, True, args[0] if args else None, None)
+    def _errback(exception=None, *args, **kwargs):
+      self._complete_job(job, False, exception, None)
+    deferred.add_callback_fn(_callback)
+    deferred.add_errback_fn(_errback)
+
+  def _build_manifest(self, job):
+    """Finds the files and directories a job references.
+
+    Args:
+      job: _RemoteJob to inspect.
+
+    Returns:
+      A (files, dirs) tuple. files is a list of (relative path, digest, mode)
+      tuples for existing files and dirs a list of relative directory paths
+      that must exist.
+    """
+    root_path = job.task.build_env.root_path
+    files = []
+    dirs = set()
+    for path in job.paths:
+      rel_path = os.path.relpath(path, root_path)
+      if rel_path.startswith(os.pardir):
+        continue
+      try:
+        st = os.stat(path)
+      except OSError:
+        # Likely an output - ensure its parent exists like it does here
+        parent_path = os.path.dirname(path)
+        if rel_path != os.curdir and os.path.isdir(parent_path):
+          dirs.add(os.path.relpath(parent_path, root_path))
+        continue
+      if stat.S_ISDIR(st.st_mode):
+        dirs.add(rel_path)
+      elif stat.S_ISREG(st.st_mode):
+        files.append((rel_path, self._get_digest(path, st), st.st_mode))
+    return (files, sorted(dirs))
+
+  def _get_digest(self, path, st):
+    key = (st.st_mtime, st.st_size)
+    with self._lock:
+      entry = self._digest_cache.get(path, None)
+    if entry and entry[0] == key:
+      return entry[1]
+    digest = _hash_file(path)
+    with self._lock:
+      self._digest_cache[path] = (key, digest)
+    return digest
+
+  def _run_remote(self, sock, job):
+    """Runs a job on a worker.
+
+    Args:
+      sock: Socket connected to the worker.
+      job: _RemoteJob to run.
+
+    Returns:
+      A (succeeded, result, usage) tuple.
+
+    Raises:
+      RemoteError: Communication with the worker failed.
+      socket.error: Communication with the worker failed.
+    """
+    root_path = job.task.build_env.root_path
+    (files, dirs) = self._build_manifest(job)
+
+    # Upload any files the worker is missing
+    paths_by_digest = {}
+    for (rel_path, digest, mode) in files:
+      paths_by_digest[digest] = os.path.join(root_path, rel_path)
+    _send_message(sock, ('have', paths_by_digest.keys()))
+    (_, missing_digests) = _recv_message(sock)
+    for digest in missing_digests:
+      with open(paths_by_digest[digest], 'rb') as f:
+        _send_message(sock, ('put', digest, f.read()))
+
+    _send_message(sock, ('run', job.task_data, files, dirs))
+    message = _recv_message(sock)
+    if message[0] == 'error':
+      raise RemoteError(message[1])
+    (_, result_data, outputs) = message
+
+    # Write back outputs
+    for (rel_path, contents, mode) in outputs:
+      path = os.path.join(root_path, rel_path)
+      parent_path = os.path.dirname(path)
+      if not os.path.isdir(parent_path):
+        os.makedirs(parent_path)
+      with open(path, 'wb') as f:
+        f.write(contents)
+      os.chmod(path, stat.S_IMODE(mode))
+
+    return loads_rooted(result_data, root_path)
+
+  def _slot_thread_main(self, address, sock):
+    """Runs queued jobs on a connection to a worker until closed.
+
+    Args:
+      address: (host, port) of the worker.
+      sock: Socket connected to the worker.
+    """
+    while True:
+      job = self._queue.get()
+      if job is None:
+        break
+      job.attempts += 1
+      try:
+        (succeeded, result, usage) = self._run_remote(sock, job)
+      except (socket.error, RemoteError, EnvironmentError) as e:
+        print 'Worker %s:%s failed running %s: %s' % (
+            address[0], address[1], job.task.pretty_name, e)
+        self._retry_job(job)
+        break
+      except Exception as e:
+        # Results that cannot be unpickled/etc
+        self._complete_job(job, False, e, None)
+        continue
+      self._complete_job(job, succeeded, result, usage)
+
+    try:
+      sock.close()
+    except socket.error: # pragma: no cover
+      pass
+
+    # If this was the last connection nothing will ever take jobs from the
+    # queue, so run them locally
+    with self._lock:
+      self._live_slot_count -= 1
+      orphaned_jobs = []
+      if not self._live_slot_count:
+        while True:
+          try:
+            job = self._queue.get_nowait()
+          except Queue.Empty:
+            break
+          if job:
+            orphaned_jobs.append(job)
+    for job in orphaned_jobs:
+      self._run_fallback(job)
+
+  def _retry_job(self, job):
+    """Requeues a job whose worker failed, or runs it locally.
+
+    Args:
+      job: _RemoteJob that failed.
+    """
+    with self._lock:
+      # The failing slot is still counted as live here
+      if job.attempts < self.max_retries and self._live_slot_count > 1:
+        self._queue.put(job)
+        return
+    self._run_fallback(job)
+
+  def wait(self, deferreds):
+    try:
+      iter(deferreds)
+    except:
+      deferreds = [deferreds]
+    for deferred in deferreds:
+      while not deferred.is_done():
+        time.sleep(0.01)
+
+  def cancel_all(self):
+    # Tasks already running on workers cannot be interrupted, but their results
+    # are ignored
+    with self._lock:
+      cancelled_jobs = list(self._jobs)
+      self._jobs.clear()
+      self._running_count = 0
+      while True:
+        try:
+          self._queue.get_nowait()
+        except Queue.Empty:
+          break
+    self._fallback_executor.cancel_all()
+    for job in cancelled_jobs:
+      if not job.deferred.is_done():
+        job.deferred.errback(exception=DeferredCancelledError())
+
+  def release_shared_state(self):
+    self._fallback_executor.release_shared_state()
+
+  def close(self, graceful=True):
+    if self.closed:
+      raise RuntimeError(
+          'Attempting to close an executor that has already been closed')
+    self.closed = True
+    if graceful:
+      while self.has_any_running():
+        time.sleep(0.01)
+    for thread in self._slot_threads:
+      self._queue.put(None)
+    if graceful:
+      for thread in self._slot_threads:
+        thread.join()
+    self._slot_threads = []
+    self._fallback_executor.close(graceful=graceful)
+    self._running_count = 0
+
+
+class WorkerServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+  """A worker daemon that executes tasks for RemoteTaskExecutors.
+  Each connection is given a private workspace that its tasks run in, and tasks
+  are executed on a shared process pool.
+  """
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, work_path=None, worker_count=None):
+    """Initializes a worker server and starts listening.
+
+    Args:
+      address: (host, port) to listen on. Use port 0 to pick any free port.
+      work_path: Path to store files and workspaces in. If omitted a temporary
+          path is used and removed when the server is closed.
+      worker_count: Number of tasks to run at once. None to use as many
+          processors as are available.
+    """
+    SocketServer.TCPServer.__init__(self, address, _WorkerRequestHandler)
+    self.owns_work_path = not work_path
+    self.work_path = work_path or tempfile.mkdtemp(prefix='anvil-worker-')
+    self.object_path = os.path.join(self.work_path, 'objects')
+    self.workspace_path = os.path.join(self.work_path, 'workspaces')
+    for path in [self.object_path, self.workspace_path]:
+      if not os.path.isdir(path):
+        os.makedirs(path)
+    self.worker_count = worker_count or multiprocessing.cpu_count()
+    self.pool = multiprocessing.Pool(processes=self.worker_count,
+                                     initializer=_task_initializer)
+
+  def get_object_path(self, digest):
+    return os.path.join(self.object_path, digest)
+
+  def server_close(self):
+    SocketServer.TCPServer.server_close(self)
+    self.pool.terminate()
+    self.pool.join()
+    if self.owns_work_path:
+      shutil.rmtree(self.work_path, ignore_errors=True)
+
+
+class _WorkerRequestHandler(SocketServer.BaseRequestHandler):
+  """Handles a connection from a RemoteTaskExecutor.
+  """
+
+  def setup(self):
+    self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.workspace = None
+    # Digests of the files written to the workspace, by relative path
+    self.materialized = {}
+
+  def finish(self):
+    if self.workspace:
+      shutil.rmtree(self.workspace, ignore_errors=True)
+
+  def handle(self):
+    server = self.server
+    sock = self.request
+    while True:
+      try:
+        message = _recv_message(sock)
+      except (socket.error, RemoteError):
+        return
+      try:
+        if message[0] == 'hello':
+          _send_message(sock, ('hello', PROTOCOL_VERSION, server.worker_count))
+        elif message[0] == 'have':
+          missing_digests = [digest for digest in message[1]
+                             if not os.path.isfile(
+                                 server.get_object_path(digest))]
+          _send_message(sock, ('missing', missing_digests))
+        elif message[0] == 'put':
+          self._store_object(message[1], message[2])
+        elif message[0] == 'run':
+          _send_message(sock, self._run_task(*message[1:]))
+        else:
+          _send_message(sock, ('error', 'Unknown message %s' % (message[0])))
+          return
+      except socket.error:
+        return
+      except Exception as e:
+        traceback.print_exc()
+        try:
+          _send_message(sock, ('error', str(e)))
+        except socket.error:
+          pass
+        return
+
+  def _store_object(self, digest, contents):
+    """Adds a file to the object store.
+
+    Args:
+      digest: Digest of the file contents.
+      contents: File contents.
+    """
+    if hashlib.sha1(contents).hexdigest() != digest:
+      raise RemoteError('Object digest mismatch')
+    # Write to a temp file and move, so other connections never see partial
+    # files
+    (fd, temp_path) = tempfile.mkstemp(dir=self.server.object_path)
+    with os.fdopen(fd, 'wb') as f:
+      f.write(contents)
+    os.rename(temp_path, self.server.get_object_path(digest))
+
+  def _snapshot_workspace(self):
+    snapshot = {}
+    for (dirpath, dirnames, filenames) in os.walk(self.workspace):
+      for filename in filenames:
+        path = os.path.join(dirpath, filename)
+        st = os.stat(path)
+        snapshot[path] = (st.st_mtime, st.st_size)
+    return snapshot
+
+  def _run_task(self, task_data, files, dirs):
+    """Runs a task in the workspace of this connection.
+
+    Args:
+      task_data: Task pickled with dumps_rooted.
+      files: (relative path, digest, mode) tuples of files to provide.
+      dirs: Relative paths of directories to provide.
+
+    Returns:
+      A result message.
+    """
+    if not self.workspace:
+      self.workspace = tempfile.mkdtemp(dir=self.server.workspace_path)
+    for rel_path in dirs:
+      path = os.path.join(self.workspace, rel_path)
+      if not os.path.isdir(path):
+        os.makedirs(path)
+    for (rel_path, digest, mode) in files:
+      if self.materialized.get(rel_path, None) == digest:
+        continue
+      path = os.path.join(self.workspace, rel_path)
+      parent_path = os.path.dirname(path)
+      if not os.path.isdir(parent_path):
+        os.makedirs(parent_path)
+      # Copied instead of linked, as tasks may modify files in place
+      shutil.copyfile(self.server.get_object_path(digest), path)
+      os.chmod(path, stat.S_IMODE(mode))
+      self.materialized[rel_path] = digest
+
+    # Anything new or changed after running is an output
+    before = self._snapshot_workspace()
+    result_data = self.server.pool.apply(_remote_task_thunk,
+                                         [task_data, self.workspace])
+    after = self._snapshot_workspace()
+    outputs = []
+    for (path, key) in after.items():
+      if before.get(path, None) == key:
+        continue
+      with open(path, 'rb') as f:
+        contents = f.read()
+      rel_path = os.path.relpath(path, self.workspace)
+      outputs.append((rel_path, contents, os.stat(path).st_mode))
+      self.materialized.pop(rel_path, None)
+    return ('result', result_data, outputs)
+
+
+def _remote_task_thunk(task_data, workspace): # pragma: no cover
+  """Thunk for executing tasks on a WorkerServer process pool.
+
+  Args:
+    task_data: Task pickled with dumps_rooted.
+    workspace: Workspace path to use as the task root path.
+
+  Returns:
+    A (succeeded, result, usage) tuple, pickled with dumps_rooted.
+  """
+  try:
+    task = loads_rooted(task_data, workspace)
+  except Exception as e:
+    thunk_result = (False, e, TaskResourceUsage('?', worker_pid=os.getpid()))
+  else:
+    thunk_result = _execute_measured(task)
+  try:
+    return dumps_rooted(thunk_result, workspace)[0]
+  except Exception as e:
+    # Unpicklable results/exceptions
+    (succeeded, result, usage) = thunk_result
+    return dumps_rooted(
+        (False, RuntimeError('Unable to return task result: %s' % (result)),
+         usage), workspace)[0]
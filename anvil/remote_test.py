@@ -0,0 +1,200 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the remote module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import socket
+import threading
+import unittest2
+
+from anvil.context import BuildEnvironment
+from anvil.remote import (PROTOCOL_VERSION, RemoteError, RemoteTaskExecutor,
+                          WorkerServer, dumps_rooted, loads_rooted,
+                          _recv_message, _send_message)
+from anvil.task import PackedPathList, Task
+from anvil.test import FixtureTestCase
+
+
+class _ConcatTask(Task):
+  def __init__(self, build_env, src_paths, output_path, *args, **kwargs):
+    super(_ConcatTask, self).__init__(build_env, *args, **kwargs)
+    self.src_paths = PackedPathList(src_paths)
+    self.output_path = output_path
+
+  def execute(self):
+    with open(self.output_path, 'w') as f:
+      for src_path in self.src_paths:
+        with open(src_path, 'r') as src_file:
+          f.write(src_file.read())
+    return (self.output_path, os.getpid())
+
+
+class _FailureTask(Task):
+  def execute(self):
+    raise TypeError('Failed!')
+
+
+class RootedPickleTest(unittest2.TestCase):
+  """Behavioral tests of rooted pickling."""
+
+  def testRoundTrip(self):
+    value = {
+        'path': '/a/b/c.txt',
+        'root': '/a/b',
+        'other': '/a/bc/d.txt',
+        'args': ['--js=/a/b/e.js', u'/a/b/f.js'],
+        'packed': '/a/b/g.js\x00/a/b/h.js',
+        }
+    (data, paths) = dumps_rooted(value, '/a/b')
+    self.assertEqual(paths, set([
+        '/a/b/c.txt', '/a/b', '/a/b/e.js', '/a/b/f.js', '/a/b/g.js',
+        '/a/b/h.js']))
+    self.assertEqual(loads_rooted(data, '/a/b'), value)
+    self.assertEqual(loads_rooted(data, '/x'), {
+        'path': '/x/c.txt',
+        'root': '/x',
+        'other': '/a/bc/d.txt',
+        'args': ['--js=/x/e.js', u'/x/f.js'],
+        'packed': '/x/g.js\x00/x/h.js',
+        })
+    self.assertIsInstance(loads_rooted(data, '/x')['args'][1], unicode)
+
+
+class RemoteTaskExecutorTest(FixtureTestCase):
+  """Behavioral tests of the RemoteTaskExecutor type."""
+  fixture = 'simple'
+
+  def setUp(self):
+    super(RemoteTaskExecutorTest, self).setUp()
+    self.build_env = BuildEnvironment(root_path=self.root_path)
+    self.output_path = os.path.join(self.root_path, 'build-out')
+    os.makedirs(self.output_path)
+
+  def _start_worker(self, worker_count=2):
+    server = WorkerServer(('127.0.0.1', 0), worker_count=worker_count)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    def _stop_worker():
+      server.shutdown()
+      server.server_close()
+    self.addCleanup(_stop_worker)
+    return server
+
+  def _get_unused_address(self):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+  def _concat_task(self, name, src_names):
+    return _ConcatTask(self.build_env,
+                       [os.path.join(self.root_path, src_name)
+                        for src_name in src_names],
+                       os.path.join(self.output_path, name))
+
+  def testRemote(self):
+    workers = [self._start_worker(), self._start_worker()]
+    addresses = ['%s:%s' % (worker.server_address) for worker in workers]
+    with RemoteTaskExecutor(addresses) as executor:
+      ds = [executor.run_task_async(self._concat_task('ab%s' % (n),
+                                                      ['a.txt', 'b.txt']))
+            for n in xrange(8)]
+      executor.wait(ds)
+      self.assertFalse(executor.has_any_running())
+      for n in xrange(8):
+        path = os.path.join(self.output_path, 'ab%s' % (n))
+        self.assertFileContents(path, 'hello!\nworld!\n')
+        # Result paths are relative to the local root
+        result = []
+        ds[n].add_callback_fn(lambda value: result.append(value))
+        self.assertEqual(result[0][0], path)
+        self.assertNotEqual(result[0][1], os.getpid())
+      self.assertEqual(len(executor.resource_usage), 8)
+
+      d = executor.run_task_async(_FailureTask(self.build_env))
+      executor.wait(d)
+      self.assertErrbackWithError(d, TypeError)
+
+    # Each input is only uploaded once per worker
+    for worker in workers:
+      object_count = len(os.listdir(worker.object_path))
+      self.assertLessEqual(object_count, 2)
+
+  def _start_broken_worker(self):
+    """Starts a worker that accepts connections and drops them on first use.
+    """
+    listen_sock = socket.socket()
+    listen_sock.bind(('127.0.0.1', 0))
+    listen_sock.listen(5)
+    def _accept_main():
+      while True:
+        try:
+          (sock, address) = listen_sock.accept()
+        except socket.error:
+          break
+        _recv_message(sock)
+        _send_message(sock, ('hello', PROTOCOL_VERSION, 1))
+        def _drop_main(sock=sock):
+          try:
+            _recv_message(sock)
+          except RemoteError:
+            pass
+          sock.close()
+        threading.Thread(target=_drop_main).start()
+    thread = threading.Thread(target=_accept_main)
+    thread.daemon = True
+    thread.start()
+    self.addCleanup(listen_sock.close)
+    return listen_sock.getsockname()
+
+  def testRetry(self):
+    worker = self._start_worker()
+    addresses = [self._start_broken_worker(), worker.server_address]
+    with RemoteTaskExecutor(addresses) as executor:
+      ds = [executor.run_task_async(self._concat_task('ab%s' % (n),
+                                                      ['a.txt', 'b.txt']))
+            for n in xrange(4)]
+      executor.wait(ds)
+      for n in xrange(4):
+        result = []
+        ds[n].add_callback_fn(lambda value: result.append(value))
+        self.assertNotEqual(result[0][1], os.getpid())
+        path = os.path.join(self.output_path, 'ab%s' % (n))
+        self.assertFileContents(path, 'hello!\nworld!\n')
+
+    # With no usable workers everything runs locally
+    addresses = [self._start_broken_worker()]
+    with RemoteTaskExecutor(addresses) as executor:
+      ds = [executor.run_task_async(self._concat_task('bc%s' % (n),
+                                                      ['b.txt', 'c.txt']))
+            for n in xrange(4)]
+      executor.wait(ds)
+      for n in xrange(4):
+        result = []
+        ds[n].add_callback_fn(lambda value: result.append(value))
+        self.assertEqual(result[0][1], os.getpid())
+        self.assertFileContents(
+            os.path.join(self.output_path, 'bc%s' % (n)), 'world!\n!!!\n')
+
+  def testFallback(self):
+    addresses = [self._get_unused_address()]
+    with RemoteTaskExecutor(addresses) as executor:
+      d = executor.run_task_async(self._concat_task('ab', ['a.txt', 'b.txt']))
+      executor.wait(d)
+      result = []
+      d.add_callback_fn(lambda value: result.append(value))
+      self.assertEqual(result[0][1], os.getpid())
+    path = os.path.join(self.output_path, 'ab')
+    self.assertFileContents(path, 'hello!\nworld!\n')
+
+
+if __name__ == '__main__':
+  unittest2.main()
@@ -29,7 +29,9 @@ class Rule(object):
 
   Sources can also refer to files, folders, or file globs. When a rule goes to
   run a list of sources will be compiled from the outputs from the previous
-  rules as well as all real files on the file system.
+  rules as well as all real files on the file system. Folders are expanded to
+  the files and folders they directly contain, or to all files beneath them if
+  the path ends with a slash ('some/folder/').
 
   Rules must define a _Context class that extends RuleContext. This context
   will be used when executing the rule to store any temporary state and
@@ -40,7 +42,8 @@ class Rule(object):
   _whitespace_re = re.compile('\s', re.M)
 
   def __init__(self, name, srcs=None, deps=None, src_filter=None,
-               src_exclude_filter=None, rule_name=None, *args, **kwargs):
+               src_exclude_filter=None, resource_weights=None, rule_name=None,
+               *args, **kwargs):
     """Initializes a rule.
 
     Args:
@@ -53,6 +56,8 @@ class Rule(object):
       src_exclude_filter: An exclusionary file name filter for all non-rule
           paths. If defined only srcs that do not match this filter will be
           included.
+      resource_weights: A dictionary of resource weights applied to all tasks
+          the rule runs, such as {'memory': 2048}. See Task.resource_weights.
       rule_name: Name of the rule in BUILD files, making it easier to debug.
 
     Raises:
@@ -103,6 +108,16 @@ class Rule(object):
     self.src_exclude_filter = None
     if src_exclude_filter and len(src_exclude_filter):
       self.src_exclude_filter = src_exclude_filter
+    # Filters are matched against every source file, so compile them once
+    self.src_filter_regex = util.compile_filename_filter(self.src_filter)
+    self.src_exclude_filter_regex = util.compile_filename_filter(
+        self.src_exclude_filter)
+
+    self.resource_weights = None
+    if resource_weights:
+      if not isinstance(resource_weights, dict):
+        raise TypeError('Invalid resource_weights type')
+      self.resource_weights = dict(resource_weights)
 
   def __repr__(self):
     return '%s(%s)' % (self.rule_name, self.path)
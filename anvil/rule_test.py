@@ -196,6 +196,14 @@ class RuleTest(unittest2.TestCase):
     rule = Rule('a', src_exclude_filter='*.js')
     self.assertEqual(rule.src_exclude_filter, '*.js')
 
+  def testRuleResourceWeights(self):
+    rule = Rule('a')
+    self.assertIsNone(rule.resource_weights)
+    rule = Rule('a', resource_weights={'memory': 2048})
+    self.assertEqual(rule.resource_weights, {'memory': 2048})
+    with self.assertRaises(TypeError):
+      Rule('a', resource_weights=2048)
+
 
 class RuleNamespaceTest(FixtureTestCase):
   """Behavioral tests of the Rule type."""
@@ -15,7 +15,7 @@ import zipfile
 import anvil.util
 from anvil.context import RuleContext
 from anvil.rule import Rule, build_rule
-from anvil.task import Task
+from anvil.task import Task, PackedPathList
 
 
 @build_rule('archive_files')
@@ -79,7 +79,7 @@ class ArchiveFilesRule(Rule):
 class _ArchiveFilesTask(Task):
   def __init__(self, build_env, paths, output_path, *args, **kwargs):
     super(_ArchiveFilesTask, self).__init__(build_env, *args, **kwargs)
-    self.paths = paths
+    self.paths = PackedPathList(paths, width=2)
     self.output_path = output_path
 
   def execute(self):
@@ -13,17 +13,31 @@ Assumes Closure Linter is installed and on the path.
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import hashlib
 import io
 import os
 import re
 
+from anvil import async
+from anvil.cache import FileScanCache, ResultCache
 from anvil.context import RuleContext
 from anvil.rule import Rule, build_rule
-from anvil.task import (Task, ExecutableTask, JavaExecutableTask,
-    WriteFileTask)
+from anvil.task import (Task, ExecutableError, ExecutableTask,
+    JavaExecutableTask, PackedPathList, WriteFileTask)
 import anvil.util
 
 
+# Number of files scanned by each dependency scanning task
+_SCAN_SHARD_SIZE = 256
+
+# Number of files linted by each linter process
+_LINT_SHARD_SIZE = 32
+
+# DepsJsTables by deps.js path, kept for as long as the process (such as a build
+# server) is running
+_deps_js_tables = {}
+
+
 @build_rule('closure_js_lint')
 class ClosureJsLintRule(Rule):
   """A set of linted JS files.
@@ -33,6 +47,10 @@ class ClosureJsLintRule(Rule):
   before being passed on as outputs. If a src_filter is provided then it is used
   to filter all sources.
 
+  Files are linted in parallel shards. Files that passed are remembered by
+  their contents and the linter flags, so only new, changed or failing files
+  are linted again.
+
   Inputs:
     srcs: Source JS file paths.
     namespaces: A list of Closurized namespaces.
@@ -90,18 +108,64 @@ class ClosureJsLintRule(Rule):
                 'closure_linter/%s.py' % (self.rule._command)),
             ] + args
 
-      # TODO(benvanik): only changed paths
       # Exclude any path containing build-*
-      for src_path in self.file_delta.changed_files:
-        if (src_path.find('build-out%s' % os.sep) == -1 and
-            src_path.find('build-gen%s' % os.sep) == -1):
-          args.append(src_path)
+      src_paths = [src_path for src_path in self.src_paths
+                   if (src_path.find('build-out%s' % os.sep) == -1 and
+                       src_path.find('build-gen%s' % os.sep) == -1)]
+
+      # Only lint files that have not passed with the same contents and flags
+      file_caches = _JsFileCaches.get(self.build_context)
+      digest_cache = file_caches.digest_cache
+      result_cache = file_caches.get_result_cache(
+          'jslint-%s' % (self.rule._command))
+      flags_digest = hashlib.md5(repr((command, args, env))).hexdigest()
+      lint_keys = {}
+      for src_path in src_paths:
+        try:
+          digest = digest_cache.scan(src_path, _compute_digest)
+        except (IOError, OSError):
+          digest = None
+        lint_key = '%s-%s' % (digest, flags_digest)
+        if (self.build_context.force or not digest or
+            not result_cache.get(src_path, lint_key)):
+          lint_keys[src_path] = lint_key
+      lint_paths = [src_path for src_path in src_paths
+                    if src_path in lint_keys]
+      if not lint_paths:
+        self._succeed()
+        return
 
-      d = self._run_task_async(ExecutableTask(
-          self.build_env, command, args, env=env,
-          pretty_name=str(self.rule)))
-      # TODO(benvanik): pull out errors?
-      self._chain(d)
+      shards = [lint_paths[n:n + _LINT_SHARD_SIZE]
+                for n in range(0, len(lint_paths), _LINT_SHARD_SIZE)]
+      ds = [self._run_task_async(_LintJsTask(
+                self.build_env, command, args, shard_paths, env=env,
+                pretty_name=str(self.rule)))
+            for shard_paths in shards]
+
+      # Merge the results of all shards into a single report
+      def _shards_linted(result_tuples):
+        return_code = 0
+        outputs = []
+        for ((_, task_args, _), shard_paths) in zip(result_tuples, shards):
+          (shard_return_code, passed_paths, shard_outputs) = task_args[0]
+          return_code = return_code or shard_return_code
+          outputs.extend(shard_outputs)
+          passed_paths = set(passed_paths)
+          for src_path in shard_paths:
+            if src_path in passed_paths:
+              result_cache.set(src_path, lint_keys[src_path], True)
+            else:
+              result_cache.discard(src_path)
+        if outputs:
+          print '\n%s:' % (self.rule)
+          print '\n'.join(outputs)
+        if return_code:
+          self._fail(ExecutableError(return_code=return_code))
+        else:
+          self._succeed()
+      d = async.gather_deferreds(ds, errback_if_any_fail=True)
+      d.add_callback_fn(_shards_linted)
+      self._chain_errback(d)
 
 
 @build_rule('closure_js_fixstyle')
@@ -141,6 +205,48 @@ class ClosureJsFixStyleRule(ClosureJsLintRule):
     self._extra_args = []
 
 
+class _LintJsTask(ExecutableTask):
+  """Runs the Closure linter (or style fixer) on a shard of JS files.
+  Files with errors are identified from the linter output, so that the others
+  can be remembered as passing even if the shard failed. Output is returned
+  instead of printed so that the rule can report all shards together.
+  """
+
+  _FILE_REGEX = re.compile('^----- FILE  :  (.+) -----$', re.MULTILINE)
+
+  def __init__(self, build_env, executable_name, call_args, src_paths,
+               *args, **kwargs):
+    """Initializes a lint task.
+
+    Args:
+      build_env: The build environment for state.
+      executable_name: The name (or full path) of the linter executable.
+      call_args: Arguments to pass to the linter, before the file paths.
+      src_paths: A list of JS file paths to lint.
+    """
+    super(_LintJsTask, self).__init__(
+        build_env, executable_name, call_args + list(src_paths),
+        *args, **kwargs)
+    self.src_paths = list(src_paths)
+
+  def execute(self):
+    (return_code, stdoutdata, stderrdata) = self._run_process()
+    if return_code == 0:
+      passed_paths = self.src_paths
+    else:
+      failed_paths = set(os.path.normpath(path)
+                         for path in self._FILE_REGEX.findall(stdoutdata))
+      if failed_paths:
+        passed_paths = [src_path for src_path in self.src_paths
+                        if not os.path.normpath(src_path) in failed_paths]
+      else:
+        # Crashed, or unknown output - assume nothing passed
+        passed_paths = []
+    outputs = [output.rstrip() for output in (stdoutdata, stderrdata)
+               if output.strip()]
+    return (return_code, passed_paths, outputs)
+
+
 # TODO(benvanik): support non-closure code
 # TODO(benvanik): support AMD modules
 @build_rule('closure_js_library')
@@ -179,6 +285,8 @@ class ClosureJsLibraryRule(Rule):
     file_list_out: A list of files in sorted order required for the given
         entry points.
         Example - 'all_files.txt'
+    scan_header_only: True to only scan the goog.provide/goog.require block at
+        the top of each file for dependencies, instead of the whole file.
 
   Outputs:
     A single compiled JS file. If no out is specified a file with the name of
@@ -188,7 +296,7 @@ class ClosureJsLibraryRule(Rule):
   def __init__(self, name, mode, compiler_jar, entry_points,
         pretty_print=False, debug=False,
         compiler_flags=None, externs=None, wrap_with_global=None,
-        out=None, deps_out=None, file_list_out=None,
+        out=None, deps_out=None, file_list_out=None, scan_header_only=False,
         *args, **kwargs):
     """Initializes a Closure JS library rule.
 
@@ -210,6 +318,8 @@ class ClosureJsLibraryRule(Rule):
       file_list_out: A list of files in sorted order required for the given
           entry points.
           Example - 'all_files.txt'
+      scan_header_only: True to only scan the goog.provide/goog.require block
+          at the top of each file for dependencies.
     """
     super(ClosureJsLibraryRule, self).__init__(name, *args, **kwargs)
     self.src_filter = '*.js'
@@ -238,6 +348,7 @@ class ClosureJsLibraryRule(Rule):
     self.out = out
     self.deps_out = deps_out
     self.file_list_out = file_list_out
+    self.scan_header_only = scan_header_only
 
   class _Context(RuleContext):
     def begin(self):
@@ -313,8 +424,7 @@ class ClosureJsLibraryRule(Rule):
         return
 
       # Issue dependency scanning to build the deps graph
-      d = self._run_task_async(_ScanJsDependenciesTask(
-          self.build_env, self.src_paths))
+      d = self._scan_dependencies()
 
       # Launch the compilation and deps.js gen tasks when scanning completes
       def _deps_scanned(dep_graph):
@@ -324,24 +434,50 @@ class ClosureJsLibraryRule(Rule):
         used_paths = dep_graph.get_transitive_closure(self.rule.entry_points)
 
         # Generate/write JS deps
-        ds.append(self._run_task_async(WriteFileTask(
-            self.build_env, dep_graph.get_deps_js(), deps_js_path)))
+        deps_js_table = _deps_js_tables.get(deps_js_path, None)
+        if not deps_js_table:
+          deps_js_table = DepsJsTable()
+          _deps_js_tables[deps_js_path] = deps_js_table
+        deps_js = dep_graph.get_deps_js(table=deps_js_table)
+        if (self.build_context.force or
+            not deps_js_table.is_written(deps_js_path)):
+          write_ds = self._write_file_if_changed(deps_js, deps_js_path)
+          if write_ds:
+            write_ds[0].add_callback_fn(
+                lambda *args, **kwargs: deps_js_table.mark_written(
+                    deps_js_path))
+          else:
+            deps_js_table.mark_written(deps_js_path)
+          ds.extend(write_ds)
 
         # Generate/write manifest
         if file_list_path:
           rel_used_paths = [
               os.path.relpath(path, self._get_rule_path())
               for path in used_paths]
-          ds.append(self._run_task_async(WriteFileTask(
-              self.build_env, u'\n'.join(rel_used_paths), file_list_path)))
+          ds.extend(self._write_file_if_changed(
+              u'\n'.join(rel_used_paths), file_list_path))
 
         # Compile main lib
         if compiling:
           for src_path in used_paths:
             args.append('--js=%s' % (src_path))
-          ds.append(self._run_task_async(JavaExecutableTask(
-              self.build_env, jar_path, args,
-              pretty_name=str(self.rule))))
+          # Only recompile if something in the closure or the compiler setup
+          # changed - edits to unused sources do not matter
+          rule_cache = self.build_context.cache
+          fingerprint = self._compute_compile_fingerprint(
+              args, used_paths + extern_paths, jar_path)
+          if (self.build_context.force or
+              not os.path.isfile(output_path) or
+              rule_cache.get_fingerprint(self.rule.path, 'compile') !=
+                  fingerprint):
+            d = self._run_task_async(JavaExecutableTask(
+                self.build_env, jar_path, args,
+                pretty_name=str(self.rule)))
+            d.add_callback_fn(
+                lambda *args, **kwargs: rule_cache.set_fingerprint(
+                    self.rule.path, 'compile', fingerprint))
+            ds.append(d)
           # TODO(benvanik): pull out (stdout, stderr) from result and the
           #     exception to get better error logging
         else:
@@ -354,15 +490,297 @@ class ClosureJsLibraryRule(Rule):
       d.add_callback_fn(_deps_scanned)
       self._chain_errback(d)
 
+    def _write_file_if_changed(self, contents, path):
+      """Writes a file unless it already has the given contents.
+      Unchanged files keep their mtimes, so rules using them see no changes.
+
+      Args:
+        contents: File contents, as a string.
+        path: Target file path.
+
+      Returns:
+        A list containing the Deferred of the write task, or an empty list if
+        the file is unchanged.
+      """
+      if not self.build_context.force:
+        try:
+          with io.open(path, 'rt') as f:
+            if f.read() == contents:
+              return []
+        except IOError:
+          pass
+      return [self._run_task_async(WriteFileTask(
+          self.build_env, contents, path))]
+
+    def _compute_compile_fingerprint(self, args, input_paths, jar_path):
+      """Computes a fingerprint of everything a compilation depends on.
+
+      Args:
+        args: Compiler arguments.
+        input_paths: All JS files read by the compiler.
+        jar_path: Compiler jar path.
+
+      Returns:
+        A fingerprint string.
+      """
+      stat_cache = self.build_context.stat_cache
+      input_stats = []
+      for input_path in input_paths:
+        st = stat_cache.stat(input_path)
+        input_stats.append(
+            (input_path, st.st_mtime, st.st_size) if st else (input_path,))
+      # Jars may be rebuilt with the same contents, so their digest is used
+      digest_cache = _JsFileCaches.get(self.build_context).digest_cache
+      jar_digest = digest_cache.scan(jar_path, _compute_digest)
+      return hashlib.md5(repr((args, input_stats, jar_digest))).hexdigest()
+
+    def _scan_dependencies(self):
+      """Scans all source files for dependencies.
+      Graphs are shared with all other rules in the build using the same
+      sources.
+
+      Returns:
+        A Deferred called back with the JsDependencyGraph of the sources.
+      """
+      registry = _JsDependencyRegistry.get(self.build_context)
+      return registry.get_graph(self, self.src_paths,
+                                header_only=self.rule.scan_header_only)
+
+
+class _JsFileCaches(object):
+  """File caches shared by all closure_js rules in a build.
+  Caches are loaded on first use and saved once the build completes, as rules
+  saving their own copies concurrently would overwrite each other's results.
+  """
+
+  def __init__(self, build_context):
+    """Initializes the caches of a build.
+
+    Args:
+      build_context: BuildContext the caches are used in.
+    """
+    self.root_path = build_context.build_env.root_path
+    # Content digests of source files and tools
+    self.digest_cache = FileScanCache(self.root_path, 'digests')
+    # ResultCaches by name, each loaded once per build
+    self._result_caches = {}
+    build_context.add_exit_callback(self.save)
+
+  @staticmethod
+  def get(build_context):
+    """Gets the caches of a build.
+
+    Args:
+      build_context: BuildContext.
+
+    Returns:
+      The _JsFileCaches of the build, created on first use.
+    """
+    file_caches = build_context.shared_state.get('closure_js_caches', None)
+    if not file_caches:
+      file_caches = _JsFileCaches(build_context)
+      build_context.shared_state['closure_js_caches'] = file_caches
+    return file_caches
+
+  def get_result_cache(self, name):
+    """Gets a result cache by name.
+
+    Args:
+      name: Cache name.
+
+    Returns:
+      The ResultCache.
+    """
+    result_cache = self._result_caches.get(name, None)
+    if not result_cache:
+      result_cache = ResultCache(self.root_path, name)
+      self._result_caches[name] = result_cache
+    return result_cache
+
+  def save(self):
+    """Saves all caches that have been loaded.
+    """
+    self.digest_cache.save()
+    for result_cache in self._result_caches.values():
+      result_cache.save()
+
+
+class _JsDependencyRegistry(object):
+  """Dependency graphs shared by all closure_js_library rules in a build.
+  Graphs are keyed by the stats of their source files, so rules with the same
+  sources share a single scan and graph (and so also its memoized transitive
+  closures). Files already scanned, or being scanned, for another rule are not
+  scanned again.
+
+  Files are scanned in shards across the task executor, with the results of
+  previous builds reused from the scan cache. Scan caches are saved once the
+  build completes.
+  """
+
+  def __init__(self, build_context):
+    """Initializes a registry.
+
+    Args:
+      build_context: BuildContext the registry is used in.
+    """
+    self.build_context = build_context
+    # FileScanCaches by name, each loaded once per build
+    self._scan_caches = {}
+    # Scan results by (header_only, src_path, stat key)
+    self._file_results = {}
+    # Deferreds of the shards currently scanning files, by the same keys
+    self._pending_scans = {}
+    # Deferreds called back with JsDependencyGraphs, by graph key
+    self._graphs = {}
+
+  @staticmethod
+  def get(build_context):
+    """Gets the registry of a build.
+
+    Args:
+      build_context: BuildContext.
+
+    Returns:
+      The _JsDependencyRegistry of the build, created on first use.
+    """
+    registry = build_context.shared_state.get('closure_js_deps', None)
+    if not registry:
+      registry = _JsDependencyRegistry(build_context)
+      build_context.shared_state['closure_js_deps'] = registry
+    return registry
+
+  def _get_scan_cache(self, header_only):
+    name = 'jsdeps-header' if header_only else 'jsdeps'
+    scan_cache = self._scan_caches.get(name, None)
+    if not scan_cache:
+      scan_cache = FileScanCache(self.build_context.build_env.root_path, name)
+      self._scan_caches[name] = scan_cache
+      self.build_context.add_exit_callback(scan_cache.save)
+    return scan_cache
+
+  def _get_stat_key(self, src_path):
+    st = self.build_context.stat_cache.stat(src_path)
+    return (st.st_mtime, st.st_size) if st else None
+
+  def get_graph(self, rule_ctx, src_paths, header_only=False):
+    """Gets the dependency graph of the given sources, scanning any that have
+    not yet been scanned in this build.
+
+    Args:
+      rule_ctx: RuleContext requesting the graph, used to run scanning tasks.
+      src_paths: A list of source JS paths.
+      header_only: True to only scan the goog.provide/goog.require block at the
+          top of each file.
+
+    Returns:
+      A Deferred called back with the JsDependencyGraph of the sources.
+    """
+    result_keys = [(header_only, src_path, self._get_stat_key(src_path))
+                   for src_path in src_paths]
+    graph_key = tuple(sorted(result_keys))
+    deferred = self._graphs.get(graph_key, None)
+    if deferred:
+      return deferred
+    deferred = async.Deferred()
+    self._graphs[graph_key] = deferred
+
+    file_results = self._file_results
+    scan_keys = []
+    scan_paths = []
+    ds = []
+    for (result_key, src_path) in zip(result_keys, src_paths):
+      if result_key in file_results:
+        continue
+      pending_deferred = self._pending_scans.get(result_key, None)
+      if pending_deferred:
+        # Wait on the shard already scanning the file for another rule
+        if not pending_deferred in ds:
+          ds.append(pending_deferred)
+        continue
+      scan_keys.append(result_key)
+      scan_paths.append(src_path)
+    for n in range(0, len(scan_paths), _SCAN_SHARD_SIZE):
+      ds.append(self._scan_shard(
+          rule_ctx, scan_keys[n:n + _SCAN_SHARD_SIZE],
+          scan_paths[n:n + _SCAN_SHARD_SIZE], header_only))
+
+    def _shards_scanned(*args, **kwargs):
+      dep_files = [JsDependencyFile(src_path,
+                                    results=file_results[result_key])
+                   for (result_key, src_path) in zip(result_keys, src_paths)]
+      deferred.callback(JsDependencyGraph(
+          self.build_context.build_env, src_paths, dep_files=dep_files))
+    def _shards_failed(*args, **kwargs):
+      # Let a later request try again
+      del self._graphs[graph_key]
+      deferred.errback(*args, **kwargs)
+    d = async.gather_deferreds(ds, errback_if_any_fail=True)
+    d.add_callback_fn(_shards_scanned)
+    d.add_errback_fn(_shards_failed)
+    return deferred
+
+  def _scan_shard(self, rule_ctx, result_keys, src_paths, header_only):
+    """Scans a shard of files, adding their results to the registry.
+
+    Args:
+      rule_ctx: RuleContext requesting the scan, used to run the scanning task.
+      result_keys: A list of the result keys of the files.
+      src_paths: A list of source JS paths.
+      header_only: True to only scan the goog.provide/goog.require block.
+
+    Returns:
+      A Deferred called back once the results have been added.
+    """
+    scan_cache = self._get_scan_cache(header_only)
+    d = rule_ctx._run_task_async(_ScanJsDependenciesTask(
+        self.build_context.build_env, src_paths,
+        cache_entries=scan_cache.get_entries(src_paths),
+        header_only=header_only))
+    for result_key in result_keys:
+      self._pending_scans[result_key] = d
+
+    def _shard_done():
+      for result_key in result_keys:
+        del self._pending_scans[result_key]
+    def _shard_scanned(result):
+      _shard_done()
+      (results, cache_entries) = result
+      scan_cache.merge(cache_entries)
+      result_keys_by_path = dict(zip(src_paths, result_keys))
+      for (src_path, src_results) in results:
+        self._file_results[result_keys_by_path[src_path]] = src_results
+    def _shard_failed(*args, **kwargs):
+      # Let a later request try again
+      _shard_done()
+    # Added before any rule waits on the shard so that results are in place
+    # before their callbacks
+    d.add_callback_fn(_shard_scanned)
+    d.add_errback_fn(_shard_failed)
+    return d
+
 
 class _ScanJsDependenciesTask(Task):
-  def __init__(self, build_env, src_paths, *args, **kwargs):
+  """Scans a shard of JS source files for their dependencies.
+  The cache entries of the files are passed in and the updated entries are
+  returned, so that the cache is only loaded and saved by the rule.
+  """
+
+  def __init__(self, build_env, src_paths, cache_entries=None,
+               header_only=False, *args, **kwargs):
     super(_ScanJsDependenciesTask, self).__init__(build_env, *args, **kwargs)
-    self.src_paths = src_paths
+    self.src_paths = PackedPathList(src_paths)
+    self.cache_entries = cache_entries or {}
+    self.header_only = header_only
 
   def execute(self):
-    deps_graph = JsDependencyGraph(self.build_env, self.src_paths)
-    return deps_graph
+    scan_cache = FileScanCache()
+    scan_cache.merge(self.cache_entries)
+    src_paths = list(self.src_paths)
+    results = [(src_path, JsDependencyFile.scan_path(
+                   src_path, scan_cache=scan_cache,
+                   header_only=self.header_only))
+               for src_path in src_paths]
+    return (results, scan_cache.get_entries(src_paths))
 
 
 class JsDependencyFile(object):
@@ -375,47 +793,265 @@ class JsDependencyFile(object):
   # TODO(benvanik): a real comment search for @provideGoog.
   _GOOG_BASE_LINE = (
       ' * @provideGoog')
+  # Lines starting with these may follow goog.provide/goog.require in a header
+  _HEADER_PREFIXES = (
+      'goog.provide(', 'goog.require(', 'goog.setCssNameMapping(')
 
-  def __init__(self, src_path):
+  def __init__(self, src_path, scan_cache=None, header_only=False,
+               results=None):
     """Initializes a JS dependency file.
 
     Args:
       src_path: Source JS file path.
+      scan_cache: A FileScanCache to reuse the results of previous scans from,
+          if any.
+      header_only: True to stop scanning at the end of the
+          goog.provide/goog.require block.
+      results: Results of a previous scan_path of the file, if any.
     """
     self.src_path = src_path
-    self.provides = []
-    self.requires = []
-    self.is_base_js = False
-    self.is_css_rename_map = False
-    with io.open(self.src_path, 'rb') as f:
-      self._scan(f)
+    if results is None:
+      results = JsDependencyFile.scan_path(
+          src_path, scan_cache=scan_cache, header_only=header_only)
+    (self.provides, self.requires,
+     self.is_base_js, self.is_css_rename_map) = results
 
-  def _scan(self, f):
-    """Scans the given file for provides/requires and returns the results.
+  @staticmethod
+  def scan_path(src_path, scan_cache=None, header_only=False):
+    """Scans the given file for provides/requires.
 
     Args:
-      f: Input file.
+      src_path: Source JS file path.
+      scan_cache: A FileScanCache to reuse the results of previous scans from,
+          if any.
+      header_only: True to stop scanning at the end of the
+          goog.provide/goog.require block.
+
+    Returns:
+      A tuple of (provides, requires, is_base_js, is_css_rename_map), as
+      returned by _scan.
+    """
+    scan_fn = (JsDependencyFile._scan_header if header_only else
+               JsDependencyFile._scan)
+    if scan_cache:
+      return scan_cache.scan(src_path, scan_fn)
+    with io.open(src_path, 'rb') as f:
+      return scan_fn(f.read())
+
+  @staticmethod
+  def _scan_header(contents):
+    return JsDependencyFile._scan(contents, header_only=True)
+
+  @staticmethod
+  def _scan(contents, header_only=False):
+    """Scans the given file contents for provides/requires.
+    Instead of matching every line only lines starting with 'goog.' are
+    visited, found with plain string searches.
+
+    Args:
+      contents: File contents.
+      header_only: True to stop scanning at the end of the first
+          goog.provide/goog.require block.
+
+    Returns:
+      A tuple of (provides, requires, is_base_js, is_css_rename_map), with
+      sorted lists of the provided and required namespaces.
     """
     provides = set()
     requires = set()
-
-    for line in f.readlines():
-      match = self._PROVIDEREQURE_REGEX.match(line)
+    is_base_js = False
+    is_css_rename_map = False
+    scan_end = len(contents)
+
+    line_start = _find_line(contents, 'goog.', 0)
+    while line_start != -1:
+      line_end = contents.find('\n', line_start)
+      if line_end == -1:
+        line_end = len(contents)
+      line = contents[line_start:line_end]
+      match = JsDependencyFile._PROVIDEREQURE_REGEX.match(line)
       if match:
         if match.group(1) == 'provide':
           provides.add(str(match.group(2)))
         else:
           requires.add(str(match.group(2)))
-      elif line.startswith(self._GOOG_BASE_LINE):
-        provides.add('goog')
-        self.is_base_js = True
+        if (header_only and not JsDependencyFile._is_header_continued(
+            contents, line_end)):
+          scan_end = line_end
+          break
       elif line.startswith('goog.setCssNameMapping('):
-        self.is_css_rename_map = True
+        is_css_rename_map = True
+      line_start = _find_line(contents, 'goog.', line_end)
+
+    if _find_line(contents, JsDependencyFile._GOOG_BASE_LINE, 0,
+                  scan_end) != -1:
+      provides.add('goog')
+      is_base_js = True
 
-    self.provides = list(provides)
-    self.provides.sort()
-    self.requires = list(requires)
-    self.requires.sort()
+    return (sorted(provides), sorted(requires), is_base_js, is_css_rename_map)
+
+  @staticmethod
+  def _is_header_continued(contents, pos):
+    """
+    Returns:
+      True if the first line after pos that is not blank or a comment is part
+      of the goog.provide/goog.require header.
+    """
+    while pos < len(contents):
+      line_end = contents.find('\n', pos + 1)
+      if line_end == -1:
+        line_end = len(contents)
+      line = contents[pos + 1:line_end].strip()
+      pos = line_end
+      if line and not line.startswith(('//', '/*', '*')):
+        return line.startswith(JsDependencyFile._HEADER_PREFIXES)
+    return False
+
+
+class DepsJsTable(object):
+  """The lines of a deps.js file, by source path.
+  Tables are updated in place as the dependency graph changes, so that only the
+  lines of added or changed files are generated and the file contents are only
+  joined again when a line changed.
+  """
+
+  _HEADER_LINES = [
+      '// Automatically generated by anvil-build - do not modify',
+      '',
+      ]
+
+  def __init__(self):
+    """Initializes an empty table.
+    """
+    self.base_path = None
+    # (provides, requires, line) by source path
+    self._entries = {}
+    # All source paths, sorted (to make the file easier to debug)
+    self._src_paths = []
+    self._contents = None
+    # Contents and (mtime, size) of the file when it was last written
+    self._written_contents = None
+    self._written_stat = None
+
+  def update(self, base_path, dep_files):
+    """Updates the table to match a dependency graph.
+
+    Args:
+      base_path: Path that all dependencies are relative from.
+      dep_files: JsDependencyFiles by source path.
+
+    Returns:
+      True if any lines changed.
+    """
+    if base_path != self.base_path:
+      self.base_path = base_path
+      self._entries.clear()
+      del self._src_paths[:]
+    entries = self._entries
+
+    removed_paths = [src_path for src_path in entries
+                     if not src_path in dep_files]
+    for src_path in removed_paths:
+      del entries[src_path]
+    added_paths = []
+    changed = len(removed_paths) > 0
+    for (src_path, dep_file) in dep_files.iteritems():
+      entry = entries.get(src_path, None)
+      if entry:
+        if (entry[0] == dep_file.provides and
+            entry[1] == dep_file.requires):
+          continue
+      else:
+        added_paths.append(src_path)
+      entries[src_path] = (dep_file.provides, dep_file.requires,
+                           self._format_line(dep_file))
+      changed = True
+
+    if removed_paths:
+      self._src_paths = [src_path for src_path in self._src_paths
+                         if src_path in entries]
+    if added_paths:
+      # Mostly sorted already, which is fast to sort again
+      self._src_paths.extend(added_paths)
+      self._src_paths.sort()
+    if changed:
+      self._contents = None
+    return changed
+
+  def _format_line(self, dep_file):
+    rel_path = os.path.relpath(dep_file.src_path, self.base_path)
+    rel_path = anvil.util.strip_build_paths(rel_path)
+    return 'goog.addDependency(\'%s\', %s, %s);' % (
+        anvil.util.ensure_forwardslashes(rel_path),
+        dep_file.provides, dep_file.requires)
+
+  def get_contents(self):
+    """Gets the contents of the deps.js file.
+
+    Returns:
+      A string containing all of the lines of the file.
+    """
+    if self._contents is None:
+      entries = self._entries
+      lines = list(self._HEADER_LINES)
+      lines.extend(entries[src_path][2] for src_path in self._src_paths)
+      self._contents = u'\n'.join(lines)
+    return self._contents
+
+  def mark_written(self, path):
+    """Records that the current contents are in the given file.
+
+    Args:
+      path: deps.js file path.
+    """
+    self._written_contents = self.get_contents()
+    self._written_stat = _get_stat_key(path)
+
+  def is_written(self, path):
+    """Checks whether the given file still has the current contents, as
+    recorded by mark_written, without reading it.
+
+    Args:
+      path: deps.js file path.
+
+    Returns:
+      True if the file is up to date.
+    """
+    return (self._written_stat is not None and
+            self._written_contents is self.get_contents() and
+            self._written_stat == _get_stat_key(path))
+
+
+def _compute_digest(contents):
+  return hashlib.md5(contents).hexdigest()
+
+
+def _get_stat_key(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime, st.st_size)
+
+
+def _find_line(contents, prefix, pos, end=None):
+  """Finds the next line starting with the given prefix.
+
+  Args:
+    contents: String to search.
+    prefix: Line prefix.
+    pos: Position to start searching at. Lines starting before it are skipped.
+    end: Position to stop searching at, or None to search to the end.
+
+  Returns:
+    The position of the start of the line, or -1 if not found.
+  """
+  if end is None:
+    end = len(contents)
+  if pos == 0 and contents.startswith(prefix, 0, end):
+    return 0
+  index = contents.find('\n' + prefix, pos, end)
+  return index + 1 if index != -1 else -1
 
 
 class JsDependencyGraph(object):
@@ -424,12 +1060,17 @@ class JsDependencyGraph(object):
   The result is a queryable list
   """
 
-  def __init__(self, build_env, src_paths, *args, **kwargs):
+  def __init__(self, build_env, src_paths, scan_cache=None, dep_files=None,
+               *args, **kwargs):
     """Initializes a JS dependency graph.
 
     Args:
       build_env: BuildEnvironment.
       src_paths: A list of source JS paths.
+      scan_cache: A FileScanCache to reuse the results of previous scans from,
+          if any.
+      dep_files: A list of already scanned JsDependencyFiles for src_paths, in
+          the same order, or None to scan the files.
     """
     self.build_env = build_env
     self.src_paths = list(src_paths)
@@ -437,10 +1078,15 @@ class JsDependencyGraph(object):
     self._provide_map = {}
     self.base_dep_file = None
     self.base_js_path = None
+    # Transitive closures by tuple of entry points
+    self._closures = {}
 
     # Scan all files
-    for src_path in self.src_paths:
-      dep_file = JsDependencyFile(src_path)
+    if dep_files is None:
+      dep_files = [JsDependencyFile(src_path, scan_cache=scan_cache)
+                   for src_path in self.src_paths]
+    for dep_file in dep_files:
+      src_path = dep_file.src_path
       self.dep_files[src_path] = dep_file
       if dep_file.is_base_js:
         self.base_dep_file = dep_file
@@ -449,9 +1095,13 @@ class JsDependencyGraph(object):
         assert not provide in self._provide_map
         self._provide_map[provide] = dep_file
 
-  def get_deps_js(self):
+  def get_deps_js(self, table=None):
     """Generates the contents of a deps.js file from the dependency graph.
 
+    Args:
+      table: A DepsJsTable to update, such as one used for a previous version of
+          the graph. Only the lines of files that changed since are generated.
+
     Returns:
       A string containing all of the lines of a deps.js file.
     """
@@ -460,26 +1110,15 @@ class JsDependencyGraph(object):
     if self.base_js_path:
       base_path = self.base_js_path
 
-    lines = [
-        '// Automatically generated by anvil-build - do not modify',
-        '',
-        ]
-
-    # Write in path order (to make the file easier to debug)
-    src_paths = self.dep_files.keys()
-    src_paths.sort()
-    for src_path in src_paths:
-      dep_file = self.dep_files[src_path]
-      rel_path = os.path.relpath(dep_file.src_path, base_path)
-      rel_path = anvil.util.strip_build_paths(rel_path)
-      lines.append('goog.addDependency(\'%s\', %s, %s);' % (
-          anvil.util.ensure_forwardslashes(rel_path),
-          dep_file.provides, dep_file.requires))
-    return u'\n'.join(lines)
+    table = table or DepsJsTable()
+    table.update(base_path, self.dep_files)
+    return table.get_contents()
 
   def get_transitive_closure(self, entry_points):
     """Identifies the transitive closure of the dependency graph for the given
     entry points.
+    Results are remembered, so repeated queries for the same entry points are
+    free.
 
     Args:
       entry_points: Closure entry points, such as 'my.start'.
@@ -488,34 +1127,69 @@ class JsDependencyGraph(object):
       A list of all file paths required by the given entry points.
       The files are sorted in proper dependency order.
     """
+    key = tuple(entry_points)
+    deps_list = self._closures.get(key, None)
+    if deps_list is None:
+      deps_list = self._compute_transitive_closure(entry_points)
+      self._closures[key] = deps_list
+    return deps_list[:]
+
+  def _compute_transitive_closure(self, entry_points):
     deps_list = []
+    visited_paths = set()
 
     # Always base.js first
     if self.base_dep_file:
       deps_list.append(self.base_dep_file.src_path)
+      visited_paths.add(self.base_dep_file.src_path)
 
     # Followed by all files in the transitive closure, in order
     for entry_point in entry_points:
-      self._add_dependencies(deps_list, entry_point)
+      self._add_dependencies(deps_list, visited_paths, entry_point)
 
     # And finally, any files that look special
     for dep_file in self.dep_files.values():
-      if dep_file.is_css_rename_map:
+      if dep_file.is_css_rename_map and not dep_file.src_path in visited_paths:
         deps_list.append(dep_file.src_path)
+        visited_paths.add(dep_file.src_path)
 
     return deps_list
 
-  def _add_dependencies(self, deps_list, namespace):
+  def _get_provider(self, namespace):
     if not namespace in self._provide_map:
       print 'Namespace %s not provided' % (namespace)
     assert namespace in self._provide_map
-    dep_file = self._provide_map[namespace]
-    if dep_file.src_path in deps_list:
+    return self._provide_map[namespace]
+
+  def _add_dependencies(self, deps_list, visited_paths, namespace):
+    """Adds the file providing a namespace and all of its dependencies to a
+    list, each after the files it requires.
+    This is a depth-first search done with an explicit stack, as dependency
+    chains can be deeper than the recursion limit.
+
+    Args:
+      deps_list: A list of file paths to add to.
+      visited_paths: A set of all file paths already visited, which is updated.
+      namespace: Namespace to add.
+    """
+    dep_file = self._get_provider(namespace)
+    if dep_file.src_path in visited_paths:
       return
-    for require in dep_file.requires:
-      if require in dep_file.provides:
-        print 'Namespace %s both provided and required in the same file' % (
-            require)
-      assert not require in dep_file.provides
-      self._add_dependencies(deps_list, require)
-    deps_list.append(dep_file.src_path)
+    visited_paths.add(dep_file.src_path)
+    # (JsDependencyFile, iterator of its remaining requires) tuples
+    stack = [(dep_file, iter(dep_file.requires))]
+    while stack:
+      (dep_file, requires) = stack[-1]
+      for require in requires:
+        if require in dep_file.provides:
+          print 'Namespace %s both provided and required in the same file' % (
+              require)
+        assert not require in dep_file.provides
+        required_file = self._get_provider(require)
+        if not required_file.src_path in visited_paths:
+          visited_paths.add(required_file.src_path)
+          stack.append((required_file, iter(required_file.requires)))
+          break
+      else:
+        stack.pop()
+        deps_list.append(dep_file.src_path)
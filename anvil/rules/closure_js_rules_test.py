@@ -0,0 +1,433 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the closure_js_rules module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest2
+
+from anvil.async import Deferred
+from anvil.cache import FileRuleCache
+from anvil.context import BuildContext, BuildEnvironment
+from anvil.project import FileModuleResolver, Project
+from anvil.task import InProcessTaskExecutor, JavaExecutableTask
+from anvil.test import FixtureTestCase
+from closure_js_rules import *
+
+
+class JsDependencyFileTest(unittest2.TestCase):
+  """Behavioral tests of the JsDependencyFile type."""
+
+  def testScan(self):
+    self.assertEqual(JsDependencyFile._scan(''), ([], [], False, False))
+    self.assertEqual(JsDependencyFile._scan(
+        'goog.provide(\'a\');\r\n'
+        'goog.require("b");\n'
+        '  goog.require(\'indented\');\n'
+        '// goog.require(\'commented\');\n'
+        'goog.require( \'c\' );\n'
+        'goog.provide(\'a\');'),
+        (['a'], ['b', 'c'], False, False))
+    self.assertEqual(JsDependencyFile._scan(
+        '/**\n'
+        ' * @provideGoog\n'
+        ' */\n'
+        'goog.provide = function(name) {};\n'),
+        (['goog'], [], True, False))
+    self.assertEqual(JsDependencyFile._scan(
+        'goog.setCssNameMapping({});'),
+        ([], [], False, True))
+
+  def testScanHeader(self):
+    contents = (
+        '/**\n'
+        ' * @fileoverview Sample.\n'
+        ' */\n'
+        'goog.provide(\'a\');\n'
+        '\n'
+        '// Comment\n'
+        'goog.require(\'b\');\n'
+        'goog.setCssNameMapping({});\n'
+        'goog.require(\'c\');\n'
+        'var x;\n'
+        'goog.require(\'d\');\n'
+        '/**\n'
+        ' * @provideGoog\n'
+        ' */\n')
+    self.assertEqual(JsDependencyFile._scan(contents),
+                     (['a', 'goog'], ['b', 'c', 'd'], True, True))
+    self.assertEqual(JsDependencyFile._scan(contents, header_only=True),
+                     (['a'], ['b', 'c'], False, True))
+    # Files without provides/requires are scanned entirely
+    self.assertEqual(JsDependencyFile._scan(
+        'var x;\n'
+        'goog.setCssNameMapping({});\n', header_only=True),
+        ([], [], False, True))
+
+
+class ClosureJsLintRuleTest(FixtureTestCase):
+  """Behavioral tests of the ClosureJsLintRule type."""
+  fixture = 'closure_js_rules/lint'
+
+  def setUp(self):
+    super(ClosureJsLintRuleTest, self).setUp()
+    self.build_env = BuildEnvironment(root_path=self.root_path)
+    with open(os.path.join(self.root_path, 'BUILD'), 'w') as f:
+      f.write('closure_js_lint(\'lint\', namespaces=[\'a\'], '
+              'linter_path=%r, srcs=glob(\'js/*.js\'))' % (
+                  os.path.join(self.root_path, 'linter')))
+
+  def _lint(self, rule_names=None, complete_later=False):
+    rule_names = rule_names or [':lint']
+    log_path = os.path.join(self.root_path, 'lint.log')
+    if os.path.exists(log_path):
+      os.remove(log_path)
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    rule_module = sys.modules[
+        type(project.resolve_rule(rule_names[0])).__module__]
+    self.addCleanup(setattr, rule_module, '_LINT_SHARD_SIZE',
+                    rule_module._LINT_SHARD_SIZE)
+    rule_module._LINT_SHARD_SIZE = 2
+    task_executor = _RecordingTaskExecutor(complete_later=complete_later)
+    with BuildContext(self.build_env, project, task_executor=task_executor,
+                      raise_on_error=False) as ctx:
+      result = ctx.execute_sync(rule_names)
+    linted_names = []
+    if os.path.exists(log_path):
+      with open(log_path) as f:
+        linted_names = sorted(f.read().split())
+    return (result, len(task_executor.tasks), linted_names)
+
+  def _write(self, name, contents):
+    path = os.path.join(self.root_path, 'js', name)
+    with open(path, 'w') as f:
+      f.write(contents)
+    # Keep stats distinct from the cached ones
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+
+  def testLint(self):
+    self.assertEqual(self._lint(), (True, 2, ['a.js', 'b.js', 'c.js']))
+    self.assertEqual(self._lint(), (True, 0, []))
+
+    # Failing files are linted until fixed, passing files are not
+    self._write('b.js', 'BAD')
+    self._write('c.js', 'var c;')
+    self.assertEqual(self._lint(), (False, 1, ['b.js', 'c.js']))
+    self.assertEqual(self._lint(), (False, 1, ['b.js']))
+    self._write('b.js', 'var b;')
+    self.assertEqual(self._lint(), (True, 1, ['b.js']))
+    self.assertEqual(self._lint(), (True, 0, []))
+
+  def testConcurrentLint(self):
+    # Rules linting at the same time keep each other's results
+    with open(os.path.join(self.root_path, 'BUILD'), 'w') as f:
+      for (name, srcs) in [('lint_a', ['js/a.js']),
+                           ('lint_bc', ['js/b.js', 'js/c.js'])]:
+        f.write('closure_js_lint(%r, namespaces=[\'a\'], linter_path=%r, '
+                'srcs=%r)\n' % (name, os.path.join(self.root_path, 'linter'),
+                                 srcs))
+    rule_names = [':lint_a', ':lint_bc']
+    self.assertEqual(self._lint(rule_names, complete_later=True),
+                     (True, 2, ['a.js', 'b.js', 'c.js']))
+    self.assertEqual(self._lint(rule_names, complete_later=True),
+                     (True, 0, []))
+
+
+class JsDependencyGraphTest(unittest2.TestCase):
+  """Behavioral tests of the JsDependencyGraph type."""
+
+  def _create_graph(self, files):
+    dep_files = [JsDependencyFile(src_path, results=results)
+                 for (src_path, results) in files]
+    return JsDependencyGraph(BuildEnvironment(root_path='/'),
+                             [src_path for (src_path, _) in files],
+                             dep_files=dep_files)
+
+  def testTransitiveClosure(self):
+    graph = self._create_graph([
+        ('/base.js', (['goog'], [], True, False)),
+        ('/a.js', (['a'], ['b', 'c'], False, False)),
+        ('/b.js', (['b'], ['d'], False, False)),
+        ('/c.js', (['c', 'c.x'], ['d', 'goog'], False, False)),
+        ('/d.js', (['d'], [], False, False)),
+        ('/e.js', (['e'], ['c.x'], False, False)),
+        ('/css.js', (['css'], [], False, True)),
+        ('/unused.js', (['unused'], [], False, False)),
+        ])
+    self.assertEqual(graph.get_transitive_closure([]),
+                     ['/base.js', '/css.js'])
+    self.assertEqual(graph.get_transitive_closure(['a']),
+                     ['/base.js', '/d.js', '/b.js', '/c.js', '/a.js',
+                      '/css.js'])
+    self.assertEqual(graph.get_transitive_closure(['e', 'a', 'css']),
+                     ['/base.js', '/d.js', '/c.js', '/e.js', '/b.js', '/a.js',
+                      '/css.js'])
+    # Results are copies
+    graph.get_transitive_closure(['a']).append('x')
+    self.assertEqual(len(graph.get_transitive_closure(['a'])), 6)
+
+    self.assertRaises(AssertionError, graph.get_transitive_closure, ['x'])
+
+  def testDeepClosure(self):
+    count = 5000
+    files = [('/%s.js' % (n), (['n%s' % (n)], ['n%s' % (n + 1)], False, False))
+             for n in range(count)]
+    files.append(('/%s.js' % (count), (['n%s' % (count)], [], False, False)))
+    graph = self._create_graph(files)
+    deps_list = graph.get_transitive_closure(['n0'])
+    self.assertEqual(len(deps_list), count + 1)
+    self.assertEqual(deps_list[0], '/%s.js' % (count))
+    self.assertEqual(deps_list[-1], '/0.js')
+
+
+  def testDepsJs(self):
+    graph = self._create_graph([
+        ('/js/base.js', (['goog'], [], True, False)),
+        ('/js/b.js', (['b'], ['a'], False, False)),
+        ('/js/a/a.js', (['a'], [], False, False)),
+        ])
+    self.assertEqual(graph.get_deps_js(), u'\n'.join([
+        '// Automatically generated by anvil-build - do not modify',
+        '',
+        'goog.addDependency(\'a/a.js\', [\'a\'], []);',
+        'goog.addDependency(\'b.js\', [\'b\'], [\'a\']);',
+        'goog.addDependency(\'base.js\', [\'goog\'], []);',
+        ]))
+
+
+class DepsJsTableTest(unittest2.TestCase):
+  """Behavioral tests of the DepsJsTable type."""
+
+  def _create_dep_files(self, files):
+    return dict((src_path, JsDependencyFile(src_path, results=results))
+                for (src_path, results) in files)
+
+  def testUpdate(self):
+    files = [('/%s.js' % (n), (['n%s' % (n)], [], False, False))
+             for n in range(10)]
+    table = DepsJsTable()
+    self.assertTrue(table.update('/', self._create_dep_files(files)))
+    contents = table.get_contents()
+    self.assertEqual(len(contents.split('\n')), 12)
+    self.assertFalse(table.update('/', self._create_dep_files(files)))
+    self.assertIs(table.get_contents(), contents)
+
+    # Changes are patched in, matching a full generation
+    del files[3]
+    files[5] = ('/5.js', (['n5'], ['n1'], False, False))
+    files.append(('/01.js', (['n01'], [], False, False)))
+    dep_files = self._create_dep_files(files)
+    self.assertTrue(table.update('/', dep_files))
+    new_table = DepsJsTable()
+    new_table.update('/', dep_files)
+    self.assertEqual(table.get_contents(), new_table.get_contents())
+    self.assertNotEqual(table.get_contents(), contents)
+
+    # All lines change with the base path
+    self.assertTrue(table.update('/x', dep_files))
+    self.assertTrue('../5.js' in table.get_contents())
+
+  def testWritten(self):
+    temp_path = tempfile.mkdtemp()
+    try:
+      path = os.path.join(temp_path, 'deps.js')
+      table = DepsJsTable()
+      table.update('/', self._create_dep_files([
+          ('/a.js', (['a'], [], False, False))]))
+      self.assertFalse(table.is_written(path))
+      with open(path, 'w') as f:
+        f.write(table.get_contents())
+      table.mark_written(path)
+      self.assertTrue(table.is_written(path))
+
+      table.update('/', self._create_dep_files([
+          ('/a.js', (['a'], ['b'], False, False))]))
+      self.assertFalse(table.is_written(path))
+      table.mark_written(path)
+      os.remove(path)
+      self.assertFalse(table.is_written(path))
+    finally:
+      shutil.rmtree(temp_path)
+
+
+class ClosureJsLibraryRuleTest(FixtureTestCase):
+  """Behavioral tests of the ClosureJsLibraryRule type."""
+  fixture = 'closure_js_rules/deps'
+
+  def setUp(self):
+    super(ClosureJsLibraryRuleTest, self).setUp()
+    self.build_env = BuildEnvironment(root_path=self.root_path)
+
+  def _build(self, rule_names):
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    with BuildContext(self.build_env, project) as ctx:
+      self.assertTrue(ctx.execute_sync(rule_names))
+
+  def testDeps(self):
+    self._build([':deps', ':header_deps'])
+    self.assertFileContents(
+        os.path.join(self.root_path, 'build-out', 'deps_files.txt'),
+        'js/base.js\njs/d.js\njs/c.js\njs/a.js\njs/css.js')
+    self.assertFileContents(
+        os.path.join(self.root_path, 'build-out', 'header_deps_files.txt'),
+        'js/base.js\njs/d.js\njs/c.js\njs/a.js\njs/css.js')
+    self.assertFileContents(
+        os.path.join(self.root_path, 'build-out', 'deps-deps.js'),
+        '// Automatically generated by anvil-build - do not modify\n\n'
+        'goog.addDependency(\'a.js\', [\'a.b\'], [\'c\', \'d\', \'e\']);\n'
+        'goog.addDependency(\'base.js\', [\'goog\'], []);\n'
+        'goog.addDependency(\'c.js\', [\'c\'], [\'d\']);\n'
+        'goog.addDependency(\'css.js\', [\'css\'], []);\n'
+        'goog.addDependency(\'d.js\', [\'d\', \'e\'], []);')
+    self.assertTrue(os.path.isfile(
+        os.path.join(self.root_path, '.build-cache', 'jsdeps')))
+    self.assertTrue(os.path.isfile(
+        os.path.join(self.root_path, '.build-cache', 'jsdeps-header')))
+
+  def testSharding(self):
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    # Rules are loaded from their own copy of the module
+    rule_module = sys.modules[type(project.resolve_rule(':deps')).__module__]
+    self.addCleanup(setattr, rule_module, '_SCAN_SHARD_SIZE',
+                    rule_module._SCAN_SHARD_SIZE)
+    rule_module._SCAN_SHARD_SIZE = 2
+
+    task_executor = _RecordingTaskExecutor()
+    with BuildContext(self.build_env, project,
+                      task_executor=task_executor) as ctx:
+      self.assertTrue(ctx.execute_sync([':deps']))
+    shard_sizes = [len(list(task.src_paths)) for task in task_executor.tasks
+                   if type(task).__name__ == '_ScanJsDependenciesTask']
+    self.assertEqual(shard_sizes, [2, 2, 1])
+    self.assertFileContents(
+        os.path.join(self.root_path, 'build-out', 'deps_files.txt'),
+        'js/base.js\njs/d.js\njs/c.js\njs/a.js\njs/css.js')
+
+
+  def testSharedGraphs(self):
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    task_executor = _RecordingTaskExecutor()
+    with BuildContext(self.build_env, project,
+                      task_executor=task_executor) as ctx:
+      self.assertTrue(ctx.execute_sync([':deps', ':deps_c', ':deps_d']))
+      # Identical sources share a graph, and files are only scanned once
+      graphs = ctx.shared_state['closure_js_deps']._graphs
+      self.assertEqual(len(graphs), 2)
+    scan_paths = []
+    for task in task_executor.tasks:
+      if type(task).__name__ == '_ScanJsDependenciesTask':
+        scan_paths.extend(task.src_paths)
+    self.assertEqual(len(scan_paths), 5)
+    self.assertFileContents(
+        os.path.join(self.root_path, 'build-out', 'deps_c_files.txt'),
+        'js/base.js\njs/d.js\njs/c.js\njs/css.js')
+    self.assertFileContents(
+        os.path.join(self.root_path, 'build-out', 'deps_d_files.txt'),
+        'js/base.js\njs/d.js')
+
+  def testSharedPendingScans(self):
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    task_executor = _RecordingTaskExecutor(complete_later=True)
+    with BuildContext(self.build_env, project,
+                      task_executor=task_executor) as ctx:
+      self.assertTrue(ctx.execute_sync([':deps', ':deps_c', ':deps_d']))
+      self.assertEqual(ctx.shared_state['closure_js_deps']._pending_scans, {})
+    # Files being scanned for one rule are not scanned again for another
+    scan_paths = []
+    for task in task_executor.tasks:
+      if type(task).__name__ == '_ScanJsDependenciesTask':
+        scan_paths.extend(task.src_paths)
+    self.assertEqual(len(scan_paths), 5)
+    self.assertFileContents(
+        os.path.join(self.root_path, 'build-out', 'deps_c_files.txt'),
+        'js/base.js\njs/d.js\njs/c.js\njs/css.js')
+
+  def testClosureCaching(self):
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    rule_cache = FileRuleCache(self.root_path)
+    def _build():
+      task_executor = _RecordingTaskExecutor(fake_java=True)
+      with BuildContext(self.build_env, project, rule_cache=rule_cache,
+                        task_executor=task_executor) as ctx:
+        self.assertTrue(ctx.execute_sync([':compiled_c']))
+      return [type(task).__name__ for task in task_executor.tasks]
+    def _touch(name, contents=None):
+      path = os.path.join(self.root_path, 'js', name)
+      if contents:
+        with open(path, 'a') as f:
+          f.write(contents)
+      mtime = os.path.getmtime(path) + 10
+      os.utime(path, (mtime, mtime))
+
+    self.assertEqual(_build(), ['_ScanJsDependenciesTask', 'WriteFileTask',
+                                'JavaExecutableTask'])
+    self.assertEqual(_build(), [])
+
+    # Files outside of the closure do not cause compilation
+    _touch('a.js', 'var y;\n')
+    self.assertEqual(_build(), ['_ScanJsDependenciesTask'])
+    # ...but changes to their dependencies update deps.js
+    _touch('a.js', 'goog.require(\'css\');\n')
+    self.assertEqual(_build(), ['_ScanJsDependenciesTask', 'WriteFileTask'])
+
+    # Any change in the closure compiles again
+    _touch('d.js')
+    self.assertEqual(_build(), ['_ScanJsDependenciesTask',
+                                'JavaExecutableTask'])
+    # ...as do changes to the compiler, but not touching it
+    _touch('../compiler.jar')
+    _touch('a.js')
+    self.assertEqual(_build(), ['_ScanJsDependenciesTask'])
+    _touch('../compiler.jar', 'x')
+    _touch('a.js')
+    self.assertEqual(_build(), ['_ScanJsDependenciesTask',
+                                'JavaExecutableTask'])
+
+
+class _RecordingTaskExecutor(InProcessTaskExecutor):
+  def __init__(self, fake_java=False, complete_later=False, *args, **kwargs):
+    super(_RecordingTaskExecutor, self).__init__(*args, **kwargs)
+    self.tasks = []
+    self.fake_java = fake_java
+    # Tasks are run from wait instead of before run_task_async returns
+    self.complete_later = complete_later
+    self._pending_tasks = []
+
+  def run_task_async(self, task):
+    self.tasks.append(task)
+    if self.complete_later:
+      deferred = Deferred()
+      self._pending_tasks.append((task, deferred))
+      return deferred
+    return self._run_task(task)
+
+  def wait(self, deferreds):
+    while self._pending_tasks:
+      (task, deferred) = self._pending_tasks.pop(0)
+      d = self._run_task(task)
+      d.add_callback_fn(deferred.callback)
+      d.add_errback_fn(deferred.errback)
+
+  def _run_task(self, task):
+    if self.fake_java and isinstance(task, JavaExecutableTask):
+      # Pretend to compile, as Java may not be available
+      for arg in task.call_args:
+        if arg.startswith('--js_output_file='):
+          with open(arg[len('--js_output_file='):], 'w') as f:
+            f.write('compiled')
+      deferred = Deferred()
+      deferred.callback()
+      return deferred
+    return super(_RecordingTaskExecutor, self).run_task_async(task)
+
+if __name__ == '__main__':
+  unittest2.main()
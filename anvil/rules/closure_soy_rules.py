@@ -9,19 +9,32 @@ closure_soy_library
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import collections
+import hashlib
 import os
 
+from anvil import async
 from anvil.context import RuleContext
 from anvil.rule import Rule, build_rule
 from anvil.task import Task, JavaExecutableTask
 
 
+# Maximum number of soy files compiled by each compiler process, unless a single
+# rule has more
+_BATCH_SIZE = 256
+
+
 @build_rule('closure_soy_library')
 class ClosureSoyLibraryRule(Rule):
   """A Closure Templates transformed file.
   Uses the Closure Templates compiler to translate input soy templates into
   JS files. Each input .soy file results in a single output .js file.
 
+  Only templates that changed since the rule last succeeded are compiled, and
+  the outputs of removed templates are deleted. All rules in a build that use
+  the same compiler and flags are compiled together, so that the compiler JVM is
+  started as few times as possible.
+
   Inputs:
     srcs: All source soy files.
     compiler_jar: Path to a compiler .jar file.
@@ -64,28 +77,181 @@ class ClosureSoyLibraryRule(Rule):
           '--bidiGlobalDir', '1',
           '--codeStyle', 'stringbuilder',
           '--cssHandlingScheme', 'goog',
+          # Outputs and inputs are relative to the root, so that the arguments
+          # are the same for all rules and they can be compiled together
+          '--inputPrefix', self.build_env.root_path + os.sep,
           '--outputPathFormat', os.path.join(
-              os.path.dirname(self._get_gen_path()),
-              '{INPUT_DIRECTORY}/{INPUT_FILE_NAME_NO_EXT}-soy.js'),
+              self.build_env.root_path, 'build-gen',
+              '{INPUT_DIRECTORY}{INPUT_FILE_NAME_NO_EXT}-soy.js'),
           ]
       args.extend(self.rule.compiler_flags)
 
+      output_paths = {}
       for src_path in self.src_paths:
-        output_path = os.path.splitext(self._get_gen_path_for_src(src_path))[0]
-        output_path += '-soy.js'
+        output_path = self._get_soy_output_path(src_path)
         self._ensure_output_exists(os.path.dirname(output_path))
         self._append_output_paths([output_path])
-        rel_path = os.path.relpath(src_path, self.build_env.root_path)
-        args.append(rel_path)
+        output_paths[src_path] = output_path
 
       # Skip if cache hit
       if self._check_if_cached():
         self._succeed()
         return
 
+      # Delete the outputs of removed templates
+      for src_path in self.file_delta.removed_files:
+        output_path = self._get_soy_output_path(src_path)
+        if not output_path in self.all_output_files:
+          try:
+            os.remove(output_path)
+          except OSError:
+            pass
+          self.build_context.stat_cache.invalidate_all([output_path])
+
+      # Each template is compiled to its own output, so only changed templates
+      # need to be compiled - unless the compiler or its arguments changed
       jar_path = self._resolve_input_files([self.rule.compiler_jar])[0]
-      d = self._run_task_async(JavaExecutableTask(
-          self.build_env, jar_path, args))
+      stat_cache = self.build_context.stat_cache
+      jar_st = stat_cache.stat(jar_path)
+      fingerprint = hashlib.md5(repr((
+          args, jar_st.st_mtime if jar_st else None,
+          jar_st.st_size if jar_st else None))).hexdigest()
+      rule_cache = self.build_context.cache
+      if (self.build_context.force or
+          rule_cache.get_fingerprint(self.rule.path, 'compile') !=
+              fingerprint):
+        compile_paths = self.src_paths
+      else:
+        changed_paths = set(self.file_delta.changed_files)
+        compile_paths = [src_path for src_path in self.src_paths
+                         if (src_path in changed_paths or
+                             not stat_cache.stat(output_paths[src_path]))]
+      if not compile_paths:
+        rule_cache.set_fingerprint(self.rule.path, 'compile', fingerprint)
+        self._succeed()
+        return
+
+      rel_paths = [os.path.relpath(src_path, self.build_env.root_path)
+                   for src_path in compile_paths]
+      batcher = _SoyCompileBatcher.get(self.build_context)
+      d = batcher.compile(self, jar_path, args, rel_paths)
+      d.add_callback_fn(
+          lambda *args, **kwargs: rule_cache.set_fingerprint(
+              self.rule.path, 'compile', fingerprint))
       # TODO(benvanik): pull out (stdout, stderr) from result and the exception
       #     to get better error logging
       self._chain(d)
+
+    def _get_soy_output_path(self, src_path):
+      output_path = os.path.splitext(self._get_gen_path_for_src(src_path))[0]
+      return output_path + '-soy.js'
+
+
+class _SoyCompileBatcher(object):
+  """Combines the compilation of closure_soy_library rules in a build.
+  Rules that begin together and use the same compiler and arguments are
+  compiled by as few compiler processes as possible. If a combined compilation
+  fails its rules are compiled again one by one, so that only the rules with
+  errors fail.
+  """
+
+  def __init__(self, build_context):
+    """Initializes a batcher.
+
+    Args:
+      build_context: BuildContext the batcher is used in.
+    """
+    self.build_context = build_context
+    # Lists of queued (rule_ctx, src_paths, deferred) by (jar_path, args)
+    self._queued = collections.OrderedDict()
+
+  @staticmethod
+  def get(build_context):
+    """Gets the batcher of a build.
+
+    Args:
+      build_context: BuildContext.
+
+    Returns:
+      The _SoyCompileBatcher of the build, created on first use.
+    """
+    batcher = build_context.shared_state.get('closure_soy_batches', None)
+    if not batcher:
+      batcher = _SoyCompileBatcher(build_context)
+      build_context.shared_state['closure_soy_batches'] = batcher
+    return batcher
+
+  def compile(self, rule_ctx, jar_path, args, src_paths):
+    """Queues the compilation of the sources of a rule.
+    Queued compilations are issued once all rules that are ready to begin
+    have begun.
+
+    Args:
+      rule_ctx: RuleContext of the rule.
+      jar_path: Compiler jar path.
+      args: A list of compiler arguments, excluding sources.
+      src_paths: A list of source paths to compile.
+
+    Returns:
+      A Deferred called back when the sources have been compiled.
+    """
+    deferred = async.Deferred()
+    schedule = not self._queued
+    self._queued.setdefault((jar_path, tuple(args)), []).append(
+        (rule_ctx, src_paths, deferred))
+    if schedule:
+      self.build_context.add_batch_callback(self._issue_queued)
+    return deferred
+
+  def _issue_queued(self):
+    queued = self._queued
+    self._queued = collections.OrderedDict()
+    for ((jar_path, compiler_args), requests) in queued.iteritems():
+      batch = []
+      batch_size = 0
+      for request in requests:
+        if batch and batch_size + len(request[1]) > _BATCH_SIZE:
+          self._compile_batch(jar_path, compiler_args, batch)
+          batch = []
+          batch_size = 0
+        batch.append(request)
+        batch_size += len(request[1])
+      self._compile_batch(jar_path, compiler_args, batch)
+
+  def _compile_batch(self, jar_path, compiler_args, batch):
+    """Compiles the sources of several rules with a single compiler process.
+
+    Args:
+      jar_path: Compiler jar path.
+      compiler_args: A tuple of compiler arguments, excluding sources.
+      batch: A list of (rule_ctx, src_paths, deferred) to compile.
+    """
+    call_args = list(compiler_args)
+    # Rules may share sources, which must only be compiled once
+    added_paths = set()
+    for (_, src_paths, _) in batch:
+      for src_path in src_paths:
+        if not src_path in added_paths:
+          added_paths.add(src_path)
+          call_args.append(src_path)
+    rule_ctx = batch[0][0]
+    pretty_name = str(rule_ctx.rule)
+    if len(batch) > 1:
+      pretty_name += ' (+%s more)' % (len(batch) - 1)
+    d = rule_ctx._run_task_async(JavaExecutableTask(
+        self.build_context.build_env, jar_path, call_args,
+        pretty_name=pretty_name))
+
+    def _compiled(*args, **kwargs):
+      for (_, _, deferred) in batch:
+        deferred.callback()
+    def _failed(*args, **kwargs):
+      if len(batch) == 1 or self.build_context.error_encountered:
+        for (_, _, deferred) in batch:
+          deferred.errback(*args, **kwargs)
+        return
+      # Find the rules with errors
+      for request in batch:
+        self._compile_batch(jar_path, compiler_args, [request])
+    d.add_callback_fn(_compiled)
+    d.add_errback_fn(_failed)
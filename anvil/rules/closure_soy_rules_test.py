@@ -0,0 +1,190 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the closure_soy_rules module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import sys
+import unittest2
+
+from anvil.async import Deferred
+from anvil.cache import FileRuleCache
+from anvil.context import BuildContext, BuildEnvironment
+from anvil.enums import Status
+from anvil.project import FileModuleResolver, Project
+from anvil.task import ExecutableError, InProcessTaskExecutor
+from anvil.test import FixtureTestCase
+from closure_soy_rules import *
+
+
+class ClosureSoyLibraryRuleTest(FixtureTestCase):
+  """Behavioral tests of the ClosureSoyLibraryRule type."""
+  fixture = 'closure_soy_rules/batch'
+
+  def setUp(self):
+    super(ClosureSoyLibraryRuleTest, self).setUp()
+    self.build_env = BuildEnvironment(root_path=self.root_path)
+
+  def _build(self, rule_names, rule_cache=None, complete_later=False):
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    task_executor = _FakeSoyTaskExecutor(complete_later=complete_later)
+    with BuildContext(self.build_env, project, rule_cache=rule_cache,
+                      task_executor=task_executor,
+                      raise_on_error=False) as ctx:
+      result = ctx.execute_sync(rule_names)
+      statuses = dict((rule_name, ctx.get_rule_results(rule_name)[0])
+                      for rule_name in rule_names)
+    return (result, statuses, sorted(task_executor.compiled_srcs))
+
+  def testBatching(self):
+    (result, _, compiled_srcs) = self._build([':a', ':b', ':flags'])
+    self.assertTrue(result)
+    self.assertEqual(compiled_srcs, [
+        ['a/a.soy', 'b/b.soy', 'b/c.soy'],
+        ['a/flags.soy'],
+        ])
+    for name in ['a/a', 'b/b', 'b/c', 'a/flags']:
+      self.assertTrue(os.path.isfile(
+          os.path.join(self.root_path, 'build-gen', name + '-soy.js')))
+
+  def testDependentBatching(self):
+    # Rules waiting on the same rule are compiled together once it completes,
+    # even when tasks complete after they are issued
+    for complete_later in [False, True]:
+      (result, _, compiled_srcs) = self._build([':p', ':q'],
+                                               complete_later=complete_later)
+      self.assertTrue(result)
+      self.assertEqual(compiled_srcs, [
+          ['p/p.soy', 'q/q.soy'],
+          ['x/x.soy'],
+          ])
+
+  def testBatchSize(self):
+    project = Project(module_resolver=FileModuleResolver(self.root_path))
+    rule_module = sys.modules[type(project.resolve_rule(':a')).__module__]
+    self.addCleanup(setattr, rule_module, '_BATCH_SIZE',
+                    rule_module._BATCH_SIZE)
+    rule_module._BATCH_SIZE = 2
+    task_executor = _FakeSoyTaskExecutor()
+    with BuildContext(self.build_env, project,
+                      task_executor=task_executor) as ctx:
+      self.assertTrue(ctx.execute_sync([':a', ':b']))
+    self.assertEqual(sorted(task_executor.compiled_srcs), [
+        ['a/a.soy'],
+        ['b/b.soy', 'b/c.soy'],
+        ])
+
+  def testFailure(self):
+    with open(os.path.join(self.root_path, 'b', 'c.soy'), 'w') as f:
+      f.write('BAD')
+    (result, statuses, compiled_srcs) = self._build([':a', ':b', ':flags'])
+    self.assertFalse(result)
+    # Rules are compiled on their own to find the ones that failed
+    self.assertEqual(compiled_srcs, [
+        ['a/a.soy'],
+        ['a/a.soy', 'b/b.soy', 'b/c.soy'],
+        ['a/flags.soy'],
+        ['b/b.soy', 'b/c.soy'],
+        ])
+    self.assertEqual(statuses, {
+        ':a': Status.SUCCEEDED,
+        ':b': Status.FAILED,
+        ':flags': Status.SUCCEEDED,
+        })
+
+
+  def testIncremental(self):
+    rule_cache = FileRuleCache(self.root_path)
+    def _build():
+      (result, _, compiled_srcs) = self._build([':glob'], rule_cache=rule_cache)
+      self.assertTrue(result)
+      return compiled_srcs
+    x_path = os.path.join(self.root_path, 'g', 'x.soy')
+    y_path = os.path.join(self.root_path, 'g', 'y.soy')
+    x_output_path = os.path.join(self.root_path, 'build-gen', 'g', 'x-soy.js')
+    y_output_path = os.path.join(self.root_path, 'build-gen', 'g', 'y-soy.js')
+
+    self.assertEqual(_build(), [['g/x.soy', 'g/y.soy']])
+    self.assertEqual(_build(), [])
+
+    # Only changed templates are compiled
+    with open(y_path, 'a') as f:
+      f.write('\n')
+    mtime = os.path.getmtime(y_path) + 10
+    os.utime(y_path, (mtime, mtime))
+    self.assertEqual(_build(), [['g/y.soy']])
+
+    # Missing outputs are compiled again
+    os.remove(y_output_path)
+    with open(x_path, 'a') as f:
+      f.write('\n')
+    self.assertEqual(_build(), [['g/x.soy', 'g/y.soy']])
+
+    # Outputs of removed templates are deleted
+    os.remove(x_path)
+    self.assertEqual(_build(), [])
+    self.assertFalse(os.path.exists(x_output_path))
+    self.assertTrue(os.path.exists(y_output_path))
+
+
+class _FakeSoyTaskExecutor(InProcessTaskExecutor):
+  """Pretends to run the soy compiler, as Java may not be available.
+  Sources containing 'BAD' fail to compile.
+  """
+
+  def __init__(self, complete_later=False, *args, **kwargs):
+    """Initializes a fake executor.
+
+    Args:
+      complete_later: True to complete tasks from wait instead of before
+          run_task_async returns, like the multiprocess executor.
+    """
+    super(_FakeSoyTaskExecutor, self).__init__(*args, **kwargs)
+    self.compiled_srcs = []
+    self.complete_later = complete_later
+    self._pending_tasks = []
+
+  def run_task_async(self, task):
+    if not self.complete_later:
+      return self._run_task(task)
+    deferred = Deferred()
+    self._pending_tasks.append((task, deferred))
+    return deferred
+
+  def wait(self, deferreds):
+    while self._pending_tasks:
+      (task, deferred) = self._pending_tasks.pop(0)
+      d = self._run_task(task)
+      d.add_callback_fn(deferred.callback)
+      d.add_errback_fn(deferred.errback)
+
+  def _run_task(self, task):
+    args = task.call_args
+    input_prefix = args[args.index('--inputPrefix') + 1]
+    output_format = args[args.index('--outputPathFormat') + 1]
+    src_paths = [arg for arg in args if arg.endswith('.soy')]
+    self.compiled_srcs.append(sorted(src_paths))
+    deferred = Deferred()
+    for src_path in src_paths:
+      with open(input_prefix + src_path) as f:
+        if 'BAD' in f.read():
+          deferred.errback(exception=ExecutableError(return_code=1))
+          return deferred
+    for src_path in src_paths:
+      (src_dir, src_name) = os.path.split(src_path)
+      output_path = output_format.replace(
+          '{INPUT_DIRECTORY}', src_dir + os.sep if src_dir else '').replace(
+          '{INPUT_FILE_NAME_NO_EXT}', os.path.splitext(src_name)[0])
+      with open(output_path, 'w') as f:
+        f.write('compiled')
+    deferred.callback()
+    return deferred
+
+
+if __name__ == '__main__':
+  unittest2.main()
@@ -15,7 +15,7 @@ import string
 
 from anvil.context import RuleContext
 from anvil.rule import Rule, build_rule
-from anvil.task import Task, ExecutableTask
+from anvil.task import Task, ExecutableTask, PackedPathList
 import anvil.util
 
 
@@ -182,7 +182,7 @@ class CopyFilesRule(Rule):
 class _CopyFilesTask(Task):
   def __init__(self, build_env, file_pairs, *args, **kwargs):
     super(_CopyFilesTask, self).__init__(build_env, *args, **kwargs)
-    self.file_pairs = file_pairs
+    self.file_pairs = PackedPathList(file_pairs, width=2)
 
   def execute(self):
     for file_pair in self.file_pairs:
@@ -244,7 +244,7 @@ class ConcatFilesRule(Rule):
 class _ConcatFilesTask(Task):
   def __init__(self, build_env, src_paths, output_path, *args, **kwargs):
     super(_ConcatFilesTask, self).__init__(build_env, *args, **kwargs)
-    self.src_paths = src_paths
+    self.src_paths = PackedPathList(src_paths)
     self.output_path = output_path
 
   def execute(self):
@@ -327,7 +327,7 @@ class _EmbedFilesRuleTask(Task):
       encoding, replace_chars, *args, **kwargs):
     super(_EmbedFilesRuleTask, self).__init__(build_env, *args, **kwargs)
     self.rule_path = rule_path
-    self.src_paths = src_paths
+    self.src_paths = PackedPathList(src_paths)
     self.output_path = output_path
     self.wrapper = wrapper
     self.encoding = encoding
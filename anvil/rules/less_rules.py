@@ -9,8 +9,11 @@ less_css_library
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import hashlib
 import os
+import re
 
+from anvil.cache import FileScanCache
 from anvil.context import RuleContext
 from anvil.rule import Rule, build_rule
 from anvil.task import Task, NodeExecutableTask
@@ -25,6 +28,9 @@ class LessCssLibraryRule(Rule):
   Only the first source will be used as the root to less. The rest will be
   treated as dependencies.
 
+  The root is scanned for @import statements to find all of the files it uses,
+  wherever they are, and the rule only runs again when one of those changes.
+
   Inputs:
     srcs: The root LESS file..
     include_paths: Paths to search for include files.
@@ -80,8 +86,8 @@ class LessCssLibraryRule(Rule):
       args.append(self.src_paths[0])
       args.append(output_path)
 
-      # Skip if cache hit
-      if self._check_if_cached():
+      # Skip if nothing the root imports changed
+      if self._check_if_imports_cached(args):
         self._succeed()
         return
 
@@ -90,3 +96,150 @@ class LessCssLibraryRule(Rule):
       # TODO(benvanik): pull out (stdout, stderr) from result and the exception
       #     to get better error logging
       self._chain(d)
+
+    def _check_if_imports_cached(self, args):
+      """Checks if the root, everything it imports and the compiler arguments
+      match their values from the last successful run.
+      Stylesheets with imports that cannot be resolved statically fall back to
+      checking all sources.
+
+      Args:
+        args: Compiler arguments.
+
+      Returns:
+        True if nothing used by the compilation has changed.
+      """
+      if self.build_context.force:
+        return False
+      rule_cache = self.build_context.cache
+
+      include_paths = [os.path.join(self.build_env.root_path, include_path)
+                       for include_path in self.rule.include_paths]
+      scanner = LessImportScanner(
+          include_paths,
+          scan_cache=_get_import_scan_cache(self.build_context),
+          stat_cache=self.build_context.stat_cache)
+      (import_paths, complete) = scanner.get_import_closure(self.src_paths[0])
+      import_delta = rule_cache.compute_delta(
+          self.rule.path, 'imports', import_paths)
+      if not complete:
+        return self._check_if_cached()
+
+      output_delta = rule_cache.compute_delta(
+          self.rule.path, 'out', self.all_output_files)
+      fingerprint = hashlib.md5(repr(args)).hexdigest()
+      if (import_delta.any_changes() or
+          len(output_delta.removed_files) or
+          rule_cache.get_fingerprint(self.rule.path, 'compile') !=
+              fingerprint):
+        rule_cache.set_fingerprint(self.rule.path, 'compile', fingerprint)
+        return False
+      return True
+
+
+def _get_import_scan_cache(build_context):
+  """Gets the import scan cache shared by all less_css_library rules in a build.
+  The cache is loaded on first use and saved once the build completes, as rules
+  saving their own copies would overwrite each other's results.
+
+  Args:
+    build_context: BuildContext.
+
+  Returns:
+    The FileScanCache of the build.
+  """
+  scan_cache = build_context.shared_state.get('less_import_scan_cache', None)
+  if not scan_cache:
+    scan_cache = FileScanCache(build_context.build_env.root_path, 'lessimports')
+    build_context.shared_state['less_import_scan_cache'] = scan_cache
+    build_context.add_exit_callback(scan_cache.save)
+  return scan_cache
+
+
+class LessImportScanner(object):
+  """Finds the files imported by LESS stylesheets.
+  Imports are resolved the same way lessc resolves them: relative to the
+  importing file and then in each include path, adding a .less extension to
+  names without one.
+  """
+
+  _IMPORT_REGEX = re.compile(
+      '@import(?:-once|-multiple)?\s*(?:\([^)]*\)\s*)?'
+      '(?:url\(\s*)?[\'"]([^\'"]+)[\'"]')
+
+  def __init__(self, include_paths=None, scan_cache=None, stat_cache=None):
+    """Initializes an import scanner.
+
+    Args:
+      include_paths: A list of absolute paths searched for imported files.
+      scan_cache: A FileScanCache to reuse the results of previous scans from,
+          if any.
+      stat_cache: A StatCache used to check for imported files, if any.
+    """
+    self.include_paths = list(include_paths or [])
+    self.scan_cache = scan_cache
+    self.stat_cache = stat_cache
+
+  @staticmethod
+  def _scan(contents):
+    """Scans stylesheet contents for imports.
+
+    Args:
+      contents: File contents, as a str.
+
+    Returns:
+      A list of imported names, in order.
+    """
+    if contents.find('@import') == -1:
+      return []
+    return LessImportScanner._IMPORT_REGEX.findall(contents)
+
+  def _scan_path(self, path):
+    if self.scan_cache:
+      return self.scan_cache.scan(path, LessImportScanner._scan)
+    with open(path, 'rb') as f:
+      return LessImportScanner._scan(f.read())
+
+  def get_import_closure(self, src_path):
+    """Gets all files a stylesheet imports, directly or indirectly.
+    Besides the files found, the result includes the paths searched before
+    them, and those searched for imports that were not found. Any of these
+    appearing changes how the stylesheet compiles.
+
+    Args:
+      src_path: Root stylesheet path.
+
+    Returns:
+      A tuple of (paths, complete) with a sorted list of the root path and all
+      paths that affect its imports, and False if any of its imports could not
+      be resolved statically (such as those using variables).
+    """
+    isfile = self.stat_cache.isfile if self.stat_cache else os.path.isfile
+    src_path = os.path.normpath(src_path)
+    paths = set([src_path])
+    complete = True
+    pending_paths = [src_path]
+    while pending_paths:
+      path = pending_paths.pop()
+      try:
+        names = self._scan_path(path)
+      except (IOError, OSError):
+        continue
+      for name in names:
+        if name.find('@{') != -1:
+          complete = False
+          continue
+        if name.find('://') != -1 or name.startswith('//'):
+          continue
+        if not os.path.splitext(name)[1]:
+          name += '.less'
+        search_paths = [os.path.dirname(path)] + self.include_paths
+        for search_path in search_paths:
+          import_path = os.path.normpath(os.path.join(search_path, name))
+          is_new = not import_path in paths
+          paths.add(import_path)
+          if isfile(import_path):
+            if is_new:
+              pending_paths.append(import_path)
+            break
+    return (sorted(paths), complete)
@@ -0,0 +1,124 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the less_rules module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import unittest2
+
+from anvil.async import Deferred
+from anvil.cache import FileRuleCache, FileScanCache, StatCache
+from anvil.context import BuildContext, BuildEnvironment
+from anvil.project import FileModuleResolver, Project
+from anvil.task import InProcessTaskExecutor
+from anvil.test import FixtureTestCase
+from less_rules import *
+
+
+class LessImportScannerTest(FixtureTestCase):
+  """Behavioral tests of the LessImportScanner type."""
+  fixture = 'less_rules/imports'
+
+  def testScan(self):
+    self.assertEqual(LessImportScanner._scan('.a { }'), [])
+    self.assertEqual(LessImportScanner._scan(
+        '@import "a";\n'
+        '@import (reference) \'b.less\';\n'
+        '@import url("c.css");\n'
+        '@import-once "@{x}/d";\n'), ['a', 'b.less', 'c.css', '@{x}/d'])
+
+  def testImportClosure(self):
+    root_path = self.root_path
+    scanner = LessImportScanner([os.path.join(root_path, 'include')],
+                                scan_cache=FileScanCache(),
+                                stat_cache=StatCache())
+    (paths, complete) = scanner.get_import_closure(
+        os.path.join(root_path, 'style.less'))
+    self.assertTrue(complete)
+    self.assertEqual(paths, sorted(os.path.join(root_path, path) for path in [
+        'style.less', 'a.less', 'shared/s.less',
+        # Searched before the include path
+        'lib.less', 'include/lib.less']))
+
+    with open(os.path.join(root_path, 'a.less'), 'a') as f:
+      f.write('@import "@{dir}/x";\n@import "missing";\n')
+    scanner = LessImportScanner()
+    (paths, complete) = scanner.get_import_closure(
+        os.path.join(root_path, 'style.less'))
+    self.assertFalse(complete)
+    self.assertTrue(os.path.join(root_path, 'missing.less') in paths)
+
+
+class LessCssLibraryRuleTest(FixtureTestCase):
+  """Behavioral tests of the LessCssLibraryRule type."""
+  fixture = 'less_rules/imports'
+
+  def setUp(self):
+    super(LessCssLibraryRuleTest, self).setUp()
+    self.build_env = BuildEnvironment(root_path=self.root_path)
+
+  def testImports(self):
+    rule_cache = FileRuleCache(self.root_path)
+    def _build():
+      project = Project(module_resolver=FileModuleResolver(self.root_path))
+      task_executor = _FakeLessTaskExecutor()
+      with BuildContext(self.build_env, project, rule_cache=rule_cache,
+                        task_executor=task_executor) as ctx:
+        self.assertTrue(ctx.execute_sync([':style']))
+      return task_executor.compile_count
+    def _write(path, contents):
+      path = os.path.join(self.root_path, path)
+      with open(path, 'a') as f:
+        f.write(contents)
+      mtime = os.path.getmtime(path) + 10
+      os.utime(path, (mtime, mtime))
+
+    self.assertEqual(_build(), 1)
+    self.assertEqual(_build(), 0)
+
+    # Scans are saved once the build completes
+    scan_cache = FileScanCache(self.root_path, 'lessimports')
+    self.assertIn(os.path.join(self.root_path, 'style.less'), scan_cache.data)
+
+    # Sources that are not imported do not matter
+    _write('unused.less', '.x { }\n')
+    self.assertEqual(_build(), 0)
+
+    # Imports are followed outside of the include paths
+    _write('shared/s.less', '@width: 1px;\n')
+    self.assertEqual(_build(), 1)
+
+    # New files that change how imports resolve are noticed
+    _write('lib.less', '.lib2 { }\n')
+    self.assertEqual(_build(), 1)
+    self.assertEqual(_build(), 0)
+
+    # Removed outputs are rebuilt
+    os.remove(os.path.join(self.root_path, 'build-out', 'style.css'))
+    self.assertEqual(_build(), 1)
+
+
+class _FakeLessTaskExecutor(InProcessTaskExecutor):
+  """Pretends to run lessc, as Node may not be available.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(_FakeLessTaskExecutor, self).__init__(*args, **kwargs)
+    self.compile_count = 0
+
+  def run_task_async(self, task):
+    self.compile_count += 1
+    with open(task.call_args[-1], 'w') as f:
+      f.write('compiled')
+    deferred = Deferred()
+    deferred.callback()
+    return deferred
+
+
+if __name__ == '__main__':
+  unittest2.main()
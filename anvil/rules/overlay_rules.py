@@ -10,7 +10,7 @@ import os
 
 from anvil.context import RuleContext
 from anvil.rule import Rule, build_rule
-from anvil.task import Task
+from anvil.task import Task, PackedPathList
 import anvil.util
 
 
@@ -79,7 +79,7 @@ class OverlayViewRule(Rule):
 class _SymlinkTask(Task):
   def __init__(self, build_env, paths, output_path, *args, **kwargs):
     super(_SymlinkTask, self).__init__(build_env, *args, **kwargs)
-    self.paths = paths
+    self.paths = PackedPathList(paths, width=2)
     self.output_path = output_path
 
   def execute(self):
@@ -14,7 +14,7 @@ import string
 
 from anvil.context import RuleContext
 from anvil.rule import Rule, build_rule
-from anvil.task import Task, ExecutableTask
+from anvil.task import Task, ExecutableTask, PackedPathList
 
 
 @build_rule('template_files')
@@ -83,9 +83,11 @@ class TemplateFilesRule(Rule):
 
 
 class _TemplateFilesTask(Task):
+  shared_attrs = Task.shared_attrs + ('params',)
+
   def __init__(self, build_env, file_pairs, params, *args, **kwargs):
     super(_TemplateFilesTask, self).__init__(build_env, *args, **kwargs)
-    self.file_pairs = file_pairs
+    self.file_pairs = PackedPathList(file_pairs, width=2)
     self.params = params
 
   def execute(self):
@@ -157,7 +159,7 @@ class StripCommentsRule(Rule):
 class _StripCommentsRuleTask(Task):
   def __init__(self, build_env, file_pairs, *args, **kwargs):
     super(_StripCommentsRuleTask, self).__init__(build_env, *args, **kwargs)
-    self.file_pairs = file_pairs
+    self.file_pairs = PackedPathList(file_pairs, width=2)
 
   def execute(self):
     for file_pair in self.file_pairs:
@@ -242,9 +244,11 @@ class PreprocessRule(Rule):
 
 
 class _PreprocessFilesTask(Task):
+  shared_attrs = Task.shared_attrs + ('defines',)
+
   def __init__(self, build_env, file_pairs, defines, *args, **kwargs):
     super(_PreprocessFilesTask, self).__init__(build_env, *args, **kwargs)
-    self.file_pairs = file_pairs
+    self.file_pairs = PackedPathList(file_pairs, width=2)
     self.defines = defines
 
   def execute(self):
@@ -0,0 +1,234 @@
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Static file serving support for the serve command.
+
+URL paths are resolved against a set of overlay roots (build outputs first, then
+the project itself) through a PathIndex that remembers every resolution until a
+change journal reports that one of the files involved changed. Small files are
+kept in memory by a ContentCache.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import collections
+import os
+import stat
+
+
+# Paths searched, relative to the root, before the root itself
+DEFAULT_SEARCH_PATHS = ['build-out', 'build-gen',]
+
+
+def compute_etag(st):
+  """Computes an entity tag for a file.
+
+  Args:
+    st: os.stat result of the file.
+
+  Returns:
+    A quoted ETag value that changes whenever the file does.
+  """
+  return '"%x-%x"' % (int(st.st_mtime * 1000000), st.st_size)
+
+
+class ServedFile(object):
+  """A file resolved from a URL path.
+  """
+
+  def __init__(self, path, st, gzip_path=None, gzip_st=None):
+    """Initializes a served file.
+
+    Args:
+      path: Absolute file path.
+      st: os.stat result of the file.
+      gzip_path: Absolute path of a precompressed version of the file, if any.
+      gzip_st: os.stat result of the precompressed file.
+    """
+    self.path = path
+    self.size = st.st_size
+    self.mtime = st.st_mtime
+    self.etag = compute_etag(st)
+    self.gzip_path = gzip_path
+    self.gzip_size = gzip_st.st_size if gzip_st else None
+    self.gzip_etag = compute_etag(gzip_st) if gzip_st else None
+
+
+class PathIndex(object):
+  """Maps URL paths to files across overlay roots.
+  Resolutions, including misses, are remembered until the change journal
+  reports a change to any file that was considered for them.
+  """
+
+  def __init__(self, root_path, change_journal,
+               search_paths=DEFAULT_SEARCH_PATHS):
+    """Initializes a path index.
+
+    Args:
+      root_path: Root path of the server.
+      change_journal: A ChangeJournal recording changes under the root path.
+      search_paths: Paths relative to the root to search, in order, before the
+          root itself.
+    """
+    self.root_path = os.path.normpath(root_path)
+    self.change_journal = change_journal
+    self.search_roots = [os.path.join(self.root_path, search_path)
+                         for search_path in search_paths]
+    self.search_roots.append(self.root_path)
+    self._clock = change_journal.clock
+    # ServedFiles (or None if not found) by URL path
+    self._entries = {}
+    # URL paths by each file path considered when resolving them
+    self._url_paths_by_file = {}
+    # All directories containing considered file paths
+    self._dir_paths = set()
+
+  def lookup(self, url_path):
+    """Resolves a URL path to a file.
+
+    Args:
+      url_path: A '/'-separated path relative to the server root.
+
+    Returns:
+      A ServedFile, or None if the path does not resolve to a regular file.
+    """
+    self._sync()
+    try:
+      return self._entries[url_path]
+    except KeyError:
+      pass
+    served_file = None
+    rel_path = _get_rel_path(url_path)
+    if rel_path:
+      candidate_paths = []
+      for search_root in self.search_roots:
+        path = os.path.join(search_root, rel_path)
+        candidate_paths.append(path)
+        served_file = self._resolve_file(path)
+        if served_file:
+          candidate_paths.append(path + '.gz')
+          break
+      self._add_entry(url_path, served_file, candidate_paths)
+    return served_file
+
+  def _resolve_file(self, path):
+    try:
+      st = os.stat(path)
+    except OSError:
+      return None
+    if not stat.S_ISREG(st.st_mode):
+      return None
+    gzip_path = path + '.gz'
+    try:
+      gzip_st = os.stat(gzip_path)
+    except OSError:
+      gzip_st = None
+    # Stale precompressed files are ignored
+    if (not gzip_st or not stat.S_ISREG(gzip_st.st_mode) or
+        gzip_st.st_mtime < st.st_mtime):
+      return ServedFile(path, st)
+    return ServedFile(path, st, gzip_path=gzip_path, gzip_st=gzip_st)
+
+  def _add_entry(self, url_path, served_file, candidate_paths):
+    self._entries[url_path] = served_file
+    for path in candidate_paths:
+      self._url_paths_by_file.setdefault(path, set()).add(url_path)
+      path = os.path.dirname(path)
+      while len(path) > len(self.root_path) and not path in self._dir_paths:
+        self._dir_paths.add(path)
+        path = os.path.dirname(path)
+
+  def _sync(self):
+    """Drops all entries affected by changes recorded since the last sync.
+    """
+    (self._clock, changed_paths) = self.change_journal.get_changes_since(
+        self._clock)
+    if changed_paths is None:
+      self.clear()
+      return
+    for path in changed_paths:
+      self._remove_file(path)
+      if path in self._dir_paths:
+        # Directory moves and deletions may not be reported per file
+        self._dir_paths.discard(path)
+        prefix = path + os.sep
+        for file_path in [file_path for file_path in self._url_paths_by_file
+                          if file_path.startswith(prefix)]:
+          self._remove_file(file_path)
+
+  def _remove_file(self, path):
+    for url_path in self._url_paths_by_file.pop(path, ()):
+      self._entries.pop(url_path, None)
+
+  def clear(self):
+    """Drops all entries.
+    """
+    self._entries.clear()
+    self._url_paths_by_file.clear()
+    self._dir_paths.clear()
+
+
+def _get_rel_path(url_path):
+  """Converts a URL path to a relative file path.
+
+  Args:
+    url_path: A '/'-separated URL path.
+
+  Returns:
+    A relative file path, or None if the URL path is a directory or would
+    escape the root.
+  """
+  segments = url_path.split('/')
+  for segment in segments:
+    if (not segment or segment in ['.', '..'] or os.sep in segment or
+        '\0' in segment):
+      return None
+  return os.path.join(*segments)
+
+
+class ContentCache(object):
+  """A least-recently-used cache of small file contents.
+  Contents are keyed by path and ETag, so changed files are never returned.
+  """
+
+  def __init__(self, max_size=64 * 1024 * 1024, max_file_size=256 * 1024):
+    """Initializes a content cache.
+
+    Args:
+      max_size: Maximum total size of all cached contents, in bytes.
+      max_file_size: Maximum size of a single cached file, in bytes.
+    """
+    self.max_size = max_size
+    self.max_file_size = max_file_size
+    self.size = 0
+    # Contents by (path, etag), from least to most recently used
+    self._contents = collections.OrderedDict()
+
+  def get(self, path, etag, size):
+    """Gets the contents of a file, reading it if it is small enough.
+
+    Args:
+      path: Absolute file path.
+      etag: ETag of the file.
+      size: Size of the file, in bytes.
+
+    Returns:
+      The file contents, or None if the file is too large to be cached or could
+      not be read.
+    """
+    if size > self.max_file_size:
+      return None
+    key = (path, etag)
+    data = self._contents.pop(key, None)
+    if data is None:
+      try:
+        with open(path, 'rb') as f:
+          data = f.read()
+      except IOError:
+        return None
+      self.size += len(data)
+      while self.size > self.max_size and self._contents:
+        (_, old_data) = self._contents.popitem(last=False)
+        self.size -= len(old_data)
+    self._contents[key] = data
+    return data
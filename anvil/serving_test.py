@@ -0,0 +1,147 @@
+#!/usr/bin/python
+
+# Copyright 2012 Google Inc. All Rights Reserved.
+
+"""Tests for the serving module.
+"""
+
+__author__ = 'benvanik@google.com (Ben Vanik)'
+
+
+import os
+import shutil
+import time
+import unittest2
+
+from anvil.journal import ChangeJournal
+from anvil.serving import ContentCache, PathIndex
+from anvil.test import FixtureTestCase
+
+
+class PathIndexTest(FixtureTestCase):
+  """Behavioral tests of the PathIndex type."""
+  fixture = 'simple'
+
+  def setUp(self):
+    super(PathIndexTest, self).setUp()
+    self.journal = ChangeJournal()
+    self.index = PathIndex(self.root_path, self.journal)
+
+  def _write(self, rel_path, contents, mtime=None):
+    path = os.path.join(self.root_path, rel_path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+      f.write(contents)
+    if mtime:
+      os.utime(path, (mtime, mtime))
+    return path
+
+  def testLookup(self):
+    index = self.index
+    a_path = os.path.join(self.root_path, 'a.txt')
+    served_file = index.lookup('a.txt')
+    self.assertEqual(served_file.path, a_path)
+    self.assertEqual(served_file.size, os.path.getsize(a_path))
+    self.assertIsNone(served_file.gzip_path)
+    self.assertIs(index.lookup('a.txt'), served_file)
+
+    self.assertIsNotNone(index.lookup('dir/dir_2/d.txt'))
+    self.assertIsNone(index.lookup('x.txt'))
+    self.assertIsNone(index.lookup(''))
+    self.assertIsNone(index.lookup('dir'))
+    self.assertIsNone(index.lookup('dir/'))
+    self.assertIsNone(index.lookup('../simple/a.txt'))
+    self.assertIsNone(index.lookup('dir/../a.txt'))
+
+  def testOverlays(self):
+    index = self.index
+    self._write('build-gen/a.txt', 'gen')
+    self.assertEqual(index.lookup('a.txt').path,
+                     os.path.join(self.root_path, 'build-gen', 'a.txt'))
+    out_path = self._write('build-out/a.txt', 'out')
+    self.assertEqual(index.lookup('a.txt').path,
+                     os.path.join(self.root_path, 'build-gen', 'a.txt'))
+    self.journal.record([out_path])
+    self.assertEqual(index.lookup('a.txt').path, out_path)
+
+  def testInvalidation(self):
+    index = self.index
+    x_path = os.path.join(self.root_path, 'x.txt')
+    self.assertIsNone(index.lookup('x.txt'))
+    self._write('x.txt', 'x')
+    self.assertIsNone(index.lookup('x.txt'))
+    self.journal.record([x_path])
+    served_file = index.lookup('x.txt')
+    self.assertEqual(served_file.size, 1)
+
+    self._write('x.txt', 'xyz')
+    self.journal.record([x_path])
+    self.assertEqual(index.lookup('x.txt').size, 3)
+    self.assertNotEqual(index.lookup('x.txt').etag, served_file.etag)
+
+    # Directory changes invalidate everything under them
+    d_path = os.path.join(self.root_path, 'dir', 'dir_2', 'd.txt')
+    self.assertEqual(index.lookup('dir/dir_2/d.txt').path, d_path)
+    shutil.rmtree(os.path.join(self.root_path, 'dir'))
+    self.journal.record([os.path.join(self.root_path, 'dir')])
+    self.assertIsNone(index.lookup('dir/dir_2/d.txt'))
+
+    # Lost changes invalidate everything
+    os.remove(x_path)
+    self.journal.max_changes = 1
+    self.journal.record([os.path.join(self.root_path, 'y.txt')])
+    self.journal.record([os.path.join(self.root_path, 'z.txt')])
+    self.assertIsNone(index.lookup('x.txt'))
+
+  def testGzip(self):
+    index = self.index
+    now = time.time()
+    self._write('x.js', 'x', mtime=now)
+    gzip_path = self._write('x.js.gz', 'gz', mtime=now + 1)
+    served_file = index.lookup('x.js')
+    self.assertEqual(served_file.gzip_path, gzip_path)
+    self.assertEqual(served_file.gzip_size, 2)
+    self.assertNotEqual(served_file.gzip_etag, served_file.etag)
+
+    # Stale precompressed files are not used
+    os.utime(gzip_path, (now - 1, now - 1))
+    self.journal.record([gzip_path])
+    self.assertIsNone(index.lookup('x.js').gzip_path)
+
+
+class ContentCacheTest(FixtureTestCase):
+  """Behavioral tests of the ContentCache type."""
+  fixture = 'simple'
+
+  def testCache(self):
+    cache = ContentCache(max_size=8, max_file_size=4)
+    paths = []
+    for name in ['x', 'y', 'z']:
+      path = os.path.join(self.root_path, name)
+      with open(path, 'w') as f:
+        f.write(name * 4)
+      paths.append(path)
+    self.assertIsNone(cache.get(paths[0], 'e', 5))
+    self.assertEqual(cache.get(paths[0], 'e', 4), 'xxxx')
+    self.assertEqual(cache.get(paths[1], 'e', 4), 'yyyy')
+    self.assertEqual(cache.size, 8)
+
+    # Cached contents are used until their ETag changes
+    with open(paths[0], 'w') as f:
+      f.write('XXXX')
+    self.assertEqual(cache.get(paths[0], 'e', 4), 'xxxx')
+    self.assertEqual(cache.get(paths[0], 'f', 4), 'XXXX')
+
+    # The least recently used contents are dropped first
+    self.assertEqual(cache.size, 8)
+    self.assertEqual(cache.get(paths[2], 'e', 4), 'zzzz')
+    self.assertEqual(cache.size, 8)
+    with open(paths[0], 'w') as f:
+      f.write('0000')
+    self.assertEqual(cache.get(paths[0], 'f', 4), 'XXXX')
+    self.assertIsNone(cache.get(os.path.join(self.root_path, 'w'), 'e', 4))
+
+
+if __name__ == '__main__':
+  unittest2.main()
@@ -6,17 +6,38 @@
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import collections
 import copy
+import cPickle
+import hashlib
 import io
+import itertools
 import multiprocessing
+import multiprocessing.pool
 import os
 import re
+import shutil
+import signal
+import StringIO
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
 
-from anvil.async import Deferred
+try:
+  import resource
+except ImportError: # pragma: no cover
+  # Not available on Windows - resource accounting will only track wall time
+  resource = None
+
+from anvil.async import Deferred, DeferredCancelledError
+from anvil import util
+
+
+# Number of TaskResourceUsage records kept by a TaskExecutor
+_MAX_RESOURCE_USAGE_COUNT = 10000
 
 
 class Task(object):
@@ -32,14 +53,32 @@ class Task(object):
       log/progress messages?
   """
 
-  def __init__(self, build_env, pretty_name=None, *args, **kwargs):
+  # Names of attributes holding per-build constant state (such as the build
+  # environment or read-only rule parameters). Executors that run tasks in other
+  # processes may send these once per worker and pass only a reference with
+  # each task. Tasks with equal values share them.
+  shared_attrs = ('build_env',)
+
+  # Resources the task is expected to hold while running, used by executors to
+  # limit how many heavy tasks run at once. Common keys are 'cpu' (slots) and
+  # 'memory' (MB). Missing keys are treated as 0.
+  resource_weights = {'cpu': 1}
+
+  def __init__(self, build_env, pretty_name=None, resource_weights=None,
+               *args, **kwargs):
     """Initializes a task.
 
     Args:
       build_env: The build environment for state.
+      pretty_name: A name used when logging.
+      resource_weights: A dictionary of resource weights overriding those of
+          the task type, such as {'memory': 2048}.
     """
     self.build_env = build_env
     self.pretty_name = pretty_name or str(self)
+    if resource_weights:
+      self.resource_weights = dict(self.resource_weights)
+      self.resource_weights.update(resource_weights)
 
   def execute(self):
     """Executes the task.
@@ -57,6 +96,58 @@ class Task(object):
     raise NotImplementedError()
 
 
+class PackedPathList(object):
+  """A compact, read-only list of paths for passing to tasks.
+  Large lists of path strings (or tuples of paths) are expensive to pickle as
+  each element becomes its own object. This packs all of them into a single
+  NUL-delimited buffer that pickles as one string and is unpacked lazily on
+  iteration.
+  """
+
+  def __init__(self, items=None, width=1):
+    """Initializes a packed path list.
+
+    Args:
+      items: A list of paths, or a list of path tuples if width > 1.
+      width: Number of paths in each item. Items are yielded as tuples of this
+          length when it is greater than 1.
+    """
+    self.width = width
+    self._count = 0
+    # Unpacked items, cached on first index
+    self._items = None
+    parts = []
+    for item in items or []:
+      if width == 1:
+        parts.append(item)
+      else:
+        assert len(item) == width
+        parts.extend(item)
+      self._count += 1
+    self._buffer = '\0'.join(parts)
+
+  def __len__(self):
+    return self._count
+
+  def __iter__(self):
+    if not self._count:
+      return iter([])
+    parts = self._buffer.split('\0')
+    if self.width == 1:
+      return iter(parts)
+    return itertools.izip(*([iter(parts)] * self.width))
+
+  def __getitem__(self, index):
+    if self._items is None:
+      self._items = list(self)
+    return self._items[index]
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_items'] = None
+    return state
+
+
 class WriteFileTask(Task):
   """A task that writes a string to a file.
   """
@@ -83,6 +174,8 @@ class MakoTemplateTask(Task):
   """A task that applies a Mako template and writes the results.
   """
 
+  shared_attrs = Task.shared_attrs + ('template_args',)
+
   def __init__(self, build_env, path, template_path, template_args,
       *args, **kwargs):
     """Initializes a Mako templating task.
@@ -135,6 +228,12 @@ class ExecutableError(Exception):
     return 'ExecutableError: call returned %s' % (self.return_code)
 
 
+class TaskCancelledError(DeferredCancelledError):
+  """Raised in a worker process when its running task is cancelled.
+  """
+  pass
+
+
 class ExecutableTask(Task):
   """A task that executes a command in the shell.
 
@@ -151,22 +250,49 @@ class ExecutableTask(Task):
       call_args: Arguments to pass to the executable.
       env: Additional environment variables.
     """
-    super(ExecutableTask, self).__init__(
-      build_env, executable_name, *args, **kwargs)
+    if not args:
+      kwargs.setdefault('pretty_name', executable_name)
+    super(ExecutableTask, self).__init__(build_env, *args, **kwargs)
     self.executable_name = executable_name
     self.call_args = call_args[:] if call_args else []
     self.env = env.copy() if env else {}
 
   def execute(self):
+    (return_code, stdoutdata, stderrdata) = self._run_process()
+
+    if len(stdoutdata) or len(stderrdata):
+      print '\n%s:' % (self.pretty_name)
+      if len(stdoutdata):
+        print stdoutdata
+      if len(stderrdata):
+        print stderrdata
+
+    if return_code != 0:
+      raise ExecutableError(return_code=return_code)
+
+    return (stdoutdata, stderrdata)
+
+  def _run_process(self):
+    """Runs the executable and waits for it to exit.
+
+    Returns:
+      A tuple of (return_code, stdout, stderr).
+
+    Raises:
+      ExecutableError: The process could not be started.
+    """
     #print self.executable_name, self.call_args
     try:
       env = os.environ.copy()
       env.update(self.env)
+      # The process gets its own process group so that it (and anything it
+      # spawns) can be killed if the task is cancelled
       p = subprocess.Popen([self.executable_name] + self.call_args,
                            bufsize=-1, # system default
                            stdout=subprocess.PIPE,
                            stderr=subprocess.PIPE,
-                           env=env)
+                           env=env,
+                           preexec_fn=getattr(os, 'setpgrp', None))
     except:
       print 'unable to open process'
       raise ExecutableError()
@@ -174,26 +300,23 @@ class ExecutableTask(Task):
     # TODO(benvanik): would be nice to support a few modes here - enabling
     #     streaming output from the process (for watching progress/etc).
     #     This right now just waits until it exits and grabs everything.
-    (stdoutdata, stderrdata) = p.communicate()
-
-    if len(stdoutdata) or len(stderrdata):
-      print '\n%s:' % (self.pretty_name)
-      if len(stdoutdata):
-        print stdoutdata
-      if len(stderrdata):
-        print stderrdata
+    try:
+      (stdoutdata, stderrdata) = p.communicate()
+    except BaseException:
+      # Cancelled or interrupted
+      _kill_process_group(p)
+      raise
 
-    return_code = p.returncode
-    if return_code != 0:
-      raise ExecutableError(return_code=return_code)
-
-    return (stdoutdata, stderrdata)
+    return (p.returncode, stdoutdata, stderrdata)
 
 
 class JavaExecutableTask(ExecutableTask):
   """A task that executes a Java class in the shell.
   """
 
+  # JVMs reserve a large heap up front
+  resource_weights = {'cpu': 1, 'memory': 1024}
+
   def __init__(self, build_env, jar_path, call_args=None, *args, **kwargs):
     """Initializes an executable task.
 
@@ -269,12 +392,27 @@ class TaskExecutor(object):
   """An abstract queue for task execution.
   """
 
-  def __init__(self, *args, **kwargs):
+  def __init__(self, resource_budget=None, *args, **kwargs):
     """Initializes a task executor.
+
+    Args:
+      resource_budget: A dictionary of resource limits, such as
+          {'memory': 8192}, that the Task.resource_weights of all concurrently
+          running tasks must fit within. A task is always admitted if nothing
+          else is running. None for no limits.
     """
     self.closed = False
     self._running_count = 0
 
+    self.resource_budget = resource_budget or {}
+    self._resources_in_use = {}
+    self._admitted_count = 0
+
+    # TaskResourceUsage for the most recently completed tasks, in completion
+    # order - older entries are dropped so that executors kept across builds do
+    # not grow without bound
+    self.resource_usage = collections.deque(maxlen=_MAX_RESOURCE_USAGE_COUNT)
+
   def __enter__(self):
     return self
 
@@ -289,6 +427,57 @@ class TaskExecutor(object):
     """
     return self._running_count > 0
 
+  def _can_admit(self, weights):
+    """Checks whether a task with the given weights fits in the budget.
+
+    Args:
+      weights: Task resource weights.
+
+    Returns:
+      True if the task can be started now.
+    """
+    if not self._admitted_count:
+      return True
+    for (name, limit) in self.resource_budget.items():
+      if self._resources_in_use.get(name, 0) + weights.get(name, 0) > limit:
+        return False
+    return True
+
+  def _acquire_resources(self, weights):
+    """Marks the given resource weights as in use by an admitted task.
+
+    Args:
+      weights: Task resource weights.
+    """
+    self._admitted_count += 1
+    for (name, value) in weights.items():
+      self._resources_in_use[name] = self._resources_in_use.get(name, 0) + value
+
+  def _release_resources(self, weights):
+    """Releases resource weights acquired with _acquire_resources.
+
+    Args:
+      weights: Task resource weights.
+    """
+    self._admitted_count -= 1
+    for (name, value) in weights.items():
+      self._resources_in_use[name] -= value
+
+  def get_heaviest_tasks(self, count=10, key='peak_rss'):
+    """Gets the completed tasks that used the most of a resource.
+
+    Args:
+      count: Maximum number of results to return.
+      key: TaskResourceUsage attribute to sort on, such as 'wall_time',
+          'cpu_time' or 'peak_rss'.
+
+    Returns:
+      A list of TaskResourceUsage, heaviest first.
+    """
+    usages = sorted(self.resource_usage,
+                    key=lambda usage: getattr(usage, key), reverse=True)
+    return usages[:count]
+
   def run_task_async(self, task):
     """Queues a new task for execution.
 
@@ -314,6 +503,20 @@ class TaskExecutor(object):
     """
     raise NotImplementedError()
 
+  def cancel_all(self):
+    """Cancels all queued and running tasks.
+    Queued tasks are dropped and running tasks are interrupted where possible,
+    killing any processes they have started. The deferreds of all cancelled
+    tasks are errbacked with a DeferredCancelledError.
+    """
+    raise NotImplementedError()
+
+  def release_shared_state(self):
+    """Releases any state shared with workers by the tasks run so far.
+    Called at the end of each build when the executor is kept for the next
+    one. Tasks still running may fail.
+    """
+    pass
 
   def close(self, graceful=True):
     """Closes the executor, waits for all tasks to complete, and joins.
@@ -344,18 +547,22 @@ class InProcessTaskExecutor(TaskExecutor):
       raise RuntimeError('Executor has been closed and cannot run new tasks')
 
     deferred = Deferred()
-    try:
-      result = task.execute()
+    (succeeded, result, usage) = _execute_measured(task, print_exception=True)
+    self.resource_usage.append(usage)
+    if succeeded:
       deferred.callback(result)
-    except Exception as e:
-      print 'exception in task:'
-      traceback.print_exc(e)
-      deferred.errback(exception=e)
+    else:
+      deferred.errback(exception=result)
     return deferred
 
   def wait(self, deferreds):
     pass
 
+  def cancel_all(self):
+    # Tasks complete before run_task_async returns, so there is never anything
+    # to cancel
+    pass
+
   def close(self, graceful=True):
     if self.closed:
       raise RuntimeError(
@@ -366,23 +573,90 @@ class InProcessTaskExecutor(TaskExecutor):
 
 class MultiProcessTaskExecutor(TaskExecutor):
   """A pool for multiprocess task execution.
+  Tasks are pickled when queued. Values named in Task.shared_attrs are sent to
+  each worker only once and referenced from then on, so they are not repickled
+  for every task.
+
+  Workers can be recycled after a number of tasks or once their resident memory
+  grows past a ceiling, limiting the impact of leaks in long-running sessions.
+
+  If a resource budget is given, tasks are held in a pending queue until their
+  resource weights fit. Pending tasks are admitted in order, but lighter tasks
+  may pass a heavy task that does not yet fit.
+
+  If a jobserver is given, each running task beyond the first also holds one of
+  its tokens so that parallelism is shared with any cooperating make processes.
+  Tokens are only read for tasks that can start right away, so queued tasks do
+  not starve the other processes.
+
+  Cancelling a single task deferred drops the task if it has not yet started,
+  otherwise its result is ignored. cancel_all additionally interrupts all
+  running tasks, killing the process groups of any processes they started.
   """
 
-  def __init__(self, worker_count=None, *args, **kwargs):
+  def __init__(self, worker_count=None, max_tasks_per_worker=None,
+               max_worker_rss=None, jobserver=None, *args, **kwargs):
     """Initializes a task executor.
     This may take a bit to run, as the process pool is primed.
 
     Args:
       worker_count: Number of worker threads to use when building. None to use
           as many processors as are available.
+      max_tasks_per_worker: Number of tasks a worker process will run before it
+          is replaced with a fresh one. None to never recycle workers.
+      max_worker_rss: Resident memory size, in bytes, above which a worker
+          process is retired after its current task. None for no limit.
+      jobserver: An anvil.jobserver.Jobserver to take tokens from, or None.
     """
     super(MultiProcessTaskExecutor, self).__init__(*args, **kwargs)
     self.worker_count = worker_count
+    # Tasks are only submitted to the pool while a worker is free for them
+    self._max_submitted_count = worker_count or multiprocessing.cpu_count()
+    self.max_tasks_per_worker = max_tasks_per_worker
+    self.max_worker_rss = max_worker_rss
     self._waiting_deferreds = {}
+    # Tasks waiting for resources, as (deferred, task_data, weights) tuples
+    self._pending_tasks = []
+    # Guards all task bookkeeping, which is also modified from the pool result
+    # thread
+    self._lock = threading.Lock()
+
+    # Jobserver tokens read but not yet given to a task - the implicit token of
+    # this process is tracked separately as it is never read or written
+    self._jobserver = jobserver
+    self._jobserver_tokens = []
+    self._implicit_token_free = True
+    # Tokens and resource weights held by submitted tasks, mapped by deferred
+    self._task_tokens = {}
+    self._task_weights = {}
+    # Signalled when tasks are queued
+    self._pending_changed = threading.Condition(self._lock)
+    self._jobserver_thread = None
+    if self._jobserver:
+      self._jobserver_thread = threading.Thread(
+          target=self._jobserver_thread_main,
+          name='JobserverThread')
+      self._jobserver_thread.daemon = True
+      self._jobserver_thread.start()
+
+    # Shared task state (see Task.shared_attrs), as _SharedStateRefs keyed by
+    # a digest of the pickled value
+    self._shared_state = {}
+    self._shared_state_path = None
+    # Incremented each time shared state is released, so that workers drop the
+    # values they loaded for earlier builds
+    self._shared_state_generation = 0
+
+    # Incremented on cancel_all - workers skip any task submitted before the
+    # current generation
+    self._cancel_generation = multiprocessing.RawValue('i', 0)
 
     try:
-      self._pool = multiprocessing.Pool(processes=self.worker_count,
-                                        initializer=_task_initializer)
+      self._pool = _TaskPool(processes=self.worker_count,
+                             initializer=_task_initializer,
+                             initargs=(self._cancel_generation,),
+                             maxtasksperchild=self.max_tasks_per_worker,
+                             max_worker_rss=self.max_worker_rss)
     except OSError as e: # pragma: no cover
       print e
       print 'Unable to initialize multiprocessing!'
@@ -396,23 +670,256 @@ class MultiProcessTaskExecutor(TaskExecutor):
     if self.closed:
       raise RuntimeError('Executor has been closed and cannot run new tasks')
 
+    deferred = Deferred(canceller=self._cancel_task)
+
+    # Pickle here (instead of in the pool's handler thread) so that shared
+    # state can be swapped out for references
+    task_data = self._pickle_task(task)
+
+    # Queue until resources are available
+    with self._lock:
+      self._running_count = self._running_count + 1
+      self._pending_tasks.append((deferred, task_data, task.resource_weights))
+      self._admit_pending_tasks()
+      self._pending_changed.notify_all()
+
+    return deferred
+
+  def _admit_pending_tasks(self):
+    """Submits all pending tasks that fit in the resource budget to the pool.
+    The lock must be held by the caller.
+    """
+    for entry in self._pending_tasks[:]:
+      if len(self._waiting_deferreds) >= self._max_submitted_count:
+        break
+      (deferred, task_data, weights) = entry
+      if not self._can_admit(weights):
+        continue
+      token = None
+      if self._jobserver:
+        if self._implicit_token_free:
+          self._implicit_token_free = False
+        elif self._jobserver_tokens:
+          token = self._jobserver_tokens.pop()
+        else:
+          # Wait for the jobserver thread to get a token
+          break
+      self._pending_tasks.remove(entry)
+      self._acquire_resources(weights)
+      self._submit_task(deferred, task_data, weights, token)
+
+  def _get_startable_count(self):
+    """Counts the pending tasks that could be submitted if they had tokens.
+    The lock must be held by the caller.
+
+    Returns:
+      The number of pending tasks that have a free worker and fit in the
+      resource budget.
+    """
+    free_count = self._max_submitted_count - len(self._waiting_deferreds)
+    startable_weights = []
+    for (deferred, task_data, weights) in self._pending_tasks:
+      if len(startable_weights) >= free_count:
+        break
+      if self._can_admit(weights):
+        self._acquire_resources(weights)
+        startable_weights.append(weights)
+    for weights in startable_weights:
+      self._release_resources(weights)
+    return len(startable_weights)
+
+  def _release_token(self, token):
+    """Releases a jobserver token held by a task.
+    The lock must be held by the caller.
+
+    Args:
+      token: Token from the jobserver, or None if the implicit token was used.
+    """
+    if not self._jobserver:
+      return
+    if token is None:
+      self._implicit_token_free = True
+    else:
+      self._jobserver.release(token)
+    self._pending_changed.notify_all()
+
+  def _jobserver_thread_main(self):
+    """Reads jobserver tokens while tasks that could start are waiting for them.
+    Tokens no longer needed (such as those read for cancelled tasks) are
+    returned to the jobserver.
+    """
+    while True:
+      with self._lock:
+        if self.closed and not self._pending_tasks:
+          break
+        needed = (self._get_startable_count() - len(self._jobserver_tokens) -
+                  (1 if self._implicit_token_free else 0))
+        while needed < 0 and self._jobserver_tokens:
+          self._jobserver.release(self._jobserver_tokens.pop())
+          needed += 1
+        if needed <= 0:
+          self._pending_changed.wait(0.1)
+          continue
+      if not self._jobserver.wait_for_token(timeout=0.05):
+        continue
+      # Another process may have taken the token since
+      token = self._jobserver.try_acquire()
+      if token is None:
+        continue
+      with self._lock:
+        self._jobserver_tokens.append(token)
+        self._admit_pending_tasks()
+
+  def _submit_task(self, deferred, task_data, weights, token=None):
+    """Submits a task to the pool.
+    The lock must be held by the caller.
+
+    Args:
+      deferred: Deferred to signal with the task result.
+      task_data: Pickled task.
+      weights: Task resource weights, released when the task completes.
+      token: Jobserver token held by the task, released when it completes.
+    """
     # Pass on results to the defered
-    deferred = Deferred()
-    def _thunk_callback(*args, **kwargs):
-      self._running_count = self._running_count - 1
-      del self._waiting_deferreds[deferred]
-      if len(args) and isinstance(args[0], Exception):
-        deferred.errback(exception=args[0])
+    def _thunk_callback(thunk_result):
+      (succeeded, result, usage, output) = thunk_result
+      # Fast tasks may complete before the entry has been added below - the
+      # lock is held until then
+      with self._lock:
+        if not self._finish_task(deferred):
+          # Cancelled
+          return
+        self._admit_pending_tasks()
+      # Output is written here and not by the worker, as workers outlive the
+      # sys.stdout they were started with (such as a build server client)
+      if output:
+        sys.stdout.write(output)
+      self.resource_usage.append(usage)
+      if not succeeded:
+        deferred.errback(exception=result)
       else:
-        deferred.callback(*args)
+        deferred.callback(result)
 
-    # Queue
-    self._running_count = self._running_count + 1
-    async_result = self._pool.apply_async(_task_thunk, [task],
+    async_result = self._pool.apply_async(
+        _task_thunk, [task_data, self._cancel_generation.value],
         callback=_thunk_callback)
     self._waiting_deferreds[deferred] = async_result
+    self._task_tokens[deferred] = token
+    self._task_weights[deferred] = weights
 
-    return deferred
+  def _finish_task(self, deferred):
+    """Removes a submitted task and releases everything it holds.
+    The lock must be held by the caller.
+
+    Args:
+      deferred: Deferred of the task.
+
+    Returns:
+      True if the task was still running, False if it was already removed.
+    """
+    if deferred not in self._waiting_deferreds:
+      return False
+    self._running_count = self._running_count - 1
+    del self._waiting_deferreds[deferred]
+    self._release_resources(self._task_weights.pop(deferred))
+    self._release_token(self._task_tokens.pop(deferred, None))
+    return True
+
+  def _cancel_task(self, deferred):
+    """Canceller for task deferreds.
+
+    Args:
+      deferred: Deferred of the task being cancelled.
+    """
+    with self._lock:
+      for entry in self._pending_tasks:
+        if entry[0] is deferred:
+          self._pending_tasks.remove(entry)
+          self._running_count = self._running_count - 1
+          return
+      if self._finish_task(deferred):
+        self._admit_pending_tasks()
+
+  def cancel_all(self):
+    with self._lock:
+      self._cancel_generation.value += 1
+      cancelled_deferreds = [entry[0] for entry in self._pending_tasks]
+      self._running_count -= len(self._pending_tasks)
+      del self._pending_tasks[:]
+      for deferred in self._waiting_deferreds.keys():
+        self._finish_task(deferred)
+        cancelled_deferreds.append(deferred)
+    # Workers running a task raise TaskCancelledError from their signal
+    # handler - idle workers, and workers that have since started a task
+    # submitted after this, ignore it
+    if hasattr(signal, 'SIGUSR1'):
+      for process in self._pool._pool:
+        try:
+          os.kill(process.pid, signal.SIGUSR1)
+        except OSError: # pragma: no cover
+          pass
+    for deferred in cancelled_deferreds:
+      if not deferred.is_done():
+        deferred.errback(exception=DeferredCancelledError())
+
+  def _pickle_task(self, task):
+    """Pickles a task, replacing its shared state with references.
+
+    Args:
+      task: Task to pickle.
+
+    Returns:
+      A string containing the pickled task.
+    """
+    shared_values = {}
+    for attr in task.shared_attrs:
+      value = getattr(task, attr, None)
+      if value is not None:
+        shared_values[attr] = value
+        setattr(task, attr, self._share_state(value))
+    try:
+      return cPickle.dumps(task, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      for (attr, value) in shared_values.items():
+        setattr(task, attr, value)
+
+  def _share_state(self, value):
+    """Registers a shared state value with the workers.
+    Values are keyed by their pickled contents, so a value modified after being
+    shared is shared again with its new contents. Each distinct value is
+    written once to a file private to the executor, and workers load it on
+    first use and keep it until the state is released.
+
+    Args:
+      value: Value to share.
+
+    Returns:
+      A _SharedStateRef that can be pickled in place of the value.
+    """
+    data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    key = hashlib.sha1(data).hexdigest()
+    ref = self._shared_state.get(key, None)
+    if ref:
+      return ref
+    if not self._shared_state_path:
+      self._shared_state_path = tempfile.mkdtemp(prefix='anvil-shared-')
+    path = os.path.join(self._shared_state_path, '%s-%s.pickle' % (
+        self._shared_state_generation, len(self._shared_state)))
+    with open(path, 'wb') as f:
+      f.write(data)
+    ref = _SharedStateRef(path, self._shared_state_generation)
+    self._shared_state[key] = ref
+    return ref
+
+  def release_shared_state(self):
+    self._shared_state.clear()
+    self._shared_state_generation += 1
+    if self._shared_state_path:
+      for name in os.listdir(self._shared_state_path):
+        try:
+          os.remove(os.path.join(self._shared_state_path, name))
+        except OSError:
+          pass
 
   def wait(self, deferreds):
     try:
@@ -423,11 +930,13 @@ class MultiProcessTaskExecutor(TaskExecutor):
     for deferred in deferreds:
       if deferred.is_done():
         continue
-      if not self._waiting_deferreds.has_key(deferred):
-        # Not a deferred created by this - queue for a spin wait
+      # The entry may be removed by the result thread at any time
+      async_result = self._waiting_deferreds.get(deferred, None)
+      if not async_result:
+        # Not a deferred created by this (or just completed) - queue for a
+        # spin wait
         spin_deferreds.append(deferred)
       else:
-        async_result = self._waiting_deferreds[deferred]
         async_result.wait()
     for deferred in spin_deferreds:
       while not deferred.is_done():
@@ -439,32 +948,411 @@ class MultiProcessTaskExecutor(TaskExecutor):
           'Attempting to close an executor that has already been closed')
     self.closed = True
     if graceful:
+      # Pending tasks are admitted as running ones complete, so wait for all of
+      # them to reach the pool before closing it
+      while True:
+        with self._lock:
+          if not self._pending_tasks:
+            break
+        time.sleep(0.01)
       self._pool.close()
     else:
+      with self._lock:
+        del self._pending_tasks[:]
       self._pool.terminate()
     self._pool.join()
+    if self._jobserver_thread:
+      self._jobserver_thread.join()
+      self._jobserver_thread = None
+      # Return any tokens that were read but never used, or that were held by
+      # tasks terminated before completing
+      for token in self._jobserver_tokens + self._task_tokens.values():
+        if token is not None:
+          self._jobserver.release(token)
+      del self._jobserver_tokens[:]
+      self._task_tokens.clear()
+      self._implicit_token_free = True
     self._running_count = 0
     self._waiting_deferreds.clear()
+    self._task_weights.clear()
+    self._shared_state.clear()
+    if self._shared_state_path:
+      shutil.rmtree(self._shared_state_path, ignore_errors=True)
+      self._shared_state_path = None
+
+
+class TaskResourceUsage(object):
+  """Resources consumed by a single task execution.
+  CPU time and peak memory include any child processes the task waited on, such
+  as compilers launched by an ExecutableTask.
+
+  Peak memory is measured for the task alone where the system allows resetting
+  the peak of the worker process (Linux), otherwise it may include the peak of
+  earlier tasks run by the same worker and is only an upper bound.
+  """
+
+  def __init__(self, pretty_name, wall_time=0.0, cpu_time=0.0, peak_rss=0,
+               peak_rss_is_upper_bound=False, worker_pid=None):
+    """Initializes a task resource usage record.
+
+    Args:
+      pretty_name: Pretty name of the task.
+      wall_time: Wall time spent executing the task, in seconds.
+      cpu_time: User and system CPU time spent by the task, in seconds.
+      peak_rss: Peak resident memory size, in bytes, of the worker process or
+          any child process it waited on.
+      peak_rss_is_upper_bound: True if peak_rss could not be measured for the
+          task alone, and the task may have used less.
+      worker_pid: ID of the process that executed the task.
+    """
+    self.pretty_name = pretty_name
+    self.wall_time = wall_time
+    self.cpu_time = cpu_time
+    self.peak_rss = peak_rss
+    self.peak_rss_is_upper_bound = peak_rss_is_upper_bound
+    self.worker_pid = worker_pid
+
+  def __repr__(self):
+    return '%s(wall=%.3fs, cpu=%.3fs, rss%s%sKB)' % (
+        self.pretty_name, self.wall_time, self.cpu_time,
+        '<=' if self.peak_rss_is_upper_bound else '=', self.peak_rss / 1024)
+
+
+def _get_rusage_rss(usage): # pragma: no cover
+  """Gets the peak resident size from an rusage result, in bytes.
+
+  Args:
+    usage: Result of resource.getrusage.
+
+  Returns:
+    The ru_maxrss value in bytes.
+  """
+  # Linux reports kilobytes, OS X reports bytes
+  if sys.platform == 'darwin':
+    return usage.ru_maxrss
+  return usage.ru_maxrss * 1024
+
+
+def _reset_peak_rss(): # pragma: no cover
+  """Resets the peak resident size of this process to its current size.
+  Only supported on Linux 4.0 and later.
+
+  Returns:
+    True if the peak was reset.
+  """
+  try:
+    with open('/proc/self/clear_refs', 'wb') as f:
+      f.write('5')
+    return True
+  except (IOError, OSError):
+    return False
+
+
+def _get_peak_rss(): # pragma: no cover
+  """Gets the peak resident size of this process since it was last reset with
+  _reset_peak_rss, in bytes.
 
-def _task_initializer(): # pragma: no cover
+  Returns:
+    The peak resident size in bytes, or None if it cannot be determined.
+  """
+  try:
+    with open('/proc/self/status', 'rb') as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except (IOError, OSError, ValueError, IndexError):
+    pass
+  return None
+
+
+def _get_current_rss(): # pragma: no cover
+  """Gets the current resident size of this process, in bytes.
+  Falls back to the peak resident size where the current size is unavailable.
+
+  Returns:
+    The resident size in bytes, or 0 if it cannot be determined.
+  """
+  try:
+    with open('/proc/self/statm', 'rb') as f:
+      return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+  except (IOError, OSError, ValueError, IndexError):
+    pass
+  if resource:
+    return _get_rusage_rss(resource.getrusage(resource.RUSAGE_SELF))
+  return 0
+
+
+def _execute_measured(task, print_exception=False):
+  """Executes a task, recording the resources it uses.
+
+  Args:
+    task: Task to execute.
+    print_exception: True to print the traceback of any exception raised by
+        the task.
+
+  Returns:
+    A (succeeded, result, usage) tuple. If the task raised then succeeded is
+    False and result is the exception. usage is a TaskResourceUsage.
+  """
+  start_time = util.timer()
+  peak_reset = _reset_peak_rss()
+  if resource:
+    start_self = resource.getrusage(resource.RUSAGE_SELF)
+    start_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  try:
+    result = task.execute()
+    succeeded = True
+  except Exception as e:
+    result = e
+    succeeded = False
+    if print_exception:
+      print 'exception in task:'
+      traceback.print_exc()
+  usage = TaskResourceUsage(task.pretty_name,
+                            wall_time=util.timer() - start_time,
+                            worker_pid=os.getpid())
+  if resource:
+    end_self = resource.getrusage(resource.RUSAGE_SELF)
+    end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    children_cpu_time = (
+        (end_children.ru_utime - start_children.ru_utime) +
+        (end_children.ru_stime - start_children.ru_stime))
+    usage.cpu_time = (
+        (end_self.ru_utime - start_self.ru_utime) +
+        (end_self.ru_stime - start_self.ru_stime) + children_cpu_time)
+
+    # ru_maxrss is the peak over the lifetime of the worker (or of all children
+    # it waited on), so it only belongs to this task if it grew during it
+    self_peak_rss = _get_peak_rss() if peak_reset else None
+    self_is_upper_bound = False
+    if self_peak_rss is None:
+      self_peak_rss = _get_rusage_rss(end_self)
+      self_is_upper_bound = end_self.ru_maxrss == start_self.ru_maxrss
+    children_peak_rss = _get_rusage_rss(end_children)
+    children_is_upper_bound = False
+    if end_children.ru_maxrss == start_children.ru_maxrss:
+      if children_cpu_time:
+        children_is_upper_bound = True
+      else:
+        # No child processes were waited on
+        children_peak_rss = 0
+    usage.peak_rss = max(self_peak_rss, children_peak_rss)
+    usage.peak_rss_is_upper_bound = (
+        (self_is_upper_bound and self_peak_rss >= children_peak_rss) or
+        (children_is_upper_bound and children_peak_rss >= self_peak_rss))
+  return (succeeded, result, usage)
+
+
+class _TaskPool(multiprocessing.pool.Pool):
+  """A process pool whose workers retire when they use too much memory.
+  Retired workers are replaced by the pool in the same way as workers that
+  reach maxtasksperchild.
+  """
+
+  def __init__(self, max_worker_rss=None, *args, **kwargs):
+    """Initializes a task pool.
+
+    Args:
+      max_worker_rss: Resident memory size, in bytes, above which a worker
+          exits after completing its current task. None for no limit.
+    """
+    self._max_worker_rss = max_worker_rss
+    super(_TaskPool, self).__init__(*args, **kwargs)
+
+  def _repopulate_pool(self):
+    for n in range(self._processes - len(self._pool)):
+      w = self.Process(target=_task_worker,
+                       args=(self._inqueue, self._outqueue,
+                             self._initializer, self._initargs,
+                             self._maxtasksperchild, self._max_worker_rss))
+      self._pool.append(w)
+      w.name = w.name.replace('Process', 'PoolWorker')
+      w.daemon = True
+      w.start()
+
+
+def _task_worker(inqueue, outqueue, initializer=None, initargs=(),
+                 maxtasks=None, max_rss=None): # pragma: no cover
+  """Worker process loop, used by _TaskPool.
+  This matches multiprocessing.pool.worker, but additionally exits once the
+  resident size of the process exceeds max_rss.
+  """
+  put = outqueue.put
+  get = inqueue.get
+  if hasattr(inqueue, '_writer'):
+    inqueue._writer.close()
+    outqueue._reader.close()
+
+  if initializer is not None:
+    initializer(*initargs)
+
+  completed = 0
+  while maxtasks is None or completed < maxtasks:
+    try:
+      task = get()
+    except (EOFError, IOError):
+      break
+    if task is None:
+      break
+
+    (job, i, func, args, kwds) = task
+    try:
+      result = (True, func(*args, **kwds))
+    except Exception as e:
+      result = (False, e)
+    try:
+      put((job, i, result))
+    except Exception as e:
+      wrapped = multiprocessing.pool.MaybeEncodingError(e, result[1])
+      put((job, i, (False, wrapped)))
+
+    task = job = result = func = args = kwds = None
+    completed += 1
+
+    if max_rss and _get_current_rss() > max_rss:
+      break
+
+
+class _SharedStateRef(object):
+  """A reference to shared task state, used by MultiProcessTaskExecutor.
+  """
+
+  def __init__(self, path, generation=0):
+    """Initializes a shared state reference.
+
+    Args:
+      path: Path of the file containing the pickled value.
+      generation: Shared state generation of the executor when the value was
+          shared.
+    """
+    self.path = path
+    self.generation = generation
+
+
+# Shared state loaded by the current worker process, mapped by path, and the
+# generation it was shared in
+_worker_shared_state = {}
+_worker_shared_state_generation = 0
+
+def _resolve_shared_state(ref): # pragma: no cover
+  """Resolves a shared state reference in a worker process.
+  The value is loaded on first use and retained until a reference from a later
+  generation is resolved.
+
+  Args:
+    ref: A _SharedStateRef.
+
+  Returns:
+    The shared value.
+  """
+  global _worker_shared_state_generation
+  if ref.generation != _worker_shared_state_generation:
+    # The executor released all earlier state
+    _worker_shared_state.clear()
+    _worker_shared_state_generation = ref.generation
+  if ref.path in _worker_shared_state:
+    return _worker_shared_state[ref.path]
+  with open(ref.path, 'rb') as f:
+    value = cPickle.load(f)
+  _worker_shared_state[ref.path] = value
+  return value
+
+# Cancellation generation shared with the executor, and the generation the
+# task currently running in this worker process was submitted in (None if idle)
+_worker_cancel_generation = None
+_worker_task_generation = None
+
+def _task_initializer(cancel_generation=None): # pragma: no cover
   """Task executor process initializer, used by MultiProcessTaskExecutor.
   Called once on each process the TaskExecutor uses.
+
+  Args:
+    cancel_generation: multiprocessing.RawValue incremented by the executor
+        when all tasks are cancelled.
   """
   #print 'started! %s' % (multiprocessing.current_process().name)
-  pass
+  # The output streams of the process that started the worker may be replaced
+  # after it is started - output of tasks is returned with their results
+  (sys.stdout, sys.stderr) = (sys.__stdout__, sys.__stderr__)
+  global _worker_cancel_generation
+  _worker_cancel_generation = cancel_generation
+  if hasattr(signal, 'SIGUSR1'):
+    signal.signal(signal.SIGUSR1, _task_cancel_handler)
+
+def _task_cancel_handler(signum, frame):
+  """SIGUSR1 handler that interrupts the running task, if any.
+  Signals may arrive after the task they were sent for has completed, so tasks
+  submitted since the last cancellation are not interrupted.
+  """
+  if (_worker_task_generation is not None and _worker_cancel_generation and
+      _worker_cancel_generation.value != _worker_task_generation):
+    raise TaskCancelledError()
 
-def _task_thunk(task): # pragma: no cover
+def _task_thunk(task_data, generation=0): # pragma: no cover
   """Thunk for executing tasks, used by MultiProcessTaskExecutor.
   This is called from separate processes so do not access any global state.
 
   Args:
-    task: Task to execute.
+    task_data: Pickled task to execute, with shared state references.
+    generation: Cancellation generation the task was submitted in. If tasks
+        have been cancelled since then the task is skipped.
 
   Returns:
-    The result of the task execution. This is passed to the deferred.
+    A (succeeded, result, usage, output) tuple, with the values returned by
+    _execute_measured and a string containing everything the task wrote to
+    sys.stdout and sys.stderr.
   """
+  global _worker_task_generation
+  # Mark as running before checking the generation, so that cancellation either
+  # is seen here or interrupts the task
+  _worker_task_generation = generation
   try:
-    result = task.execute()
-    return result
+    if (_worker_cancel_generation and
+        _worker_cancel_generation.value != generation):
+      raise TaskCancelledError()
+    task = cPickle.loads(task_data)
+    for attr in task.shared_attrs:
+      value = getattr(task, attr, None)
+      if isinstance(value, _SharedStateRef):
+        setattr(task, attr, _resolve_shared_state(value))
   except Exception as e:
-    return e
+    _worker_task_generation = None
+    return (False, e, TaskResourceUsage('?', worker_pid=os.getpid()), '')
+  output = StringIO.StringIO()
+  (old_stdout, old_stderr) = (sys.stdout, sys.stderr)
+  sys.stdout = sys.stderr = output
+  try:
+    (succeeded, result, usage) = _execute_measured(task)
+  finally:
+    _worker_task_generation = None
+    (sys.stdout, sys.stderr) = (old_stdout, old_stderr)
+  return (succeeded, result, usage, output.getvalue())
+
+
+def _kill_process_group(p):
+  """Kills a process started by a task and all processes in its group.
+  Processes are asked to terminate and killed if they have not after a short
+  time.
+
+  Args:
+    p: subprocess.Popen object of a process started in its own process group.
+  """
+  if not hasattr(os, 'killpg'): # pragma: no cover
+    try:
+      p.kill()
+    except OSError:
+      pass
+    p.wait()
+    return
+  for (sig, timeout) in [(signal.SIGTERM, 0.5), (signal.SIGKILL, None)]:
+    try:
+      os.killpg(p.pid, sig)
+    except OSError:
+      # Group no longer exists
+      break
+    end_time = time.time() + (timeout or 0)
+    while p.poll() is None and time.time() < end_time:
+      time.sleep(0.01)
+    if p.returncode is not None:
+      break
+  p.wait()
@@ -8,8 +8,17 @@
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import cPickle
+import multiprocessing
+import shutil
+import StringIO
+import sys
+import tempfile
+import time
 import unittest2
 
+import anvil.task
+from anvil.async import DeferredCancelledError
 from anvil.context import BuildEnvironment
 from anvil.task import *
 from anvil.test import AsyncTestCase, FixtureTestCase
@@ -83,6 +92,39 @@ class ExecutableTaskTest(FixtureTestCase):
   #   task = PythonExecutableTask(self.build_env, 'some_py')
 
 
+class PackedPathListTest(unittest2.TestCase):
+  """Behavioral tests of the PackedPathList type."""
+
+  def testEmpty(self):
+    paths = PackedPathList()
+    self.assertEqual(len(paths), 0)
+    self.assertEqual(list(paths), [])
+    paths = PackedPathList([], width=2)
+    self.assertEqual(len(paths), 0)
+    self.assertEqual(list(paths), [])
+
+  def testPaths(self):
+    paths = PackedPathList(['a', 'b/c', ''])
+    self.assertEqual(len(paths), 3)
+    self.assertEqual(list(paths), ['a', 'b/c', ''])
+    self.assertEqual(paths[1], 'b/c')
+
+  def testPairs(self):
+    pairs = PackedPathList([('a', 'b'), ('c/d', 'e')], width=2)
+    self.assertEqual(len(pairs), 2)
+    self.assertEqual(list(pairs), [('a', 'b'), ('c/d', 'e')])
+    self.assertEqual(pairs[1], ('c/d', 'e'))
+
+  def testPickle(self):
+    pairs = PackedPathList([('a', 'b'), ('c', 'd')], width=2)
+    # Items unpacked for indexing are not pickled
+    self.assertEqual(pairs[0], ('a', 'b'))
+    pairs = cPickle.loads(cPickle.dumps(pairs, cPickle.HIGHEST_PROTOCOL))
+    self.assertIsNone(pairs._items)
+    self.assertEqual(list(pairs), [('a', 'b'), ('c', 'd')])
+    self.assertEqual(pairs[1], ('c', 'd'))
+
+
 class SuccessTask(Task):
   def __init__(self, build_env, success_result, *args, **kwargs):
     super(SuccessTask, self).__init__(build_env, *args, **kwargs)
@@ -94,6 +136,37 @@ class FailureTask(Task):
   def execute(self):
     raise TypeError('Failed!')
 
+class SleepTask(Task):
+  def __init__(self, build_env, duration, *args, **kwargs):
+    super(SleepTask, self).__init__(build_env, *args, **kwargs)
+    self.duration = duration
+  def execute(self):
+    start_time = time.time()
+    time.sleep(self.duration)
+    return (start_time, time.time())
+
+class AllocateTask(Task):
+  def __init__(self, build_env, size, *args, **kwargs):
+    super(AllocateTask, self).__init__(build_env, *args, **kwargs)
+    self.size = size
+  def execute(self):
+    return len(bytearray(self.size))
+
+class PrintTask(Task):
+  def __init__(self, build_env, message, *args, **kwargs):
+    super(PrintTask, self).__init__(build_env, *args, **kwargs)
+    self.message = message
+  def execute(self):
+    print self.message
+
+class SharedStateTask(Task):
+  shared_attrs = Task.shared_attrs + ('params',)
+  def __init__(self, build_env, params, *args, **kwargs):
+    super(SharedStateTask, self).__init__(build_env, *args, **kwargs)
+    self.params = params
+  def execute(self):
+    return (self.build_env.root_path, self.params['value'])
+
 
 class TaskExecutorTest(AsyncTestCase):
   """Behavioral tests of the TaskExecutor type."""
@@ -173,6 +246,246 @@ class TaskExecutorTest(AsyncTestCase):
   def testMultiprocess(self):
     self.runTestsWithExecutorType(MultiProcessTaskExecutor)
 
+  def testResourceUsage(self):
+    build_env = BuildEnvironment()
+    for executor_cls in [InProcessTaskExecutor, MultiProcessTaskExecutor]:
+      with executor_cls() as executor:
+        da = executor.run_task_async(SuccessTask(build_env, 'a',
+                                                 pretty_name='a'))
+        db = executor.run_task_async(FailureTask(build_env, pretty_name='b'))
+        executor.wait([da, db])
+        self.assertEqual(len(executor.resource_usage), 2)
+        names = set([usage.pretty_name for usage in executor.resource_usage])
+        self.assertEqual(names, set(['a', 'b']))
+        for usage in executor.resource_usage:
+          self.assertGreaterEqual(usage.wall_time, 0)
+          self.assertGreaterEqual(usage.cpu_time, 0)
+          self.assertIsNotNone(usage.worker_pid)
+        self.assertEqual(len(executor.get_heaviest_tasks(count=1)), 1)
+
+    # Only the most recent records are kept
+    self.addCleanup(setattr, anvil.task, '_MAX_RESOURCE_USAGE_COUNT',
+                    anvil.task._MAX_RESOURCE_USAGE_COUNT)
+    anvil.task._MAX_RESOURCE_USAGE_COUNT = 2
+    with InProcessTaskExecutor() as executor:
+      for name in ['a', 'b', 'c']:
+        executor.run_task_async(SuccessTask(build_env, name, pretty_name=name))
+      self.assertEqual([usage.pretty_name for usage in executor.resource_usage],
+                       ['b', 'c'])
+
+  def testExceptionTraceback(self):
+    build_env = BuildEnvironment()
+    output = StringIO.StringIO()
+    old_stderr = sys.stderr
+    sys.stderr = output
+    try:
+      with InProcessTaskExecutor() as executor:
+        executor.run_task_async(FailureTask(build_env))
+    finally:
+      sys.stderr = old_stderr
+    self.assertIn('Traceback', output.getvalue())
+    self.assertIn('TypeError: Failed!', output.getvalue())
+
+  def testPeakRss(self):
+    # The peak of a task does not include the peaks of earlier tasks run by the
+    # same worker, where it can be measured
+    build_env = BuildEnvironment()
+    with MultiProcessTaskExecutor(worker_count=1) as executor:
+      executor.wait(executor.run_task_async(AllocateTask(
+          build_env, 64 * 1024 * 1024)))
+      executor.wait(executor.run_task_async(SuccessTask(build_env, True)))
+      (heavy_usage, light_usage) = executor.resource_usage
+      self.assertGreaterEqual(heavy_usage.peak_rss, 64 * 1024 * 1024)
+      if light_usage.peak_rss_is_upper_bound:
+        self.assertGreaterEqual(light_usage.peak_rss, heavy_usage.peak_rss)
+      else:
+        self.assertLess(light_usage.peak_rss,
+                        heavy_usage.peak_rss - 32 * 1024 * 1024)
+
+  def testOutput(self):
+    # Output is written to sys.stdout as it is when the task completes, as the
+    # build server replaces it for each client
+    build_env = BuildEnvironment()
+    for executor_cls in [InProcessTaskExecutor, MultiProcessTaskExecutor]:
+      with executor_cls(worker_count=1) as executor:
+        outputs = []
+        for message in ['a', 'b']:
+          output = StringIO.StringIO()
+          old_stdout = sys.stdout
+          sys.stdout = output
+          try:
+            executor.wait(executor.run_task_async(PrintTask(build_env,
+                                                            message)))
+          finally:
+            sys.stdout = old_stdout
+          outputs.append(output.getvalue())
+        self.assertEqual(outputs, ['a\n', 'b\n'])
+
+  def testWorkerRecycling(self):
+    build_env = BuildEnvironment()
+    with MultiProcessTaskExecutor(worker_count=1,
+                                  max_tasks_per_worker=1) as executor:
+      for n in xrange(3):
+        executor.wait(executor.run_task_async(SuccessTask(build_env, n)))
+      pids = set([usage.worker_pid for usage in executor.resource_usage])
+      self.assertEqual(len(pids), 3)
+
+    # A tiny memory ceiling retires the worker after every task
+    with MultiProcessTaskExecutor(worker_count=1,
+                                  max_worker_rss=1) as executor:
+      for n in xrange(3):
+        executor.wait(executor.run_task_async(SuccessTask(build_env, n)))
+      pids = set([usage.worker_pid for usage in executor.resource_usage])
+      self.assertEqual(len(pids), 3)
+
+  def testResourceWeights(self):
+    build_env = BuildEnvironment()
+    task = SuccessTask(build_env, True)
+    self.assertEqual(task.resource_weights, {'cpu': 1})
+    task = SuccessTask(build_env, True, resource_weights={'memory': 10})
+    self.assertEqual(task.resource_weights, {'cpu': 1, 'memory': 10})
+    self.assertEqual(Task.resource_weights, {'cpu': 1})
+    task = JavaExecutableTask(build_env, 'some_jar')
+    self.assertEqual(task.resource_weights['memory'], 1024)
+
+  def testAdmissionControl(self):
+    build_env = BuildEnvironment()
+    with MultiProcessTaskExecutor(worker_count=4,
+                                  resource_budget={'memory': 100}) as executor:
+      heavy = [executor.run_task_async(SleepTask(
+                   build_env, 0.2, resource_weights={'memory': 100}))
+               for n in xrange(2)]
+      light = [executor.run_task_async(SleepTask(build_env, 0))
+               for n in xrange(3)]
+      # Only one heavy task fits at a time - the other must be pending
+      self.assertEqual(len(executor._pending_tasks), 1)
+      executor.wait(heavy + light)
+      self.assertFalse(executor.has_any_running())
+      intervals = []
+      for d in heavy:
+        d.add_callback_fn(lambda result: intervals.append(result))
+      intervals.sort()
+      self.assertLessEqual(intervals[0][1], intervals[1][0])
+      # Light tasks were not held back by the pending heavy task
+      light_ends = []
+      for d in light:
+        d.add_callback_fn(lambda result: light_ends.append(result[1]))
+      self.assertLess(max(light_ends), intervals[1][0])
+
+  def testCancel(self):
+    build_env = BuildEnvironment()
+    with MultiProcessTaskExecutor(worker_count=1) as executor:
+      ds = [executor.run_task_async(SleepTask(build_env, 0.2))
+            for n in xrange(4)]
+      ds[3].cancel()
+      self.assertErrbackWithError(ds[3], DeferredCancelledError)
+      executor.wait(ds[:3])
+      for d in ds[:3]:
+        self.assertCallback(d)
+      self.assertFalse(executor.has_any_running())
+
+  def testCancelAll(self):
+    build_env = BuildEnvironment()
+    pid_path = os.path.join(tempfile.mkdtemp(), 'pid')
+    self.addCleanup(shutil.rmtree, os.path.dirname(pid_path))
+    with MultiProcessTaskExecutor(
+        worker_count=2, resource_budget={'memory': 1}) as executor:
+      running = [
+          executor.run_task_async(ExecutableTask(
+              build_env, 'sh', ['-c', 'echo $$ > %s; exec sleep 30' % (
+                  pid_path)])),
+          executor.run_task_async(SleepTask(build_env, 30)),
+          ]
+      # Pending in the executor, not yet submitted to the pool
+      pending = executor.run_task_async(SleepTask(
+          build_env, 0, resource_weights={'memory': 1}))
+      while not os.path.exists(pid_path) or not os.path.getsize(pid_path):
+        time.sleep(0.01)
+      time.sleep(0.1)
+      with open(pid_path, 'r') as f:
+        pid = int(f.read())
+
+      start_time = time.time()
+      executor.cancel_all()
+      self.assertFalse(executor.has_any_running())
+      for d in running + [pending]:
+        self.assertErrbackWithError(d, DeferredCancelledError)
+
+      # Workers are usable once cancelled tasks have been interrupted
+      d = executor.run_task_async(SuccessTask(build_env, 'a'))
+      executor.wait(d)
+      self.assertCallbackEqual(d, 'a')
+      executor.close()
+      self.assertLess(time.time() - start_time, 5)
+
+    # The process started by the task was killed
+    with self.assertRaises(OSError):
+      os.kill(pid, 0)
+
+  def testCancelSignal(self):
+    for name in ['_worker_cancel_generation', '_worker_task_generation']:
+      self.addCleanup(setattr, anvil.task, name, getattr(anvil.task, name))
+    anvil.task._worker_cancel_generation = multiprocessing.RawValue('i', 1)
+    # Idle workers and tasks submitted since the last cancellation ignore
+    # signals, which may arrive late
+    anvil.task._worker_task_generation = None
+    anvil.task._task_cancel_handler(None, None)
+    anvil.task._worker_task_generation = 1
+    anvil.task._task_cancel_handler(None, None)
+    anvil.task._worker_task_generation = 0
+    with self.assertRaises(TaskCancelledError):
+      anvil.task._task_cancel_handler(None, None)
+
+  def testSharedState(self):
+    build_env = BuildEnvironment()
+    for executor_cls in [InProcessTaskExecutor, MultiProcessTaskExecutor]:
+      params = {'value': 'x'}
+      with executor_cls() as executor:
+        ds = [executor.run_task_async(SharedStateTask(build_env, params))
+              for n in xrange(8)]
+        executor.wait(ds)
+        for d in ds:
+          self.assertCallbackEqual(d, (build_env.root_path, 'x'))
+        if executor_cls is MultiProcessTaskExecutor:
+          # Only the build env and params should have been registered
+          self.assertEqual(len(executor._shared_state), 2)
+          shared_state_path = executor._shared_state_path
+          self.assertTrue(os.path.isdir(shared_state_path))
+
+        # Released state is dropped by the executor and its workers, so that
+        # new values are used even if they reuse the ids of old ones
+        executor.release_shared_state()
+        if executor_cls is MultiProcessTaskExecutor:
+          self.assertEqual(len(executor._shared_state), 0)
+          self.assertEqual(os.listdir(shared_state_path), [])
+        params['value'] = 'y'
+        ds = [executor.run_task_async(SharedStateTask(build_env, params))
+              for n in xrange(8)]
+        executor.wait(ds)
+        for d in ds:
+          self.assertCallbackEqual(d, (build_env.root_path, 'y'))
+      if executor_cls is MultiProcessTaskExecutor:
+        self.assertFalse(os.path.exists(shared_state_path))
+
+  def testSharedStateModified(self):
+    build_env = BuildEnvironment()
+    for executor_cls in [InProcessTaskExecutor, MultiProcessTaskExecutor]:
+      with executor_cls() as executor:
+        # Values modified after being shared are shared again
+        params = {'value': 'x'}
+        d1 = executor.run_task_async(SharedStateTask(build_env, params))
+        params['value'] = 'y'
+        d2 = executor.run_task_async(SharedStateTask(build_env, params))
+        # Equal values are shared once, whatever their identity
+        d3 = executor.run_task_async(SharedStateTask(build_env,
+                                                     {'value': 'y'}))
+        executor.wait([d1, d2, d3])
+        self.assertCallbackEqual(d1, (build_env.root_path, 'x'))
+        self.assertCallbackEqual(d2, (build_env.root_path, 'y'))
+        self.assertCallbackEqual(d3, (build_env.root_path, 'y'))
+        if executor_cls is MultiProcessTaskExecutor:
+          self.assertEqual(len(executor._shared_state), 3)
+
 
 if __name__ == '__main__':
   unittest2.main()
@@ -3,6 +3,7 @@
 __author__ = 'benvanik@google.com (Ben Vanik)'
 
 
+import fnmatch
 import inspect
 import os
 import re
@@ -144,6 +145,25 @@ def validate_names(values, require_semicolon=False):
       raise NameError('Names must be a rule (contain a :): "%s"' % (value))
 
 
+def compile_filename_filter(value):
+  """Compiles a file name filter into a single regular expression.
+
+  Args:
+    value: A filter string of fnmatch patterns separated by |.
+        Example - *.txt|*.js
+
+  Returns:
+    A compiled regular expression that matches file names (after
+    os.path.normcase) that match any of the patterns, or None if the filter is
+    empty.
+  """
+  if not value:
+    return None
+  patterns = [fnmatch.translate(os.path.normcase(pattern))
+              for pattern in value.split('|')]
+  return re.compile('|'.join('(?:%s)' % (pattern) for pattern in patterns))
+
+
 def underscore_to_pascalcase(value):
   """Converts a string from underscore_case to PascalCase.
 
@@ -147,6 +147,28 @@ class UnderscoreToPascalCaseTest(unittest2.TestCase):
         util.underscore_to_pascalcase('a  b'),
         'A  b')
 
+
+
+class CompileFilenameFilterTest(unittest2.TestCase):
+  """Behavioral tests of the compile_filename_filter method."""
+
+  def testEmpty(self):
+    self.assertIsNone(util.compile_filename_filter(None))
+    self.assertIsNone(util.compile_filename_filter(''))
+
+  def testPatterns(self):
+    regex = util.compile_filename_filter('*.txt')
+    self.assertTrue(regex.match('a.txt'))
+    self.assertFalse(regex.match('a.txt-a'))
+    self.assertFalse(regex.match('a.js'))
+    regex = util.compile_filename_filter('*.txt-a|*.txt-b|c.?s')
+    self.assertTrue(regex.match('a.txt-a'))
+    self.assertTrue(regex.match('a.txt-b'))
+    self.assertTrue(regex.match('c.js'))
+    self.assertFalse(regex.match('a.txt'))
+    self.assertFalse(regex.match('c.jss'))
+
+
 class WhichTest(unittest2.TestCase):
   """Behavioral tests of the which method."""
 
@@ -0,0 +1,14 @@
+// Copyright
+
+/**
+ * @fileoverview A.
+ */
+
+goog.provide('a.b');
+
+goog.require('c');
+// Comment
+goog.require('d');
+
+var x = 1;
+goog.require('e');
@@ -0,0 +1,4 @@
+/**
+ * @provideGoog
+ */
+goog.provide = function(name) {};
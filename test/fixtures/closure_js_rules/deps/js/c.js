@@ -0,0 +1,2 @@
+goog.provide('c');
+goog.require('d');
@@ -0,0 +1,3 @@
+goog.provide('css');
+
+goog.setCssNameMapping({});
@@ -0,0 +1,2 @@
+goog.provide('d');
+goog.provide('e');
@@ -0,0 +1 @@
+goog.provide('a');
@@ -0,0 +1,26 @@
+"""Stand-in for gjslint that fails files containing 'BAD'.
+Linted paths are appended to lint.log in the fixture root.
+"""
+
+import os
+import sys
+
+
+paths = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+root_path = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+with open(os.path.join(root_path, 'lint.log'), 'a') as f:
+  for path in paths:
+    f.write(os.path.basename(path) + '\n')
+
+failed_count = 0
+for path in paths:
+  with open(path) as f:
+    if 'BAD' in f.read():
+      failed_count += 1
+      sys.stdout.write('----- FILE  :  %s -----\n' % (path))
+      sys.stdout.write('Line 1, E:0001: Bad\n')
+if failed_count:
+  sys.stdout.write('Found %s errors in %s files\n' % (
+      failed_count, failed_count))
+  sys.exit(1)